@@ -17,23 +17,86 @@
 import json
 import Queue
 import logging
+from weakref import WeakKeyDictionary
 
 from cloudify.amqp_client import AMQPConnection
 from cloudify.constants import EVENTS_EXCHANGE_NAME, LOGS_EXCHANGE_NAME
 
+from . import metrics
+
 
 class AckingAMQPConnection(AMQPConnection):
+    """An AMQPConnection that acks the messages put on its acks_queue.
+
+    The messages can be stored (and put on the queue) in any order, so the
+    acks are coalesced: every time the queue is processed, each channel gets
+    a single multiple-ack, up to the highest delivery tag that it, and all
+    the tags before it, were put on the queue.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AckingAMQPConnection, self).__init__(*args, **kwargs)
+        self._delivery_trackers = WeakKeyDictionary()
+
     def _process_publish(self, channel):
         self._process_acks()
         super(AckingAMQPConnection, self)._process_publish(channel)
 
     def _process_acks(self):
+        trackers = self._delivery_trackers
         while True:
             try:
                 channel, tag = self.acks_queue.get_nowait()
-                channel.basic_ack(tag)
             except Queue.Empty:
-                return
+                break
+            if channel not in trackers:
+                trackers[channel] = DeliveryTracker()
+            trackers[channel].done(tag)
+        for channel, tracker in trackers.items():
+            last_acked = tracker.last_acked
+            tag = tracker.pop_ackable()
+            if tag is not None:
+                channel.basic_ack(tag, multiple=True)
+                metrics.ACKS_SENT.inc()
+                metrics.MESSAGES_ACKED.inc(tag - last_acked)
+        # the trackers are only used by the connection's thread, so the
+        # gauge is set here, rather than read by the metrics server's thread
+        metrics.PENDING_ACKS.set(sum(tracker.pending
+                                     for tracker in trackers.values()))
+
+
+class DeliveryTracker(object):
+    """Track the delivery tags of a channel that are ready to be acked.
+
+    Delivery tags are consecutive numbers, starting from 1 on every channel.
+    """
+
+    def __init__(self):
+        self.last_acked = 0
+        self._done = set()
+
+    def done(self, tag):
+        if tag > self.last_acked:
+            self._done.add(tag)
+
+    @property
+    def pending(self):
+        """Number of tags that are done, but can't be acked yet"""
+        return len(self._done)
+
+    def pop_ackable(self):
+        """The highest tag that can be acked with multiple=True.
+
+        :return: the tag, or None if there's nothing new to ack
+        """
+        tag = self.last_acked
+        while tag + 1 in self._done:
+            tag += 1
+            self._done.remove(tag)
+        if tag == self.last_acked:
+            return None
+        self.last_acked = tag
+        return tag
 
 
 logger = logging.getLogger(__name__)
@@ -41,9 +104,13 @@ logger = logging.getLogger(__name__)
 
 class AMQPLogsEventsConsumer(object):
 
-    def __init__(self, message_processor):
+    def __init__(self, message_processor, acks_queue=None,
+                 prefetch_count=None):
         self.queue = 'cloudify-logs-events'
         self._message_processor = message_processor
+        self._acks_queue = acks_queue
+        # how many unacked messages RabbitMQ sends to the consumer
+        self._prefetch_count = prefetch_count
 
         # This is here because AMQPConnection expects it
         self.routing_key = ''
@@ -63,17 +130,29 @@ class AMQPLogsEventsConsumer(object):
                                      EVENTS_EXCHANGE_NAME,
                                      'topic',
                                      routing_key='events.#')
+        if self._prefetch_count:
+            channel.basic_qos(prefetch_count=self._prefetch_count)
         channel.basic_consume(self.process, self.queue)
 #        channel.basic_recover(requeue=True)
 
     def process(self, channel, method, properties, body):
+        metrics.MESSAGES_RECEIVED.labels(exchange=method.exchange).inc()
         try:
             parsed_body = json.loads(body)
+            message_id = _get_publisher_message_id(properties)
+            if message_id is not None:
+                # kept in the message, so that it is spooled along with it
+                parsed_body['message_id'] = message_id
             self._message_processor(parsed_body, method.exchange,
                                     (channel, method.delivery_tag))
         except Exception as e:
             logger.warn('Failed message processing: %s', e)
+            metrics.MESSAGES_FAILED.inc()
             logger.debug('Message was: %s', body)
+            # the message would fail again if it was redelivered, and
+            # messages are only acked up to the first one that isn't
+            if self._acks_queue is not None:
+                self._acks_queue.put((channel, method.delivery_tag))
 
     def _bind_queue_to_exchange(self,
                                 channel,
@@ -87,3 +166,16 @@ class AMQPLogsEventsConsumer(object):
         channel.queue_bind(queue=self.queue,
                            exchange=exchange_name,
                            routing_key=routing_key)
+
+
+def _get_publisher_message_id(properties):
+    """The id that the publisher assigned to the message, if any.
+
+    It is either the message_id property of the message, or its
+    message_id header.
+    """
+    if properties is None:
+        return None
+    if properties.message_id:
+        return properties.message_id
+    return (properties.headers or {}).get('message_id')
@@ -0,0 +1,160 @@
+########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+import logging
+from time import time
+from datetime import datetime
+from threading import Lock
+from collections import defaultdict
+
+from cloudify.constants import LOGS_EXCHANGE_NAME
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_LOGGER = 'amqp-postgres'
+SUMMARY_INTERVAL = 10
+
+# the reasons a log can be dropped for, in the order they're checked
+LEVEL_REASON = 'level'
+REPEATED_REASON = 'repeated'
+RATE_REASON = 'rate'
+
+
+class IngestPolicy(object):
+    """Decide which logs are stored, to protect the database from floods.
+
+    Logs can be dropped for three reasons:
+      - their level is below `min_level`
+      - they are identical to a log of the same execution that was already
+        received `repeat_limit` times in the current interval; after that,
+        only one in every `sample_rate` of them is stored
+      - their execution sends more than `rate` logs per second, with bursts
+        of up to `burst` logs (a token bucket per execution)
+
+    Every `summary_interval` seconds, a summary log is created for each
+    execution that had logs dropped, stating how many. Events are never
+    dropped. All the checks are disabled by default.
+    """
+
+    def __init__(self, min_level=None, rate=0, burst=None, repeat_limit=0,
+                 sample_rate=100, summary_interval=SUMMARY_INTERVAL,
+                 clock=time):
+        self._lock = Lock()
+        self._min_level = self._level_number(min_level) if min_level else 0
+        self._rate = rate
+        self._burst = burst or max(rate, 1) * 10
+        self._repeat_limit = repeat_limit
+        self._sample_rate = max(sample_rate, 1)
+        self._summary_interval = summary_interval
+        self._clock = clock
+        self._interval_start = clock()
+        # execution id: (tokens, time of the last refill)
+        self._buckets = {}
+        # execution id: {(logger, level, text): count}
+        self._repeats = defaultdict(lambda: defaultdict(int))
+        # execution id: {reason: count}
+        self._dropped = defaultdict(lambda: defaultdict(int))
+
+    @property
+    def enabled(self):
+        return bool(self._min_level or self._rate or self._repeat_limit)
+
+    def accept(self, message, exchange):
+        """Should the message be stored?"""
+        if exchange != LOGS_EXCHANGE_NAME or not self.enabled:
+            return True
+        try:
+            execution_id = message['context']['execution_id']
+            level = message['level']
+            key = (message['logger'], level, message['message']['text'])
+        except (KeyError, TypeError):
+            # malformed messages are rejected when they're stored
+            return True
+        with self._lock:
+            reason = self._drop_reason(execution_id, level, key)
+            if reason is None:
+                return True
+            self._dropped[execution_id][reason] += 1
+            return False
+
+    def _drop_reason(self, execution_id, level, key):
+        if self._min_level and \
+                0 < self._level_number(level) < self._min_level:
+            return LEVEL_REASON
+        if self._repeat_limit:
+            repeats = self._repeats[execution_id]
+            repeats[key] += 1
+            over_limit = repeats[key] - self._repeat_limit
+            if over_limit > 0 and over_limit % self._sample_rate:
+                return REPEATED_REASON
+        if self._rate and not self._take_token(execution_id):
+            return RATE_REASON
+        return None
+
+    def _take_token(self, execution_id):
+        now = self._clock()
+        tokens, last_refill = self._buckets.get(
+            execution_id, (self._burst, now))
+        tokens = min(self._burst, tokens + (now - last_refill) * self._rate)
+        if tokens < 1:
+            self._buckets[execution_id] = (tokens, now)
+            return False
+        self._buckets[execution_id] = (tokens - 1, now)
+        return True
+
+    def get_summaries(self):
+        """Get the summary logs of the interval, once it's over.
+
+        :return: a list of log messages, one for each execution that had
+                 logs dropped; empty if the interval isn't over yet
+        """
+        now = self._clock()
+        with self._lock:
+            if now - self._interval_start < self._summary_interval:
+                return []
+            self._interval_start = now
+            dropped, self._dropped = self._dropped, defaultdict(
+                lambda: defaultdict(int))
+            self._repeats.clear()
+            # a bucket that is full again is the same as a new one, so
+            # there's no need to keep it
+            for execution_id, (tokens, last_refill) in \
+                    list(self._buckets.items()):
+                if tokens + (now - last_refill) * self._rate >= self._burst:
+                    del self._buckets[execution_id]
+        return [self._get_summary(execution_id, reasons)
+                for execution_id, reasons in dropped.items()]
+
+    @staticmethod
+    def _get_summary(execution_id, reasons):
+        details = ', '.join('{0}: {1}'.format(reason, count)
+                            for reason, count in sorted(reasons.items()))
+        text = 'Dropped {0} log messages of this execution ({1})'.format(
+            sum(reasons.values()), details)
+        logger.info('Execution %s: %s', execution_id, text)
+        return {
+            'context': {'execution_id': execution_id},
+            'level': 'warning',
+            'logger': SUMMARY_LOGGER,
+            'message': {'text': text},
+            'timestamp': datetime.utcnow().isoformat()
+        }
+
+    @staticmethod
+    def _level_number(level):
+        """The numeric value of a level name; 0 for unknown levels"""
+        number = logging.getLevelName(str(level).upper())
+        return number if isinstance(number, int) else 0
@@ -20,7 +20,9 @@ import logging
 import argparse
 
 from cloudify.amqp_client import get_client
+from prometheus_client import start_http_server
 
+from . import metrics
 from .amqp_consumer import AMQPLogsEventsConsumer, AckingAMQPConnection
 from .postgres_publisher import DBLogEventPublisher
 
@@ -46,9 +48,13 @@ def _create_connections(config):
         cls=AckingAMQPConnection
     )
     amqp_client.acks_queue = acks_queue
+    metrics.ACKS_QUEUE_DEPTH.set_function(acks_queue.qsize)
     db_publisher = DBLogEventPublisher(config, amqp_client)
     amqp_consumer = AMQPLogsEventsConsumer(
-        message_processor=db_publisher.process
+        message_processor=db_publisher.process,
+        acks_queue=acks_queue,
+        prefetch_count=config.get('amqp_postgres_prefetch_count',
+                                  db_publisher.prefetch_count)
     )
 
     amqp_client.add_handler(amqp_consumer)
@@ -63,6 +69,12 @@ def main(args):
     with open(args['config']) as f:
         config = yaml.safe_load(f)
     amqp_client, db_publisher = _create_connections(config)
+    if config.get('amqp_postgres_metrics_port'):
+        port = config['amqp_postgres_metrics_port']
+        host = config.get('amqp_postgres_metrics_host',
+                          metrics.DEFAULT_METRICS_HOST)
+        start_http_server(port, addr=host)
+        logger.info('Serving metrics on http://%s:%d/metrics', host, port)
 
     logger.info('Starting consuming...')
     amqp_client.consume()
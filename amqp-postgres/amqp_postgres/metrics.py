@@ -0,0 +1,80 @@
+########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+"""Ingestion metrics, exposed with prometheus_client.
+
+The metrics are updated by the consumer and the publisher, and served over
+HTTP (GET /metrics, see `prometheus_client.start_http_server`) if
+`amqp_postgres_metrics_port` is set in the config. The server only listens
+on localhost by default.
+"""
+
+from prometheus_client import Counter, Gauge, Histogram
+
+DEFAULT_METRICS_HOST = '127.0.0.1'
+
+# upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+# the metrics of the ingestion pipeline: messages are received by the
+# consumer, queued for one of the writers of the publisher, stored in
+# batches, and then queued to be acked
+MESSAGES_RECEIVED = Counter(
+    'amqp_postgres_messages_received_total',
+    'Messages received from RabbitMQ', labelnames=['exchange'])
+MESSAGES_FAILED = Counter(
+    'amqp_postgres_messages_failed_total',
+    'Messages that could not be parsed or queued')
+MESSAGES_DROPPED = Counter(
+    'amqp_postgres_messages_dropped_total',
+    'Messages that were not stored', labelnames=['reason'])
+MESSAGES_SPOOLED = Counter(
+    'amqp_postgres_messages_spooled_total',
+    'Messages written to the spool while the database was down')
+ROWS_INSERTED = Counter(
+    'amqp_postgres_rows_inserted_total',
+    'Rows committed to the database (including duplicates that were '
+    'skipped)', labelnames=['table'])
+BATCH_SIZE = Histogram(
+    'amqp_postgres_batch_size',
+    'Messages per stored batch', buckets=SIZE_BUCKETS)
+COMMIT_SECONDS = Histogram(
+    'amqp_postgres_commit_seconds',
+    'Time it took to store and commit a batch', buckets=LATENCY_BUCKETS)
+FALLBACKS = Counter(
+    'amqp_postgres_fallbacks_total',
+    'Times the normal storing of a batch was replaced by a fallback',
+    labelnames=['kind'])
+EXECUTIONS_CACHE_LOOKUPS = Counter(
+    'amqp_postgres_executions_cache_lookups_total',
+    'Lookups of executions in the cache', labelnames=['result'])
+WRITER_QUEUE_DEPTH = Gauge(
+    'amqp_postgres_writer_queue_depth',
+    'Received messages waiting for a writer', labelnames=['writer'])
+ACKS_QUEUE_DEPTH = Gauge(
+    'amqp_postgres_acks_queue_depth',
+    'Stored messages waiting to be acked')
+PENDING_ACKS = Gauge(
+    'amqp_postgres_pending_acks',
+    'Stored messages whose ack waits for an earlier message to be stored')
+MESSAGES_ACKED = Counter(
+    'amqp_postgres_messages_acked_total',
+    'Messages acked to RabbitMQ')
+ACKS_SENT = Counter(
+    'amqp_postgres_acks_sent_total',
+    'Multiple-acks sent to RabbitMQ')
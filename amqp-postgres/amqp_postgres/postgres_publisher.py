@@ -14,22 +14,80 @@
 # limitations under the License.
 ############
 
+import os
 import json
 import Queue
 import logging
-from time import time
+from io import BytesIO
+from time import time, sleep
 from threading import Thread, Lock
 
 import psycopg2
+import psycopg2.extensions
 from psycopg2.extras import execute_values, DictCursor
 from collections import OrderedDict
 from cloudify.constants import EVENTS_EXCHANGE_NAME, LOGS_EXCHANGE_NAME
 
+from . import metrics
+from .spool import Spool
+from .ingest_policy import IngestPolicy, SUMMARY_INTERVAL
 
 logger = logging.getLogger(__name__)
 
+# Upper bound of the time a message waits before its batch is flushed. The
+# actual delay and batch size are adapted to the load by BatchController,
+# within the bounds below (all of them can be overridden in the config)
 BATCH_DELAY = 0.5
+MIN_BATCH_DELAY = 0.05
+MIN_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 5000
+# Commits slower than this make the batches smaller
+TARGET_COMMIT_TIME = 0.5
 
+# Number of writer threads, each with its own database connection
+DEFAULT_WRITERS = 1
+# The prefetch count is a 16 bit number in AMQP
+MAX_PREFETCH_COUNT = 65535
+
+# Errors that might mean the connection to the database was lost. Some
+# OperationalErrors only fail the transaction (eg. a deadlock or a statement
+# timeout), so the connection is only considered lost if it is closed, or
+# if the error didn't come from the server (see `_is_connection_lost`)
+DB_CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+# Errors that only fail the transaction, after which it can be retried
+TRANSACTION_ERRORS = (psycopg2.extensions.TransactionRollbackError,
+                      psycopg2.extensions.QueryCanceledError)
+# When the database is down, reconnecting is retried with an exponential
+# backoff (in seconds) between these bounds
+MIN_RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+# While the database is down, received messages are written to a spool
+# file in this directory (one file per writer), and acked once they're
+# on disk. They're stored in the database when it's back, at most this many
+# messages per second
+DEFAULT_SPOOL_DIR = '/var/lib/cloudify/amqp-postgres/spool'
+DEFAULT_SPOOL_MAX_SIZE_MB = 1024
+DEFAULT_SPOOL_REPLAY_RATE = 1000
+
+# How batches are written to the database: `values` sends a multi-row
+# INSERT built by execute_values, `copy` streams the rows with COPY FROM STDIN
+VALUES_INSERT_MODE = 'values'
+COPY_INSERT_MODE = 'copy'
+INSERT_MODES = (VALUES_INSERT_MODE, COPY_INSERT_MODE)
+
+# The events and logs tables are partitioned by day (see the rest-service's
+# storage/partitions.py). The partitions of the coming days are created in
+# advance, every PARTITIONS_INTERVAL seconds
+PARTITIONED_TABLES = ['events', 'logs']
+DEFAULT_PARTITION_DAYS = 7
+PARTITIONS_INTERVAL = 3600
+CREATE_PARTITIONS_QUERY = 'SELECT create_partitions(%s, %s)'
+
+# Rows have a message_id: the id the publisher assigned to the message they
+# were created from, or NULL if it has none. The message_id columns have a
+# unique index (which allows any number of NULLs), and the inserts skip rows
+# that conflict with it, so messages that RabbitMQ redelivers (or that are
+# replayed from the spool) are only stored once
 EVENT_INSERT_QUERY = """
     INSERT INTO events (
         timestamp,
@@ -45,8 +103,10 @@ EVENT_INSERT_QUERY = """
         error_causes,
         visibility,
         source_id,
-        target_id)
+        target_id,
+        message_id)
     VALUES %s
+    ON CONFLICT DO NOTHING
 """
 
 # we use now() and not 'AT UTC'
@@ -67,7 +127,8 @@ EVENT_VALUES_TEMPLATE = """(
         %(error_causes)s,
         %(visibility)s,
         %(source_id)s,
-        %(target_id)s
+        %(target_id)s,
+        %(message_id)s
     )
 """
 
@@ -86,8 +147,10 @@ LOG_INSERT_QUERY = """
         node_id,
         visibility,
         source_id,
-        target_id)
+        target_id,
+        message_id)
     VALUES %s
+    ON CONFLICT DO NOTHING
 """
 # see comment above regarding now()
 LOG_VALUES_TEMPLATE = """(
@@ -104,11 +167,174 @@ LOG_VALUES_TEMPLATE = """(
         %(node_id)s,
         %(visibility)s,
         %(source_id)s,
-        %(target_id)s
+        %(target_id)s,
+        %(message_id)s
     )
 """
 
-EXECUTION_SELECT_QUERY = """
+# COPY doesn't support ON CONFLICT, so in the copy mode the rows are
+# copied into a temporary staging table, and moved from there with
+# INSERT ... SELECT, which also sets now() and casts the reported timestamp
+# the same way the INSERT does. The staging tables are created once per
+# connection, and emptied on every commit
+EVENT_STAGING_CREATE_QUERY = """
+    CREATE TEMPORARY TABLE events_staging (
+        reported_timestamp text,
+        _execution_fk integer,
+        _tenant_id integer,
+        _creator_id integer,
+        event_type text,
+        message text,
+        message_code text,
+        operation text,
+        node_id text,
+        error_causes text,
+        visibility visibility_states,
+        source_id text,
+        target_id text,
+        message_id text)
+    ON COMMIT DELETE ROWS
+"""
+EVENT_COPY_QUERY = """
+    COPY events_staging FROM STDIN
+"""
+EVENT_STAGING_INSERT_QUERY = """
+    INSERT INTO events (
+        timestamp,
+        reported_timestamp,
+        _execution_fk,
+        _tenant_id,
+        _creator_id,
+        event_type,
+        message,
+        message_code,
+        operation,
+        node_id,
+        error_causes,
+        visibility,
+        source_id,
+        target_id,
+        message_id)
+    SELECT
+        now(),
+        CAST (reported_timestamp AS TIMESTAMP),
+        _execution_fk,
+        _tenant_id,
+        _creator_id,
+        event_type,
+        message,
+        message_code,
+        operation,
+        node_id,
+        error_causes,
+        visibility,
+        source_id,
+        target_id,
+        message_id
+    FROM events_staging
+    ON CONFLICT DO NOTHING
+"""
+# the fields of an event item, in the order of the staging table columns
+EVENT_COPY_FIELDS = [
+    'timestamp',
+    'execution_id',
+    'tenant_id',
+    'creator_id',
+    'event_type',
+    'message',
+    'message_code',
+    'operation',
+    'node_id',
+    'error_causes',
+    'visibility',
+    'source_id',
+    'target_id',
+    'message_id',
+]
+
+LOG_STAGING_CREATE_QUERY = """
+    CREATE TEMPORARY TABLE logs_staging (
+        reported_timestamp text,
+        _execution_fk integer,
+        _tenant_id integer,
+        _creator_id integer,
+        logger text,
+        level text,
+        message text,
+        message_code text,
+        operation text,
+        node_id text,
+        visibility visibility_states,
+        source_id text,
+        target_id text,
+        message_id text)
+    ON COMMIT DELETE ROWS
+"""
+LOG_COPY_QUERY = """
+    COPY logs_staging FROM STDIN
+"""
+LOG_STAGING_INSERT_QUERY = """
+    INSERT INTO logs (
+        timestamp,
+        reported_timestamp,
+        _execution_fk,
+        _tenant_id,
+        _creator_id,
+        logger,
+        level,
+        message,
+        message_code,
+        operation,
+        node_id,
+        visibility,
+        source_id,
+        target_id,
+        message_id)
+    SELECT
+        now(),
+        CAST (reported_timestamp AS TIMESTAMP),
+        _execution_fk,
+        _tenant_id,
+        _creator_id,
+        logger,
+        level,
+        message,
+        message_code,
+        operation,
+        node_id,
+        visibility,
+        source_id,
+        target_id,
+        message_id
+    FROM logs_staging
+    ON CONFLICT DO NOTHING
+"""
+LOG_COPY_FIELDS = [
+    'timestamp',
+    'execution_id',
+    'tenant_id',
+    'creator_id',
+    'logger',
+    'level',
+    'message',
+    'message_code',
+    'operation',
+    'node_id',
+    'visibility',
+    'source_id',
+    'target_id',
+    'message_id',
+]
+
+# After each batch, the ids (_storage_id) of the executions that have new
+# events or logs are sent on this channel, comma-separated, so that clients
+# following an execution don't need to poll (see the rest-service's
+# storage/notifications.py). Payloads are limited to 8000 bytes.
+EVENTS_CHANNEL = 'cloudify_events_logs'
+NOTIFY_QUERY = 'SELECT pg_notify(%s, %s)'
+MAX_NOTIFY_PAYLOAD = 7900
+
+EXECUTIONS_SELECT_QUERY = """
     SELECT
         id,
         _storage_id,
@@ -116,51 +342,198 @@ EXECUTION_SELECT_QUERY = """
         _tenant_id,
         visibility
     FROM executions
-    WHERE id = %s
+    WHERE id IN %s
 """
 
+EXECUTIONS_CACHE_SIZE = 10000
+
 
 class DBLogEventPublisher(object):
     COMMIT_DELAY = 0.1  # seconds
 
     def __init__(self, config, connection):
         self._lock = Lock()
-        self._batch = Queue.Queue()
+        # messages are sharded between the writers by execution id, so
+        # that the events of a single execution are stored in order
+        writers = config.get('amqp_postgres_writers', DEFAULT_WRITERS)
+        if writers < 1:
+            raise ValueError('Expected at least 1 writer, got {0}'
+                             .format(writers))
+        self._shards = [Queue.Queue() for _ in range(writers)]
+        metrics.WRITER_QUEUE_DEPTH.clear()
+        for index, shard in enumerate(self._shards):
+            metrics.WRITER_QUEUE_DEPTH.labels(writer=index).set_function(
+                shard.qsize)
+        self._batch_controllers = [
+            BatchController(
+                min_size=config.get('amqp_postgres_min_batch_size',
+                                    MIN_BATCH_SIZE),
+                max_size=config.get('amqp_postgres_max_batch_size',
+                                    MAX_BATCH_SIZE),
+                min_delay=config.get('amqp_postgres_min_batch_delay',
+                                     MIN_BATCH_DELAY),
+                max_delay=config.get('amqp_postgres_max_batch_delay',
+                                     BATCH_DELAY),
+                target_commit_time=config.get(
+                    'amqp_postgres_target_commit_time', TARGET_COMMIT_TIME)
+            ) for _ in range(writers)
+        ]
+
+        self._reconnect_delays = (
+            config.get('amqp_postgres_min_reconnect_delay',
+                       MIN_RECONNECT_DELAY),
+            config.get('amqp_postgres_max_reconnect_delay',
+                       MAX_RECONNECT_DELAY)
+        )
+        spool_dir = config.get('amqp_postgres_spool_dir', DEFAULT_SPOOL_DIR)
+        if spool_dir:
+            max_size = 1024 * 1024 * config.get(
+                'amqp_postgres_spool_max_size_mb', DEFAULT_SPOOL_MAX_SIZE_MB)
+            self._spools = [
+                Spool(os.path.join(spool_dir, 'writer-{0}.spool'.format(i)),
+                      max_size=max_size)
+                for i in range(writers)
+            ]
+            # spools left by a previous run that had more writers are
+            # replayed by the first writer
+            self._orphan_spools = [
+                Spool(os.path.join(spool_dir, filename), max_size=max_size)
+                for filename in self._list_spools(spool_dir)
+                if filename not in set(os.path.basename(spool.path)
+                                       for spool in self._spools)
+            ]
+        else:
+            # no spooling: messages are kept in memory until the
+            # database is back
+            self._spools = [None] * writers
+            self._orphan_spools = []
+        self._spool_replay_rate = config.get(
+            'amqp_postgres_spool_replay_rate', DEFAULT_SPOOL_REPLAY_RATE)
+        self._partition_days = config.get(
+            'amqp_postgres_partition_days', DEFAULT_PARTITION_DAYS)
+        self._ingest_policy = IngestPolicy(
+            min_level=config.get('amqp_postgres_min_log_level'),
+            rate=config.get('amqp_postgres_log_rate_limit', 0),
+            burst=config.get('amqp_postgres_log_rate_burst'),
+            repeat_limit=config.get('amqp_postgres_repeated_log_limit', 0),
+            sample_rate=config.get('amqp_postgres_repeated_log_sample_rate',
+                                   100),
+            summary_interval=config.get(
+                'amqp_postgres_drop_summary_interval', SUMMARY_INTERVAL)
+        )
 
-        self._last_commit = time()
         self.config = config
+        self._insert_mode = config.get('amqp_postgres_insert_mode',
+                                       VALUES_INSERT_MODE)
+        if self._insert_mode not in INSERT_MODES:
+            raise ValueError('Unknown insert mode: {0} (expected one of: {1})'
+                             .format(self._insert_mode,
+                                     ', '.join(INSERT_MODES)))
         self._amqp_connection = connection
         self._started = Queue.Queue()
-        self._reset_cache()
+        self._executions_cache = LRUCache(EXECUTIONS_CACHE_SIZE)
         # exception stored here will be raised by the main thread
         self.error_exit = None
 
     def _reset_cache(self):
-        self._executions_cache = LimitedSizeDict(10000)
+        with self._lock:
+            self._executions_cache.clear()
+
+    @property
+    def executions_cache_stats(self):
+        with self._lock:
+            return {
+                'hits': self._executions_cache.hits,
+                'misses': self._executions_cache.misses,
+                'size': len(self._executions_cache)
+            }
 
     def start(self):
         self.error_exit = None
-        # Create a separate thread to allow proper batching without losing
-        # messages. Without this thread, if the messages were just committed,
+        # Create separate threads to allow proper batching without losing
+        # messages. Without them, if the messages were just committed,
         # and 1 new message is sent, then process will never commit, because
-        # batch size wasn't exceeded and commit delay hasn't passed yet
-        publish_thread = Thread(target=self._message_publisher)
-        publish_thread.daemon = True
-        publish_thread.start()
-        try:
-            started = self._started.get(3)
-        except Queue.Empty:
-            raise RuntimeError('Timeout connecting to database')
-        else:
-            if isinstance(started, Exception):
-                raise started
+        # batch size wasn't exceeded and commit delay hasn't passed yet.
+        # Each writer thread has its own connection and its own shard.
+        writers = zip(self._shards, self._batch_controllers, self._spools)
+        for index, (shard, controller, spool) in enumerate(writers):
+            previous_spools = [spool]
+            if index == 0:
+                previous_spools += self._orphan_spools
+            publish_thread = Thread(
+                target=self._run_writer,
+                args=(shard, controller, spool, previous_spools))
+            publish_thread.daemon = True
+            publish_thread.start()
+        partitions_thread = Thread(target=self._partitions_maintainer)
+        partitions_thread.daemon = True
+        partitions_thread.start()
+        for _ in self._shards:
+            try:
+                started = self._started.get(3)
+            except Queue.Empty:
+                raise RuntimeError('Timeout connecting to database')
+            else:
+                if isinstance(started, Exception):
+                    raise started
+
+    @property
+    def batch_settings(self):
+        """The current batch size and flush delay of each of the writers"""
+        return [{'batch_size': controller.batch_size,
+                 'batch_delay': controller.delay}
+                for controller in self._batch_controllers]
+
+    @property
+    def prefetch_count(self):
+        """How many unacked messages the consumer should get at most.
+
+        That's enough to fill two of the largest batches of every writer;
+        more would only wait in memory.
+        """
+        max_batch_size = max(controller.max_size
+                             for controller in self._batch_controllers)
+        return min(MAX_PREFETCH_COUNT,
+                   2 * len(self._shards) * max_batch_size)
 
     def process(self, message, exchange, tag):
-        self._batch.put((message, exchange, tag))
+        if self._ingest_policy.accept(message, exchange):
+            self._get_shard(message).put((message, exchange, tag))
+        else:
+            metrics.MESSAGES_DROPPED.labels(reason='policy').inc()
+            if tag is not None:
+                self._amqp_connection.acks_queue.put(tag)
+        self._queue_drop_summaries()
+
+    def _queue_drop_summaries(self):
+        """Queue the summary logs of the messages that were dropped"""
+        for summary in self._ingest_policy.get_summaries():
+            self._get_shard(summary).put((summary, LOGS_EXCHANGE_NAME, None))
+
+    def _get_shard(self, message):
+        """Choose the writer queue for the message.
+
+        All messages of an execution go to the same writer, which stores
+        them in the order they were received.
+        """
+        if len(self._shards) == 1:
+            return self._shards[0]
+        try:
+            execution_id = message['context']['execution_id']
+        except (KeyError, TypeError):
+            execution_id = None
+        return self._shards[hash(execution_id) % len(self._shards)]
 
     def connect(self):
+        """A connection for a writer"""
+        conn = self._connect()
+        if self._insert_mode == COPY_INSERT_MODE:
+            self._create_staging_tables(conn)
+        return conn
+
+    def _connect(self):
         host, _, port = self.config['postgresql_host'].partition(':')
-        return psycopg2.connect(
+        conn = psycopg2.connect(
             dbname=self.config['postgresql_db_name'],
             host=host,
             port=port or 5432,
@@ -168,8 +541,69 @@ class DBLogEventPublisher(object):
             password=self.config['postgresql_password'],
             cursor_factory=DictCursor
         )
+        # return strings as unicode, same as they are in the messages
+        psycopg2.extensions.register_type(psycopg2.extensions.UNICODE, conn)
+        return conn
+
+    @staticmethod
+    def _create_staging_tables(conn):
+        """Create the temporary tables that the rows are copied into.
+
+        They only exist for the lifetime of the connection, so they are
+        created again after every reconnect.
+        """
+        with conn.cursor() as cur:
+            cur.execute(EVENT_STAGING_CREATE_QUERY)
+            cur.execute(LOG_STAGING_CREATE_QUERY)
+        conn.commit()
+
+    def _partitions_maintainer(self):
+        """Create the partitions of the coming days, once in a while"""
+        while True:
+            try:
+                conn = self._connect()
+                try:
+                    self._create_partitions(conn)
+                finally:
+                    conn.close()
+            except psycopg2.Error as e:
+                # rows are kept in the parent tables until the partitions
+                # are created, so this can be retried later
+                logger.warning('Error creating partitions: %s', e)
+            sleep(PARTITIONS_INTERVAL)
 
-    def _message_publisher(self):
+    def _create_partitions(self, conn):
+        with conn.cursor() as cur:
+            for table in PARTITIONED_TABLES:
+                cur.execute(CREATE_PARTITIONS_QUERY,
+                            (table, self._partition_days))
+        conn.commit()
+
+    @staticmethod
+    def _list_spools(spool_dir):
+        try:
+            filenames = os.listdir(spool_dir)
+        except OSError:
+            return []
+        return sorted(filename for filename in filenames
+                      if filename.endswith('.spool'))
+
+    def _run_writer(self, batch, controller, spool, previous_spools):
+        """Run a writer, and stop consuming if it fails.
+
+        A writer that stopped silently would leave its messages unacked, so
+        once the prefetch count filled up, nothing would be stored anymore,
+        while the process kept running.
+        """
+        try:
+            self._message_publisher(batch, controller, spool,
+                                    previous_spools)
+        except Exception as e:
+            # on_db_connection_error has stopped everything already
+            if self.error_exit is not e:
+                self.on_writer_error(e)
+
+    def _message_publisher(self, batch, controller, spool, previous_spools):
         try:
             conn = self.connect()
         except psycopg2.OperationalError as e:
@@ -178,50 +612,232 @@ class DBLogEventPublisher(object):
         else:
             self._started.put(True)
         items = []
+        # messages spooled by a previous run
+        for previous_spool in previous_spools:
+            while True:
+                try:
+                    self._replay_spool_retrying(
+                        conn, previous_spool, controller)
+                except DB_CONNECTION_ERRORS as e:
+                    conn, items = self._on_connection_lost(
+                        conn, e, batch, controller, spool, items)
+                else:
+                    break
+        last_commit = time()
         while True:
             try:
-                items.append(self._batch.get(timeout=BATCH_DELAY / 2))
+                items.append(batch.get(timeout=controller.delay / 2))
             except Queue.Empty:
-                pass
-            if len(items) > 100 or \
-                    (items and (time() - self._last_commit > BATCH_DELAY)):
+                # if no more messages arrive, the summaries are queued
+                # by the writers
+                self._queue_drop_summaries()
+            if controller.should_flush(len(items), time() - last_commit):
+                commit_start = time()
                 try:
-                    self._store(conn, items)
-                except psycopg2.OperationalError as e:
-                    self.on_db_connection_error(e)
-                except psycopg2.IntegrityError:
-                    logger.exception('Error storing %d logs+events',
-                                     len(items))
-                    conn.rollback()
-                    # in case the integrityError was caused by stale cache,
-                    # clean it entirely before trying to insert without
-                    # batching.
-                    # This happens rarely.
-                    self._reset_cache()
-                    self._store_nobatch(conn, items)
+                    self._store_batch(conn, items)
+                except DB_CONNECTION_ERRORS as e:
+                    if self._is_connection_lost(conn, e):
+                        conn, items = self._on_connection_lost(
+                            conn, e, batch, controller, spool, items)
+                    else:
+                        self._on_transaction_error(conn, e)
+                    # the items that couldn't be stored or spooled are
+                    # stored with the next batch
+                    last_commit = time()
+                    continue
+                last_commit = time()
+                metrics.BATCH_SIZE.observe(len(items))
+                metrics.COMMIT_SECONDS.observe(last_commit - commit_start)
+                controller.update(len(items), last_commit - commit_start,
+                                  batch.qsize())
                 items = []
-                self._last_commit = time()
-
-    def _get_execution(self, conn, execution_id):
-        if execution_id not in self._executions_cache:
-            with conn.cursor() as cur:
-                cur.execute(EXECUTION_SELECT_QUERY, (execution_id, ))
-                executions = cur.fetchall()
-            if len(executions) > 1:
-                raise ValueError('Expected 1 execution, found {0} (id: {1})'
-                                 .format(len(executions), execution_id))
-            elif not executions:
-                execution = None
+
+    @staticmethod
+    def _is_connection_lost(conn, error):
+        """Whether the error means that the database connection was lost.
+
+        Errors reported by the server (which have a pgcode) on a connection
+        that is still open only failed the transaction.
+        """
+        return bool(conn.closed) or getattr(error, 'pgcode', None) is None
+
+    @staticmethod
+    def _on_transaction_error(conn, error):
+        """Roll back a transaction that failed, so that it can be retried"""
+        logger.warning('Error storing logs+events, retrying: %s', error)
+        metrics.FALLBACKS.labels(kind='retry').inc()
+        conn.rollback()
+
+    def _on_connection_lost(self, conn, error, batch, controller, spool,
+                            items):
+        """Handle a lost database connection.
+
+        Wait for the database to be back, while spooling the received
+        messages, and then store the spooled messages.
+
+        :return: a tuple of the new connection, and the messages that were
+                 neither stored nor spooled
+        """
+        logger.error('Lost the database connection: %s', error)
+        metrics.FALLBACKS.labels(kind='reconnect').inc()
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        while True:
+            conn, items = self._wait_for_database(batch, spool, items)
+            try:
+                self._replay_spool_retrying(conn, spool, controller)
+            except DB_CONNECTION_ERRORS as e:
+                logger.error('Lost the database connection: %s', e)
+                continue
+            return conn, items
+
+    def _wait_for_database(self, batch, spool, items):
+        """Reconnect to the database, with an exponential backoff.
+
+        While waiting, the messages of this writer are moved to the spool.
+        If the spool is full (or disabled), the messages are kept in memory,
+        and no more messages are taken from the writer's queue.
+
+        :return: a tuple of the new connection, and the messages that
+                 weren't spooled
+        """
+        delay, max_delay = self._reconnect_delays
+        while True:
+            if not items:
+                while True:
+                    try:
+                        items.append(batch.get_nowait())
+                    except Queue.Empty:
+                        break
+            items = self._spool_items(spool, items)
+            sleep(delay)
+            try:
+                conn = self.connect()
+            except psycopg2.OperationalError as e:
+                logger.warning('Reconnecting to the database failed, '
+                               'retrying in %d seconds: %s', delay, e)
+                delay = min(delay * 2, max_delay)
             else:
-                execution = executions[0]
-            self._executions_cache[execution_id] = execution
-        return self._executions_cache[execution_id]
+                logger.info('Reconnected to the database')
+                return conn, items
+
+    def _spool_items(self, spool, items):
+        """Write the items to the spool, and ack them once they're on disk
 
-    def _get_db_item(self, conn, message, exchange):
-        execution_id = message['context']['execution_id']
-        execution = self._get_execution(conn, execution_id)
+        :return: the items that couldn't be spooled
+        """
+        if not items or spool is None:
+            return items
+        if not spool.append((message, exchange)
+                            for message, exchange, _ in items):
+            logger.warning('The spool %s is full, keeping %d messages in '
+                           'memory', spool.path, len(items))
+            metrics.FALLBACKS.labels(kind='memory').inc()
+            return items
+        metrics.FALLBACKS.labels(kind='spool').inc()
+        metrics.MESSAGES_SPOOLED.inc(len(items))
+        for _, _, ack in items:
+            if ack is not None:
+                self._amqp_connection.acks_queue.put(ack)
+        return []
+
+    def _replay_spool_retrying(self, conn, spool, controller):
+        """Store the spooled messages, retrying after transaction errors
+
+        :raises: one of DB_CONNECTION_ERRORS, if the connection was lost
+        """
+        while True:
+            try:
+                return self._replay_spool(conn, spool, controller)
+            except DB_CONNECTION_ERRORS as e:
+                if self._is_connection_lost(conn, e):
+                    raise
+                self._on_transaction_error(conn, e)
+                sleep(self._reconnect_delays[0])
+
+    def _replay_spool(self, conn, spool, controller):
+        """Store the spooled messages, at a throttled rate"""
+        if spool is None or spool.is_empty():
+            return
+        logger.info('Storing the messages spooled in %s', spool.path)
+        for messages, offset in spool.read(controller.batch_size):
+            start = time()
+            # spooled messages were already acked
+            self._store_batch(conn, [(message, exchange, None)
+                                     for message, exchange in messages])
+            spool.commit(offset)
+            min_duration = len(messages) / float(self._spool_replay_rate)
+            elapsed = time() - start
+            if elapsed < min_duration:
+                sleep(min_duration - elapsed)
+        spool.clear()
+
+    def _get_executions(self, conn, execution_ids):
+        """Get the executions with the given ids, as a dict keyed by id.
+
+        Executions that aren't cached yet are all fetched in a single
+        query. Executions that don't exist are returned (and cached) as None.
+        """
+        executions = {}
+        missing = set()
+        # the cache is shared by all the writers
+        with self._lock:
+            for execution_id in execution_ids:
+                try:
+                    executions[execution_id] = \
+                        self._executions_cache[execution_id]
+                except KeyError:
+                    missing.add(execution_id)
+        lookups = metrics.EXECUTIONS_CACHE_LOOKUPS
+        lookups.labels(result='hit').inc(len(executions))
+        lookups.labels(result='miss').inc(len(missing))
+        if not missing:
+            return executions
+
+        fetched = dict.fromkeys(missing)
+        with conn.cursor() as cur:
+            cur.execute(EXECUTIONS_SELECT_QUERY, (tuple(missing), ))
+            for execution in cur.fetchall():
+                if fetched[execution['id']] is not None:
+                    raise ValueError(
+                        'Expected 1 execution, found more (id: {0})'
+                        .format(execution['id']))
+                fetched[execution['id']] = execution
+        with self._lock:
+            for execution_id, execution in fetched.items():
+                self._executions_cache[execution_id] = execution
+        executions.update(fetched)
+        return executions
+
+    @staticmethod
+    def _get_execution_id(message):
+        try:
+            return message['context']['execution_id']
+        except (KeyError, TypeError):
+            return None
+
+    def _get_db_items(self, conn, items):
+        """Convert the messages to rows, resolving all their executions
+
+        :return: a list of (item, exchange, ack) tuples; item is None
+                 for messages that can't be stored
+        """
+        executions = self._get_executions(conn, set(
+            self._get_execution_id(message) for message, _, _ in items
+        ) - {None})
+        return [
+            (self._get_db_item(message, exchange, executions), exchange, ack)
+            for message, exchange, ack in items
+        ]
+
+    def _get_db_item(self, message, exchange, executions):
+        execution_id = self._get_execution_id(message)
+        execution = executions.get(execution_id)
         if execution is None:
             logger.warning('No execution found: %s', execution_id)
+            metrics.MESSAGES_DROPPED.labels(reason='no_execution').inc()
             return
 
         if exchange == EVENTS_EXCHANGE_NAME:
@@ -230,15 +846,37 @@ class DBLogEventPublisher(object):
             get_item = self._get_log
         else:
             raise ValueError('Unknown exchange type: {0}'.format(exchange))
-        return get_item(message, execution)
+        item = get_item(message, execution)
+        if item is None:
+            metrics.MESSAGES_DROPPED.labels(reason='malformed').inc()
+        return item
+
+    def _store_batch(self, conn, items):
+        try:
+            self._store(conn, items)
+        except psycopg2.IntegrityError:
+            logger.exception('Error storing %d logs+events', len(items))
+            metrics.FALLBACKS.labels(kind='isolate').inc()
+            conn.rollback()
+            self._store_isolating(conn, items)
+        except TRANSACTION_ERRORS as e:
+            if conn.closed:
+                raise
+            logger.warning('Error storing %d logs+events, retrying in '
+                           'smaller transactions: %s', len(items), e)
+            metrics.FALLBACKS.labels(kind='retry').inc()
+            conn.rollback()
+            self._store_isolating(conn, items)
 
     def _store(self, conn, items):
+        self._store_db_items(conn, self._get_db_items(conn, items))
+
+    def _store_db_items(self, conn, db_items):
         events, logs = [], []
 
         acks = []
-        for message, exchange, ack in items:
+        for item, exchange, ack in db_items:
             acks.append(ack)
-            item = self._get_db_item(conn, message, exchange)
             if item is None:
                 continue
             target = events if exchange == EVENTS_EXCHANGE_NAME else logs
@@ -247,45 +885,112 @@ class DBLogEventPublisher(object):
         with conn.cursor() as cur:
             self._insert_events(cur, events)
             self._insert_logs(cur, logs)
+            self._notify(cur, events + logs)
         logger.debug('commit %s', len(logs) + len(events))
         conn.commit()
+        metrics.ROWS_INSERTED.labels(table='events').inc(len(events))
+        metrics.ROWS_INSERTED.labels(table='logs').inc(len(logs))
         for ack in acks:
-            self._amqp_connection.acks_queue.put(ack)
+            if ack is not None:
+                self._amqp_connection.acks_queue.put(ack)
 
-    def _store_nobatch(self, conn, items):
-        """Store the items one by one, without batching.
+    def _store_isolating(self, conn, items):
+        """Store a batch that failed with an IntegrityError.
 
-        This is to be used in the anomalous cases where inserting the whole
-        batch throws an IntegrityError - we fall back to inserting the items
-        one by one, so that only the errorneous message is dropped.
+        The IntegrityError is usually caused by a stale cache (an execution
+        that was deleted while its logs were being sent), so first the
+        executions are resolved again, which drops the messages of the
+        deleted executions. If the batch still fails, it is split in halves
+        recursively until the failing messages are isolated and dropped,
+        so a single bad message costs a few extra transactions (about
+        2*log2 of the batch size) and not one per message.
+        This happens rarely.
+
+        Batches that failed with one of TRANSACTION_ERRORS (eg. a deadlock)
+        are retried the same way. If a half fails with one of them again,
+        the error is raised, and the whole batch is retried later; halves
+        that were stored already are skipped then, by their message ids.
         """
-        for message, exchange, ack in items:
-            item = self._get_db_item(conn, message, exchange)
-            if item is None:
-                continue
-            insert = (self._insert_events if exchange == EVENTS_EXCHANGE_NAME
-                      else self._insert_logs)
-            try:
-                with conn.cursor() as cur:
-                    insert(cur, [item])
-                conn.commit()
-            except psycopg2.OperationalError as e:
-                self.on_db_connection_error(e)
-            except psycopg2.IntegrityError:
-                logger.debug('Error storing %s: %s', exchange, item)
-                conn.rollback()
+        self._reset_cache()
+        self._store_bisecting(conn, self._get_db_items(conn, items))
+
+    def _store_bisecting(self, conn, db_items):
+        try:
+            self._store_db_items(conn, db_items)
+        except psycopg2.IntegrityError as e:
+            conn.rollback()
+            if len(db_items) == 1:
+                item, exchange, ack = db_items[0]
+                logger.warning('Dropping a message from %s that can\'t be '
+                               'stored: %s', exchange, e)
+                logger.debug('Dropped %s: %s', exchange, item)
+                metrics.MESSAGES_DROPPED.labels(reason='integrity').inc()
+                if ack is not None:
+                    self._amqp_connection.acks_queue.put(ack)
+                return
+            middle = len(db_items) // 2
+            self._store_bisecting(conn, db_items[:middle])
+            self._store_bisecting(conn, db_items[middle:])
+
+    @staticmethod
+    def _notify(cursor, items):
+        """Notify the listeners of the executions that have new rows.
+
+        Notifications are only delivered once the transaction commits.
+        """
+        execution_ids = sorted(set(str(item['execution_id'])
+                                   for item in items))
+        payloads = []
+        for execution_id in execution_ids:
+            if payloads and len(payloads[-1]) + len(execution_id) < \
+                    MAX_NOTIFY_PAYLOAD:
+                payloads[-1] += ',' + execution_id
+            else:
+                payloads.append(execution_id)
+        for payload in payloads:
+            cursor.execute(NOTIFY_QUERY, (EVENTS_CHANNEL, payload))
 
     def _insert_events(self, cursor, events):
         if not events:
             return
-        execute_values(cursor, EVENT_INSERT_QUERY, events,
-                       template=EVENT_VALUES_TEMPLATE)
+        if self._insert_mode == COPY_INSERT_MODE:
+            self._copy_rows(cursor, events, EVENT_COPY_FIELDS,
+                            copy_query=EVENT_COPY_QUERY,
+                            insert_query=EVENT_STAGING_INSERT_QUERY)
+        else:
+            execute_values(cursor, EVENT_INSERT_QUERY, events,
+                           template=EVENT_VALUES_TEMPLATE)
 
     def _insert_logs(self, cursor, logs):
         if not logs:
             return
-        execute_values(cursor, LOG_INSERT_QUERY, logs,
-                       template=LOG_VALUES_TEMPLATE)
+        if self._insert_mode == COPY_INSERT_MODE:
+            self._copy_rows(cursor, logs, LOG_COPY_FIELDS,
+                            copy_query=LOG_COPY_QUERY,
+                            insert_query=LOG_STAGING_INSERT_QUERY)
+        else:
+            execute_values(cursor, LOG_INSERT_QUERY, logs,
+                           template=LOG_VALUES_TEMPLATE)
+
+    def _copy_rows(self, cursor, items, fields, copy_query, insert_query):
+        """Stream the items into the table using COPY ... FROM STDIN.
+
+        The rows are serialized in the COPY text format and copied into
+        the staging table, and then inserted from there into the table.
+        """
+        lines = []
+        for item in items:
+            lines.append(u'\t'.join(_copy_value(item[field])
+                                    for field in fields))
+        lines.append(u'')
+        data = BytesIO(u'\n'.join(lines).encode('utf-8'))
+        cursor.copy_expert(copy_query, data)
+        cursor.execute(insert_query)
+
+    def on_writer_error(self, err):
+        logger.exception('Storing logs+events failed - cannot continue')
+        self._amqp_connection.close()
+        self.error_exit = err
 
     def on_db_connection_error(self, err):
         logger.critical('Database down - cannot continue')
@@ -309,7 +1014,8 @@ class DBLogEventPublisher(object):
                 'node_id': message['context'].get('node_id'),
                 'source_id': message['context'].get('source_id'),
                 'target_id': message['context'].get('target_id'),
-                'visibility': execution['visibility']
+                'visibility': execution['visibility'],
+                'message_id': _get_message_id(message)
             }
         except KeyError as e:
             logger.warning('Error formatting log: %s', e)
@@ -335,7 +1041,8 @@ class DBLogEventPublisher(object):
                 'source_id': message['context'].get('source_id'),
                 'target_id': message['context'].get('target_id'),
                 'error_causes': task_error_causes,
-                'visibility': execution['visibility']
+                'visibility': execution['visibility'],
+                'message_id': _get_message_id(message)
             }
         except KeyError as e:
             logger.warning('Error formatting event: %s', e)
@@ -343,22 +1050,145 @@ class DBLogEventPublisher(object):
             return None
 
 
-class LimitedSizeDict(OrderedDict):
+def _get_message_id(message):
+    """A stable identity of the message, used to skip duplicates.
+
+    This is the id that the publisher assigned to the message (see
+    amqp_consumer), which is the same for every delivery of the message.
+    The delivery tag can't be used instead, because a redelivered message
+    gets a new one.
+
+    Messages without an id aren't deduplicated (their message_id is None):
+    a redelivery can't be told apart from a distinct message with the same
+    content (eg. the same log line, logged twice in the same millisecond),
+    and dropping genuine messages is worse than storing a duplicate.
     """
-    A FIFO dictionary with a maximum size limit. If number of keys reaches
-    the limit, the elements added first will be popped
-    Implementation taken from https://stackoverflow.com/a/2437645/978089
+    message_id = message.get('message_id')
+    if message_id:
+        return unicode(message_id)
+    return None
+
+
+def _copy_value(value):
+    """Format a single value for the COPY text format"""
+    if value is None:
+        return u'\\N'
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    elif isinstance(value, str):
+        value = value.decode('utf-8')
+    return (value.replace(u'\\', u'\\\\')
+                 .replace(u'\n', u'\\n')
+                 .replace(u'\r', u'\\r')
+                 .replace(u'\t', u'\\t'))
+
+
+class BatchController(object):
+    """Adapt the batch size and the flush delay of a writer to its load.
+
+    After every commit, the controller is updated with the size of the
+    batch, the time the commit took, and the number of messages still
+    waiting in the writer's queue:
+      - the flush delay follows the commit time, so that under light load
+        (fast commits) messages are stored almost immediately, and under
+        heavy load the commit overhead is amortized over longer intervals
+      - the batch size grows while there is a backlog or while the incoming
+        rate would fill the batch before the delay passes, and shrinks when
+        the commits get slower than the target commit time, or when the
+        load drops
     """
-    def __init__(self, size_limit=None, *args, **kwds):
+    # weight of the newest sample in the moving averages
+    SMOOTHING = 0.3
+
+    def __init__(self, min_size, max_size, min_delay, max_delay,
+                 target_commit_time):
+        if not 0 < min_size <= max_size:
+            raise ValueError('Invalid batch size bounds: {0}-{1}'
+                             .format(min_size, max_size))
+        if not 0 < min_delay <= max_delay:
+            raise ValueError('Invalid batch delay bounds: {0}-{1}'
+                             .format(min_delay, max_delay))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.target_commit_time = target_commit_time
+
+        self.batch_size = min_size
+        self.delay = max_delay
+        self.rate = 0.0
+        self.commit_time = 0.0
+        self._last_update = time()
+
+    def should_flush(self, items_count, since_last_commit):
+        return items_count >= self.batch_size or \
+            (items_count > 0 and since_last_commit >= self.delay)
+
+    def update(self, batch_size, commit_time, backlog):
+        now = time()
+        elapsed = now - self._last_update
+        self._last_update = now
+        if elapsed > 0:
+            self.rate = self._average(self.rate, batch_size / elapsed)
+        self.commit_time = self._average(self.commit_time, commit_time)
+
+        new_size = self.batch_size
+        if self.commit_time > self.target_commit_time:
+            new_size = self.batch_size * 3 // 4
+        elif backlog > self.batch_size or \
+                self.rate * self.delay > self.batch_size:
+            new_size = self.batch_size * 2
+        elif backlog == 0 and self.rate * self.delay < self.batch_size / 4:
+            new_size = self.batch_size // 2
+        new_size = min(self.max_size, max(self.min_size, new_size))
+        new_delay = min(self.max_delay,
+                        max(self.min_delay, self.commit_time * 2))
+
+        if new_size != self.batch_size:
+            logger.debug('Batch size: %d -> %d (rate: %.1f/s, backlog: %d, '
+                         'commit time: %.3fs)', self.batch_size, new_size,
+                         self.rate, backlog, self.commit_time)
+        self.batch_size = new_size
+        self.delay = new_delay
+
+    def _average(self, current, sample):
+        return current + self.SMOOTHING * (sample - current)
+
+
+class LRUCache(object):
+    """A mapping with a maximum size, that evicts the least recently used
+    keys when the limit is reached.
+
+    Lookups through `cache[key]` are counted in `hits` and `misses`.
+    """
+    def __init__(self, size_limit):
         self.size_limit = size_limit
-        OrderedDict.__init__(self, *args, **kwds)
-        self._check_size_limit()
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __getitem__(self, key):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        # re-insert, to mark the key as the most recently used one
+        self._items[key] = value
+        self.hits += 1
+        return value
 
     def __setitem__(self, key, value):
-        OrderedDict.__setitem__(self, key, value)
-        self._check_size_limit()
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.size_limit:
+            self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
 
-    def _check_size_limit(self):
-        if self.size_limit is not None:
-            while len(self) > self.size_limit:
-                self.popitem(last=False)
+    def clear(self):
+        self._items.clear()
@@ -0,0 +1,122 @@
+########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Spool(object):
+    """An append-only file of messages that couldn't be stored in the DB.
+
+    Messages are written as JSON lines, and every append is fsynced before
+    it returns, so that the messages can be acked as soon as they're
+    spooled. When the database is back, the messages are read back in
+    chunks; the offset of the last stored chunk is kept in a separate
+    file, so that after a crash only the chunk that was being replayed
+    will be stored again.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._offset_path = '{0}.offset'.format(path)
+
+    @property
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    @property
+    def offset(self):
+        try:
+            with open(self._offset_path) as f:
+                return int(f.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def is_empty(self):
+        return self.offset >= self.size
+
+    def append(self, messages):
+        """Append the (message, exchange) pairs to the spool.
+
+        :return: False if the spool doesn't have room for the messages;
+                 nothing is written in that case
+        """
+        data = ''.join(
+            json.dumps({'message': message, 'exchange': exchange}) + '\n'
+            for message, exchange in messages
+        )
+        if self.size + len(data) > self.max_size:
+            return False
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+
+    def read(self, chunk_size):
+        """Read the spooled messages, starting from the stored offset.
+
+        :return: a generator of (messages, offset) tuples, where messages
+                 is a list of at most `chunk_size` (message, exchange)
+                 pairs, and offset is the position right after them, to be
+                 passed to `commit` once they're stored
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            chunk = []
+            while True:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    # the end of the file, or a partially written line
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning('Skipping a corrupt spooled message')
+                    continue
+                chunk.append((record['message'], record['exchange']))
+                if len(chunk) >= chunk_size:
+                    yield chunk, f.tell()
+                    chunk = []
+            if chunk:
+                yield chunk, f.tell()
+
+    def commit(self, offset):
+        """Mark the messages up to `offset` as stored"""
+        tmp_path = '{0}.tmp'.format(self._offset_path)
+        with open(tmp_path, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._offset_path)
+
+    def clear(self):
+        """Remove the spool, once all of its messages are stored"""
+        for path in [self.path, self._offset_path]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -14,10 +14,21 @@
 # limitations under the License.
 ############
 
+import os
+import json
+import errno
+import Queue
+import shutil
+import psycopg2
+import tempfile
 from uuid import uuid4
-from time import sleep
+from time import sleep, time
+from unittest import TestCase, skipUnless
 from dateutil import parser as date_parser
 
+from mock import MagicMock, Mock, patch
+from prometheus_client import REGISTRY, generate_latest
+
 from cloudify.models_states import VisibilityState
 from cloudify.amqp_client import create_events_publisher
 
@@ -29,9 +40,30 @@ from manager_rest.test.base_test import BaseServerTestCase
 
 
 from amqp_postgres.main import _create_connections
-from amqp_postgres.postgres_publisher import BATCH_DELAY
+from amqp_postgres.amqp_consumer import (
+    AckingAMQPConnection,
+    AMQPLogsEventsConsumer,
+    DeliveryTracker
+)
+from amqp_postgres.postgres_publisher import (
+    BATCH_DELAY,
+    BatchController,
+    COPY_INSERT_MODE,
+    VALUES_INSERT_MODE,
+    DBLogEventPublisher,
+    EVENTS_CHANNEL,
+    LRUCache,
+    MAX_NOTIFY_PAYLOAD,
+    NOTIFY_QUERY,
+    _get_message_id
+)
+from amqp_postgres.spool import Spool
+from amqp_postgres.ingest_policy import IngestPolicy
+from cloudify.constants import EVENTS_EXCHANGE_NAME, LOGS_EXCHANGE_NAME
 
 LOG_MESSAGE = 'log'
+# set to run the benchmarks, which only report their timings
+BENCHMARK_ENV = 'AMQP_POSTGRES_BENCHMARK'
 EVENT_MESSAGE = 'event'
 
 
@@ -46,8 +78,8 @@ class TestAMQPPostgres(BaseServerTestCase):
             'amqp_{0}'.format(n)
             for n in ['host', 'username', 'password', 'ca_path']
         ]
-        amqp_client, _ = _create_connections(
-            {k: getattr(config, k) for k in config_keys})
+        self.config = {k: getattr(config, k) for k in config_keys}
+        amqp_client, _ = _create_connections(self.config)
         amqp_client.consume_in_thread()
         self.addCleanup(amqp_client.close)
         self.events_publisher = create_events_publisher()
@@ -112,6 +144,135 @@ class TestAMQPPostgres(BaseServerTestCase):
 
         self._assert_log(log_2, execution_2_logs[0])
 
+    def _get_items(self, execution_id, count):
+        """`count` logs and `count` events, in the format of a batch"""
+        items = []
+        for i in range(count):
+            message = u'Test\tmessage \\ {0}\n\u00e9'.format(i)
+            items.append((self._get_log(execution_id, message),
+                          LOGS_EXCHANGE_NAME, None))
+            items.append((self._get_event(execution_id, message),
+                          EVENTS_EXCHANGE_NAME, None))
+        return items
+
+    def test_copy_insert_mode(self):
+        """COPY stores the same rows as execute_values"""
+        item_count = 5000
+        rows = {}
+        for mode in [VALUES_INSERT_MODE, COPY_INSERT_MODE]:
+            execution_id = str(uuid4())
+            self._create_execution(execution_id)
+            items = self._get_items(execution_id, item_count)
+
+            publisher = DBLogEventPublisher(
+                dict(self.config, amqp_postgres_insert_mode=mode), Mock())
+            conn = publisher.connect()
+            self.addCleanup(conn.close)
+            publisher._store(conn, items)
+
+            filters = {'execution_id': execution_id}
+            pagination = {'size': item_count * 2}
+            rows[mode] = (
+                sorted(self._row_values(log) for log in self.sm.list(
+                    models.Log, filters=filters, pagination=pagination)),
+                sorted(self._row_values(event) for event in self.sm.list(
+                    models.Event, filters=filters, pagination=pagination))
+            )
+
+        self.assertEqual(len(rows[COPY_INSERT_MODE][0]), item_count)
+        self.assertEqual(rows[COPY_INSERT_MODE], rows[VALUES_INSERT_MODE])
+
+    @skipUnless(os.environ.get(BENCHMARK_ENV),
+                'set {0} to run the benchmarks'.format(BENCHMARK_ENV))
+    def test_insert_modes_benchmark(self):
+        """Rows/s of the values and the copy modes, best of a few runs"""
+        item_count = 5000
+        for mode in [VALUES_INSERT_MODE, COPY_INSERT_MODE]:
+            publisher = DBLogEventPublisher(
+                dict(self.config, amqp_postgres_insert_mode=mode), Mock())
+            conn = publisher.connect()
+            self.addCleanup(conn.close)
+            durations = []
+            for _ in range(3):
+                execution_id = str(uuid4())
+                self._create_execution(execution_id)
+                items = self._get_items(execution_id, item_count)
+                start = time()
+                publisher._store(conn, items)
+                durations.append(time() - start)
+            print('{0}: {1:.0f} rows/s'.format(
+                mode, len(items) / min(durations)))
+
+    def test_redelivered_messages(self):
+        """Messages that are stored again are skipped, in both modes"""
+        for mode in [VALUES_INSERT_MODE, COPY_INSERT_MODE]:
+            execution_id = str(uuid4())
+            self._create_execution(execution_id)
+            log = dict(self._get_log(execution_id), message_id=str(uuid4()))
+            event = dict(self._get_event(execution_id),
+                         message_id=str(uuid4()))
+            items = [
+                (log, LOGS_EXCHANGE_NAME, None),
+                (event, EVENTS_EXCHANGE_NAME, None)
+            ]
+            publisher = DBLogEventPublisher(
+                dict(self.config, amqp_postgres_insert_mode=mode), Mock())
+            conn = publisher.connect()
+            self.addCleanup(conn.close)
+            publisher._store(conn, items)
+            # a redelivery, in the same batch as a new message, and as an
+            # identical message that has no message id
+            publisher._store(conn, items + [
+                (self._get_log(execution_id, 'New log'),
+                 LOGS_EXCHANGE_NAME, None),
+                (dict(log, message_id=None), LOGS_EXCHANGE_NAME, None)
+            ])
+
+            filters = {'execution_id': execution_id}
+            self.assertEqual(
+                sorted(log.message for log in self.sm.list(
+                    models.Log, filters=filters)),
+                ['New log', 'Test log', 'Test log'])
+            self.assertEqual(
+                len(self.sm.list(models.Event, filters=filters)), 1)
+
+    def test_sharded_writers(self):
+        """With several writers, each execution's logs are stored in order"""
+        execution_ids = [str(uuid4()) for _ in range(8)]
+        for execution_id in execution_ids:
+            self._create_execution(execution_id)
+        acks = Mock()
+        publisher = DBLogEventPublisher(
+            dict(self.config, amqp_postgres_writers=4), acks)
+        publisher.start()
+
+        for i in range(50):
+            for execution_id in execution_ids:
+                publisher.process(self._get_log(execution_id, str(i)),
+                                  LOGS_EXCHANGE_NAME, i)
+        sleep(BATCH_DELAY * 4)
+
+        for execution_id in execution_ids:
+            logs = self.sm.list(
+                models.Log,
+                filters={'execution_id': execution_id},
+                sort={'_storage_id': 'asc'})
+            self.assertEqual([log.message for log in logs],
+                             [str(i) for i in range(50)])
+        self.assertEqual(acks.acks_queue.put.call_count,
+                         50 * len(execution_ids))
+
+    @staticmethod
+    def _row_values(row):
+        """Get the values of a stored log/event that don't depend on
+        the execution it was stored for
+        """
+        values = row.to_dict()
+        for field in ['_storage_id', '_execution_fk', 'execution_id',
+                      'timestamp', 'message_id']:
+            values.pop(field, None)
+        return sorted(values.items())
+
     @staticmethod
     def _get_amqp_manager():
         return AMQPManager(
@@ -218,3 +379,521 @@ class TestAMQPPostgres(BaseServerTestCase):
             },
             'timestamp': get_formatted_timestamp()
         }
+
+
+class TestBatchController(TestCase):
+    def setUp(self):
+        super(TestBatchController, self).setUp()
+        self.now = 1000.0
+        time_patcher = patch('amqp_postgres.postgres_publisher.time',
+                             lambda: self.now)
+        time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+        self.controller = BatchController(
+            min_size=100, max_size=1000, min_delay=0.05, max_delay=0.5,
+            target_commit_time=0.5)
+
+    def _commit(self, batch_size, commit_time, backlog, interval=0.5):
+        self.now += interval
+        self.controller.update(batch_size, commit_time, backlog)
+
+    def test_flush(self):
+        self.assertFalse(self.controller.should_flush(0, 10))
+        self.assertFalse(self.controller.should_flush(10, 0.1))
+        self.assertTrue(self.controller.should_flush(10, 0.5))
+        self.assertTrue(self.controller.should_flush(100, 0))
+
+    def test_grows_with_backlog(self):
+        for _ in range(10):
+            self._commit(self.controller.batch_size, 0.05, 100000)
+        self.assertEqual(self.controller.batch_size, 1000)
+
+    def test_shrinks_on_slow_commits(self):
+        for _ in range(10):
+            self._commit(self.controller.batch_size, 0.05, 100000)
+        for _ in range(20):
+            self._commit(self.controller.batch_size, 2, 100000)
+        self.assertEqual(self.controller.batch_size, 100)
+        self.assertEqual(self.controller.delay, 0.5)
+
+    def test_light_load(self):
+        for _ in range(20):
+            self._commit(1, 0.002, 0, interval=5)
+        self.assertEqual(self.controller.batch_size, 100)
+        self.assertEqual(self.controller.delay, 0.05)
+
+
+class TestExecutionsCache(TestCase):
+    def test_lru_eviction(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache['a'], 1)
+        cache['c'] = 3
+        # 'b' is the least recently used
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertIn('c', cache)
+        with self.assertRaises(KeyError):
+            cache['b']
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_batched_lookup(self):
+        publisher = DBLogEventPublisher({}, Mock())
+        conn = MagicMock()
+        cursor = conn.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [
+            {'id': 'e1', '_storage_id': 1},
+            {'id': 'e2', '_storage_id': 2},
+        ]
+        executions = publisher._get_executions(conn, {'e1', 'e2', 'e3'})
+        self.assertEqual(cursor.execute.call_count, 1)
+        self.assertEqual(executions['e1']['_storage_id'], 1)
+        self.assertEqual(executions['e2']['_storage_id'], 2)
+        self.assertIsNone(executions['e3'])
+
+        # all of them are cached now, including the missing one
+        publisher._get_executions(conn, {'e1', 'e2', 'e3'})
+        self.assertEqual(cursor.execute.call_count, 1)
+        stats = publisher.executions_cache_stats
+        self.assertEqual((stats['hits'], stats['misses']), (3, 3))
+
+
+class TestFailureIsolation(TestCase):
+    def setUp(self):
+        super(TestFailureIsolation, self).setUp()
+        self.amqp_connection = Mock()
+        self.publisher = DBLogEventPublisher({}, self.amqp_connection)
+        self.publisher._get_executions = Mock(return_value={
+            'e1': {
+                '_storage_id': 1,
+                '_tenant_id': 0,
+                '_creator_id': 0,
+                'visibility': 'tenant'
+            }
+        })
+        self.inserted = []
+        self.publisher._insert_logs = self._insert_logs
+        self.conn = MagicMock()
+
+    def _insert_logs(self, cursor, logs):
+        if any(log['message'] == 'bad' for log in logs):
+            raise psycopg2.IntegrityError()
+        self.inserted.extend(log['message'] for log in logs)
+
+    def _items(self, messages):
+        return [
+            (TestAMQPPostgres._get_log('e1', message), LOGS_EXCHANGE_NAME, i)
+            for i, message in enumerate(messages)
+        ]
+
+    def test_single_bad_message(self):
+        messages = [str(i) for i in range(100)]
+        messages[37] = 'bad'
+        self.publisher._store_batch(self.conn, self._items(messages))
+
+        self.assertEqual(self.inserted,
+                         [m for m in messages if m != 'bad'])
+        acked = [c[0][0] for c in
+                 self.amqp_connection.acks_queue.put.call_args_list]
+        self.assertEqual(sorted(acked), list(range(100)))
+        # the first attempt, the retry after refreshing the executions, and
+        # at most 2 attempts per bisection level
+        self.assertLessEqual(self.conn.rollback.call_count, 2 + 7)
+        self.assertLessEqual(self.conn.commit.call_count, 7)
+
+    def test_all_good(self):
+        messages = [str(i) for i in range(10)]
+        self.publisher._store_batch(self.conn, self._items(messages))
+        self.assertEqual(self.inserted, messages)
+        self.assertEqual(self.conn.commit.call_count, 1)
+        self.assertEqual(self.conn.rollback.call_count, 0)
+
+    def test_transaction_error(self):
+        """A batch that deadlocked is retried, and nothing is dropped"""
+        self.conn.closed = 0
+        errors = [psycopg2.extensions.TransactionRollbackError()]
+        insert_logs = self.publisher._insert_logs
+
+        def _insert_logs(cursor, logs):
+            if errors:
+                raise errors.pop()
+            insert_logs(cursor, logs)
+        self.publisher._insert_logs = _insert_logs
+
+        messages = [str(i) for i in range(10)]
+        self.publisher._store_batch(self.conn, self._items(messages))
+        self.assertEqual(self.inserted, messages)
+        self.assertEqual(self.conn.rollback.call_count, 1)
+
+    def test_notify(self):
+        self.publisher._store_batch(self.conn, self._items(['1', '2']))
+        cursor = self.conn.cursor.return_value.__enter__.return_value
+        cursor.execute.assert_called_once_with(
+            NOTIFY_QUERY, (EVENTS_CHANNEL, '1'))
+
+    def test_notify_payload_size(self):
+        cursor = Mock()
+        items = [{'execution_id': i} for i in range(5000)]
+        self.publisher._notify(cursor, items)
+        payloads = [c[0][1][1] for c in cursor.execute.call_args_list]
+        self.assertGreater(len(payloads), 1)
+        self.assertTrue(all(len(p) <= MAX_NOTIFY_PAYLOAD for p in payloads))
+        self.assertEqual(
+            sorted(int(i) for p in payloads for i in p.split(',')),
+            list(range(5000)))
+
+
+class TestMessageId(TestCase):
+    def _receive(self, properties):
+        processor = Mock()
+        consumer = AMQPLogsEventsConsumer(processor)
+        consumer.process(Mock(), Mock(exchange=LOGS_EXCHANGE_NAME),
+                         properties,
+                         json.dumps(TestAMQPPostgres._get_log('e1')))
+        return processor.call_args[0][0]
+
+    def test_publisher_message_id(self):
+        by_property = self._receive(Mock(message_id='m1', headers=None))
+        by_header = self._receive(Mock(message_id=None,
+                                       headers={'message_id': 'm2'}))
+        self.assertEqual(_get_message_id(by_property), 'm1')
+        self.assertEqual(_get_message_id(by_header), 'm2')
+
+    def test_no_message_id(self):
+        """Messages without a publisher id aren't deduplicated"""
+        message = self._receive(None)
+        self.assertNotIn('message_id', message)
+        self.assertIsNone(_get_message_id(message))
+
+
+class TestSpool(TestCase):
+    def setUp(self):
+        super(TestSpool, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'spool', 'writer-0.spool')
+
+    def test_append_and_read(self):
+        spool = Spool(self.path, max_size=1024 * 1024)
+        self.assertTrue(spool.is_empty())
+        messages = [({'index': i}, LOGS_EXCHANGE_NAME) for i in range(5)]
+        self.assertTrue(spool.append(messages))
+        self.assertFalse(spool.is_empty())
+
+        chunks = list(spool.read(2))
+        self.assertEqual([len(chunk) for chunk, _ in chunks], [2, 2, 1])
+        self.assertEqual([m for chunk, _ in chunks for m in chunk], messages)
+
+        # after committing the first chunk, reading starts after it
+        spool.commit(chunks[0][1])
+        self.assertEqual(
+            [m for chunk, _ in Spool(self.path, 1024).read(10)
+             for m in chunk],
+            messages[2:])
+        spool.clear()
+        self.assertTrue(spool.is_empty())
+
+    def test_full(self):
+        spool = Spool(self.path, max_size=50)
+        self.assertFalse(spool.append(
+            [({'message': 'x' * 100}, LOGS_EXCHANGE_NAME)]))
+        self.assertTrue(spool.is_empty())
+
+
+class TestDatabaseOutage(TestCase):
+    def setUp(self):
+        super(TestDatabaseOutage, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        sleep_patcher = patch('amqp_postgres.postgres_publisher.sleep')
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+        self.amqp_connection = Mock()
+        self.publisher = DBLogEventPublisher(
+            {'amqp_postgres_spool_dir': self.tmpdir}, self.amqp_connection)
+        self.spool = self.publisher._spools[0]
+        self.conn = Mock()
+        self.publisher.connect = Mock(side_effect=[
+            psycopg2.OperationalError(),
+            psycopg2.OperationalError(),
+            self.conn
+        ])
+
+    def test_spool_while_down(self):
+        batch = Queue.Queue()
+        for i in range(3, 6):
+            batch.put(({'index': i}, LOGS_EXCHANGE_NAME, i))
+        items = [({'index': i}, LOGS_EXCHANGE_NAME, i) for i in range(3)]
+
+        conn, items = self.publisher._wait_for_database(
+            batch, self.spool, items)
+
+        self.assertIs(conn, self.conn)
+        self.assertEqual(items, [])
+        # exponential backoff
+        self.assertEqual([c[0][0] for c in self.sleep.call_args_list],
+                         [1, 2, 4])
+        acked = [c[0][0] for c in
+                 self.amqp_connection.acks_queue.put.call_args_list]
+        self.assertEqual(sorted(acked), list(range(6)))
+
+        stored = []
+        self.publisher._store_batch = \
+            lambda conn, items: stored.extend(items)
+        self.publisher._replay_spool(
+            conn, self.spool, self.publisher._batch_controllers[0])
+        self.assertEqual(sorted(m['index'] for m, _, _ in stored),
+                         list(range(6)))
+        # spooled messages aren't acked again
+        self.assertTrue(all(ack is None for _, _, ack in stored))
+        self.assertTrue(self.spool.is_empty())
+
+    def test_connection_lost(self):
+        is_lost = self.publisher._is_connection_lost
+        # a deadlock, or a statement timeout, on an open connection
+        self.assertFalse(is_lost(Mock(closed=0), Mock(pgcode='40P01')))
+        self.assertFalse(is_lost(Mock(closed=0), Mock(pgcode='57014')))
+        self.assertTrue(is_lost(Mock(closed=0), psycopg2.OperationalError()))
+        self.assertTrue(is_lost(Mock(closed=2), Mock(pgcode='57P01')))
+
+    def test_writer_error(self):
+        """A writer that fails (eg. the disk is full) stops consuming"""
+        self.publisher.connect = Mock(return_value=self.conn)
+        self.publisher._store_batch = Mock(
+            side_effect=psycopg2.OperationalError())
+        batch = Queue.Queue()
+        batch.put(({'index': 0}, LOGS_EXCHANGE_NAME, 0))
+        error = IOError(errno.ENOSPC, 'No space left on device')
+
+        with patch.object(Spool, 'append', side_effect=error):
+            self.publisher._run_writer(
+                batch, self.publisher._batch_controllers[0], self.spool,
+                [self.spool])
+
+        self.assertIs(self.publisher.error_exit, error)
+        self.amqp_connection.close.assert_called_once_with()
+
+    def test_no_spool(self):
+        publisher = DBLogEventPublisher(
+            {'amqp_postgres_spool_dir': None}, self.amqp_connection)
+        publisher.connect = Mock(side_effect=[
+            psycopg2.OperationalError(),
+            self.conn
+        ])
+        items = [({'index': i}, LOGS_EXCHANGE_NAME, i) for i in range(3)]
+        conn, remaining = publisher._wait_for_database(
+            Queue.Queue(), None, items)
+        # without a spool, the messages are kept until they're stored
+        self.assertEqual(remaining, items)
+        self.assertFalse(self.amqp_connection.acks_queue.put.called)
+
+
+class TestIngestPolicy(TestCase):
+    def setUp(self):
+        super(TestIngestPolicy, self).setUp()
+        self.now = 0
+        self.execution_id = str(uuid4())
+
+    def _policy(self, **kwargs):
+        return IngestPolicy(clock=lambda: self.now, **kwargs)
+
+    def _accepted(self, policy, messages, exchange=LOGS_EXCHANGE_NAME):
+        return [message['message']['text'] for message in messages
+                if policy.accept(message, exchange)]
+
+    def _log(self, text, level='info'):
+        log = TestAMQPPostgres._get_log(self.execution_id, text)
+        log['level'] = level
+        return log
+
+    def test_disabled(self):
+        policy = self._policy()
+        logs = [self._log('same', 'debug') for _ in range(1000)]
+        self.assertEqual(len(self._accepted(policy, logs)), 1000)
+
+    def test_min_level(self):
+        policy = self._policy(min_level='info')
+        logs = [self._log(level, level)
+                for level in ['debug', 'info', 'warning', 'custom']]
+        self.assertEqual(self._accepted(policy, logs),
+                         ['info', 'warning', 'custom'])
+
+    def test_repeated_messages(self):
+        policy = self._policy(repeat_limit=3, sample_rate=10)
+        logs = [self._log('same') for _ in range(23)] + [self._log('new')]
+        # the first 3, and then 1 in every 10
+        self.assertEqual(self._accepted(policy, logs),
+                         ['same'] * 5 + ['new'])
+
+    def test_rate_limit(self):
+        policy = self._policy(rate=10, burst=20)
+        logs = [self._log(str(i)) for i in range(50)]
+        self.assertEqual(len(self._accepted(policy, logs)), 20)
+        self.now += 1
+        self.assertEqual(len(self._accepted(policy, logs)), 10)
+        # other executions have their own limit
+        self.execution_id = str(uuid4())
+        logs = [self._log(str(i)) for i in range(50)]
+        self.assertEqual(len(self._accepted(policy, logs)), 20)
+
+    def test_events_are_never_dropped(self):
+        policy = self._policy(min_level='error', rate=1, repeat_limit=1)
+        events = [TestAMQPPostgres._get_event(self.execution_id)
+                  for _ in range(100)]
+        self.assertEqual(
+            len(self._accepted(policy, events, EVENTS_EXCHANGE_NAME)), 100)
+
+    def test_summaries(self):
+        policy = self._policy(min_level='info', rate=1, burst=1,
+                              summary_interval=10)
+        self._accepted(policy, [self._log('a', 'debug'), self._log('b'),
+                                self._log('c'), self._log('d')])
+        self.assertEqual(policy.get_summaries(), [])
+        self.now += 10
+        summaries = policy.get_summaries()
+        self.assertEqual(len(summaries), 1)
+        self.assertEqual(summaries[0]['context']['execution_id'],
+                         self.execution_id)
+        self.assertEqual(
+            summaries[0]['message']['text'],
+            'Dropped 3 log messages of this execution (level: 1, rate: 2)')
+        # a summary is created only once
+        self.now += 10
+        self.assertEqual(policy.get_summaries(), [])
+
+    def test_publisher_acks_dropped_logs(self):
+        amqp_connection = Mock()
+        publisher = DBLogEventPublisher(
+            {'amqp_postgres_min_log_level': 'info',
+             'amqp_postgres_spool_dir': None}, amqp_connection)
+        publisher.process(self._log('dropped', 'debug'),
+                          LOGS_EXCHANGE_NAME, 1)
+        publisher.process(self._log('stored'), LOGS_EXCHANGE_NAME, 2)
+
+        amqp_connection.acks_queue.put.assert_called_once_with(1)
+        queued = publisher._shards[0].get_nowait()
+        self.assertEqual(queued[0]['message']['text'], 'stored')
+        self.assertTrue(publisher._shards[0].empty())
+
+
+class TestAcks(TestCase):
+    def _connection(self):
+        with patch('amqp_postgres.amqp_consumer.AMQPConnection.__init__',
+                   return_value=None):
+            connection = AckingAMQPConnection()
+        connection.acks_queue = Queue.Queue()
+        return connection
+
+    def test_contiguous_tags(self):
+        tracker = DeliveryTracker()
+        tracker.done(2)
+        tracker.done(3)
+        self.assertIsNone(tracker.pop_ackable())
+        tracker.done(1)
+        tracker.done(5)
+        self.assertEqual(tracker.pop_ackable(), 3)
+        self.assertIsNone(tracker.pop_ackable())
+        tracker.done(4)
+        self.assertEqual(tracker.pop_ackable(), 5)
+
+    def test_one_ack_per_channel(self):
+        connection = self._connection()
+        channel, other_channel = Mock(), Mock()
+        for ack in [(channel, 2), (other_channel, 1), (channel, 1),
+                    (channel, 3), (channel, 5)]:
+            connection.acks_queue.put(ack)
+        connection._process_acks()
+        channel.basic_ack.assert_called_once_with(3, multiple=True)
+        other_channel.basic_ack.assert_called_once_with(1, multiple=True)
+
+        channel.reset_mock()
+        connection.acks_queue.put((channel, 4))
+        connection._process_acks()
+        channel.basic_ack.assert_called_once_with(5, multiple=True)
+
+    def test_failed_messages_are_acked(self):
+        acks_queue = Queue.Queue()
+        consumer = AMQPLogsEventsConsumer(Mock(), acks_queue=acks_queue)
+        channel, method = Mock(), Mock(delivery_tag=7)
+        consumer.process(channel, method, None, 'not json')
+        self.assertEqual(acks_queue.get_nowait(), (channel, 7))
+
+    def test_prefetch(self):
+        publisher = DBLogEventPublisher(
+            {'amqp_postgres_writers': 2,
+             'amqp_postgres_max_batch_size': 1000,
+             'amqp_postgres_spool_dir': None}, Mock())
+        consumer = AMQPLogsEventsConsumer(
+            publisher.process, prefetch_count=publisher.prefetch_count)
+        connection = Mock()
+        consumer.register(connection)
+        connection.channel().basic_qos.assert_called_once_with(
+            prefetch_count=4000)
+
+
+class TestMetrics(TestCase):
+    @staticmethod
+    def _get(name, **labels):
+        return REGISTRY.get_sample_value(
+            'amqp_postgres_{0}'.format(name), labels) or 0
+
+    def test_exposition(self):
+        body = generate_latest()
+        self.assertIn('# TYPE amqp_postgres_rows_inserted_total counter',
+                      body)
+        self.assertIn('# TYPE amqp_postgres_commit_seconds histogram', body)
+        self.assertIn('amqp_postgres_pending_acks', body)
+
+    def test_pipeline(self):
+        """Received, stored and acked messages are counted"""
+        received = self._get('messages_received_total',
+                             exchange=LOGS_EXCHANGE_NAME)
+        inserted = self._get('rows_inserted_total', table='logs')
+        misses = self._get('executions_cache_lookups_total', result='miss')
+        acked = self._get('messages_acked_total')
+
+        with patch('amqp_postgres.amqp_consumer.AMQPConnection.__init__',
+                   return_value=None):
+            connection = AckingAMQPConnection()
+        connection.acks_queue = Queue.Queue()
+        publisher = DBLogEventPublisher(
+            {'amqp_postgres_spool_dir': None}, connection)
+        consumer = AMQPLogsEventsConsumer(publisher.process)
+        channel = Mock()
+        for tag in [1, 2, 3]:
+            consumer.process(
+                channel, Mock(exchange=LOGS_EXCHANGE_NAME, delivery_tag=tag),
+                None, json.dumps(TestAMQPPostgres._get_log('e1')))
+
+        self.assertEqual(self._get('writer_queue_depth', writer='0'), 3)
+        shard = publisher._shards[0]
+        items = [shard.get_nowait() for _ in range(3)]
+        conn = MagicMock()
+        cursor = conn.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [{
+            'id': 'e1',
+            '_storage_id': 1,
+            '_tenant_id': 0,
+            '_creator_id': 0,
+            'visibility': 'tenant'
+        }]
+        publisher._insert_logs = Mock()
+        # the first message is stored last
+        publisher._store_batch(conn, items[1:])
+        self.assertEqual(self._get('writer_queue_depth', writer='0'), 0)
+        connection._process_acks()
+        self.assertEqual(self._get('pending_acks'), 2)
+        publisher._store_batch(conn, items[:1])
+        connection._process_acks()
+
+        self.assertEqual(
+            self._get('messages_received_total', exchange=LOGS_EXCHANGE_NAME),
+            received + 3)
+        self.assertEqual(self._get('rows_inserted_total', table='logs'),
+                         inserted + 3)
+        self.assertEqual(
+            self._get('executions_cache_lookups_total', result='miss'),
+            misses + 1)
+        self.assertEqual(self._get('messages_acked_total'), acked + 3)
+        self.assertEqual(self._get('pending_acks'), 0)
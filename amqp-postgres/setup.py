@@ -31,6 +31,7 @@ setup(
     install_requires=[
         'pika==0.11.2',
         'psycopg2==2.7.4',
+        'prometheus_client==0.12.0',
         'cloudify-common==5.0.dev1',
     ],
 )
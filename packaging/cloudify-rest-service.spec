@@ -58,6 +58,8 @@ cp -R "${RPM_SOURCE_DIR}/resources/rest-service/cloudify/" "%{buildroot}/opt/man
 # Create the log dirs
 mkdir -p %{buildroot}/var/log/cloudify/rest
 mkdir -p %{buildroot}/var/log/cloudify/amqp-postgres
+# AMQP Postgres spools messages here while the database is down
+mkdir -p %{buildroot}/var/lib/cloudify/amqp-postgres
 
 # Copy static files into place. In order to have files in /packaging/files
 # actually included in the RPM, they must have an entry in the %files
@@ -102,4 +104,5 @@ getent passwd cfyuser >/dev/null || useradd -r -g cfyuser -d /etc/cloudify -s /s
 
 %attr(750,cfyuser,adm) /var/log/cloudify/rest
 %attr(750,cfyuser,adm) /var/log/cloudify/amqp-postgres
+%attr(750,cfyuser,cfyuser) /var/lib/cloudify/amqp-postgres
 %attr(550,root,cfyuser) /opt/cloudify/encryption/update-encryption-key
@@ -0,0 +1,61 @@
+"""Partition events and logs by day
+ - Create the partitioning functions and the insert triggers
+ - Create the partitions of all the days that have events or logs
+
+The migration runs in a single transaction, and doesn't move any rows, so
+the downtime of the upgrade is about one scan of each of the two tables
+(to find their days). The existing rows stay in the parent tables, where
+they are still queried through the inheritance, and they are moved to
+their partitions later, in short transactions, by the retention job (see
+`RetentionEngine`). Moving them can be interrupted, and resumes where it
+stopped on the next run.
+
+Revision ID: 5a8e7f2c91d4
+Revises: e8e3f4b9a2c1
+Create Date: 2018-11-06 14:03:27.218904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from manager_rest.storage.partitions import (
+    DROP_PARTITION_FUNCTIONS,
+    DROP_TRIGGER,
+    PARTITIONED_TABLES,
+    setup_partitioning
+)
+
+# revision identifiers, used by Alembic.
+revision = '5a8e7f2c91d4'
+down_revision = 'e8e3f4b9a2c1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    for table in PARTITIONED_TABLES:
+        setup_partitioning(conn, table)
+        days = conn.execute(sa.text(
+            'SELECT DISTINCT CAST(reported_timestamp AS date) '
+            'FROM ONLY {0}'.format(table)))
+        for day, in days.fetchall():
+            conn.execute(sa.text('SELECT create_partition(:table, :day)'),
+                         table=table, day=day)
+
+
+def downgrade():
+    conn = op.get_bind()
+    for table in PARTITIONED_TABLES:
+        op.execute(DROP_TRIGGER.format(table))
+        children = conn.execute(sa.text("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = CAST(:table AS regclass)
+        """), table=table)
+        for child, in children.fetchall():
+            op.execute('ALTER TABLE {0} NO INHERIT {1}'.format(child, table))
+            op.execute('INSERT INTO {0} SELECT * FROM {1}'.format(
+                table, child))
+            op.execute('DROP TABLE {0}'.format(child))
+    op.execute(DROP_PARTITION_FUNCTIONS)
@@ -0,0 +1,56 @@
+"""Add full-text search indexes of the events and logs messages
+ - A GIN index on the text search document of the message, on the
+   events and logs tables and on all their partitions
+
+Revision ID: b3f1c2d9e7a4
+Revises: 5a8e7f2c91d4
+Create Date: 2018-11-12 11:20:45.630172
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from manager_rest.storage.partitions import PARTITIONED_TABLES
+
+# revision identifiers, used by Alembic.
+revision = 'b3f1c2d9e7a4'
+down_revision = '5a8e7f2c91d4'
+branch_labels = None
+depends_on = None
+
+# the expression of the index must be the same as in
+# resource_models.message_search_vector
+MESSAGE_SEARCH_VECTOR = "to_tsvector('simple'::regconfig, message)"
+
+
+def _get_tables(conn, table):
+    """The table, and all of its partitions"""
+    children = conn.execute(sa.text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = CAST(:table AS regclass)
+        ORDER BY c.relname
+    """), table=table)
+    return [table] + [child for child, in children.fetchall()]
+
+
+def upgrade():
+    conn = op.get_bind()
+    for table in PARTITIONED_TABLES:
+        for name in _get_tables(conn, table):
+            op.execute('CREATE INDEX {0}_message_search_idx ON {0} '
+                       'USING gin ({1})'.format(name, MESSAGE_SEARCH_VECTOR))
+
+
+def downgrade():
+    conn = op.get_bind()
+    for table in PARTITIONED_TABLES:
+        # partitions created after the upgrade copied the index of the
+        # parent table, under a generated name
+        indexes = conn.execute(sa.text("""
+            SELECT indexname FROM pg_indexes
+            WHERE tablename = ANY(:tables)
+            AND indexdef LIKE '%to_tsvector%'
+        """), tables=_get_tables(conn, table))
+        for index, in indexes.fetchall():
+            op.execute('DROP INDEX {0}'.format(index))
@@ -0,0 +1,34 @@
+"""Add message_id to events and logs
+ - The id that the publisher assigned to the AMQP message that the event
+   or log was stored from (if any), unique, so that redelivered messages
+   are only stored once
+
+Revision ID: e8e3f4b9a2c1
+Revises: 1fbd6bf39e84
+Create Date: 2018-11-04 10:12:31.402156
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e8e3f4b9a2c1'
+down_revision = '1fbd6bf39e84'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('events', sa.Column('message_id', sa.Text(), nullable=True))
+    op.add_column('logs', sa.Column('message_id', sa.Text(), nullable=True))
+    op.create_index(op.f('events_message_id_idx'), 'events', ['message_id'],
+                    unique=True)
+    op.create_index(op.f('logs_message_id_idx'), 'logs', ['message_id'],
+                    unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('logs_message_id_idx'), table_name='logs')
+    op.drop_index(op.f('events_message_id_idx'), table_name='events')
+    op.drop_column('logs', 'message_id')
+    op.drop_column('events', 'message_id')
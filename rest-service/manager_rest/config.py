@@ -68,6 +68,17 @@ class Config(object):
         self.insecure_endpoints_disabled = True
         self.default_page_size = 1000
         self.min_available_memory_mb = None
+        # how often (seconds) the available memory is sampled
+        self.memory_sample_interval = 1.0
+
+        # how many days events and logs are kept (None: forever), and
+        # per-tenant overrides: {tenant name: {'events': days, 'logs': days}}
+        self.events_retention_days = 5
+        self.logs_retention_days = 5
+        self.retention_tenant_policies = {}
+        # old rows are deleted in chunks, with a delay (seconds) between them
+        self.retention_chunk_size = 1000
+        self.retention_chunk_delay = 0.1
 
         self.security_hash_salt = None
         self.security_secret_key = None
@@ -33,6 +33,15 @@ class InsufficientMemoryError(ManagerException):
             *args, **kwargs)
 
 
+class TooManyListenersError(ManagerException):
+    TOO_MANY_LISTENERS_ERROR_CODE = 'too_many_listeners_error'
+
+    def __init__(self, *args, **kwargs):
+        super(TooManyListenersError, self).__init__(
+            503, TooManyListenersError.TOO_MANY_LISTENERS_ERROR_CODE,
+            *args, **kwargs)
+
+
 class MissingPremiumPackage(ManagerException):
     MISSING_PREMIUM_ERROR_CODE = 'missing_premium_package_error'
 
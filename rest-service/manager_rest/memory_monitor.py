@@ -0,0 +1,99 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""The memory available on the manager, sampled in the background.
+
+Checking the available memory before every list would otherwise read
+/proc/meminfo on every request. Instead, a daemon thread samples it every
+`memory_sample_interval` seconds, and all the requests of the process read
+the latest sample.
+"""
+
+import os
+import logging
+from threading import Lock, Thread
+from time import time, sleep
+
+import psutil
+
+from manager_rest import config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_INTERVAL = 1.0
+# if the sampler didn't update the sample for this many intervals (eg. it
+# died), the memory is sampled by the caller instead
+MAX_MISSED_SAMPLES = 5
+
+
+class MemoryMonitor(object):
+    """The latest sample of the available memory, shared by the requests.
+
+    The sampler thread is started on first use, and again in every process
+    that is forked after that (eg. the gunicorn workers), since threads
+    don't survive a fork.
+    """
+
+    def __init__(self, interval=None, sample=None):
+        self._interval = interval
+        self._sample = sample or _sample_available_mb
+        self._lock = Lock()
+        self._pid = None
+        self._available_mb = None
+        self._sampled_at = 0
+
+    @property
+    def interval(self):
+        if self._interval is not None:
+            return self._interval
+        return config.instance.memory_sample_interval or \
+            DEFAULT_SAMPLE_INTERVAL
+
+    def available_mb(self):
+        """The available memory (in MB), as of the latest sample"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+            elif time() - self._sampled_at > \
+                    self.interval * MAX_MISSED_SAMPLES:
+                self._update()
+            return self._available_mb
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._update()
+        thread = Thread(target=self._run, args=(self._pid, ))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, pid):
+        while self._pid == pid:
+            sleep(self.interval)
+            try:
+                with self._lock:
+                    self._update()
+            except Exception:
+                logger.exception('Failed sampling the available memory')
+
+    def _update(self):
+        self._available_mb = self._sample()
+        self._sampled_at = time()
+
+
+def _sample_available_mb():
+    return psutil.virtual_memory().available / 1024 / 1024
+
+
+instance = MemoryMonitor()
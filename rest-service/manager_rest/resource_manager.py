@@ -61,7 +61,8 @@ class ResourceManager(object):
 
     def list_executions(self, include=None, is_include_system_workflows=False,
                         filters=None, pagination=None, sort=None,
-                        all_tenants=False, get_all_results=False):
+                        all_tenants=False, get_all_results=False,
+                        stream=False):
         filters = filters or {}
         is_system_workflow = filters.get('is_system_workflow')
         if is_system_workflow:
@@ -78,7 +79,8 @@ class ResourceManager(object):
             pagination=pagination,
             sort=sort,
             all_tenants=all_tenants,
-            get_all_results=get_all_results
+            get_all_results=get_all_results,
+            stream=stream
         )
 
     def update_execution_status(self, execution_id, status, error):
@@ -1036,7 +1038,7 @@ class ResourceManager(object):
 
         for node in nodes:
             node.set_deployment(deployment)
-            self.sm.put(node)
+        self.sm.put_many(nodes)
 
     def _create_deployment_node_instances(self,
                                           deployment_id,
@@ -1045,8 +1047,7 @@ class ResourceManager(object):
             deployment_id,
             dsl_node_instances)
 
-        for node_instance in node_instances:
-            self.sm.put(node_instance)
+        self.sm.put_many(node_instances)
 
     def assert_no_snapshot_creation_running_or_queued(self):
         """
@@ -1367,8 +1368,7 @@ class ResourceManager(object):
         modified_instances = deepcopy(modification.node_instances)
         modified_instances['before_rollback'] = [
             instance.to_dict() for instance in node_instances]
-        for instance in node_instances:
-            self.sm.delete(instance)
+        self.sm.delete_many(node_instances)
         for instance_dict in modified_instances['before_modification']:
             self.add_node_instance_from_dict(instance_dict)
         nodes_num_instances = {
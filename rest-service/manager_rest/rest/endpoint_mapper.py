@@ -109,7 +109,10 @@ def setup_resources(api):
         'OperationsId': 'operations/<string:operation_id>',
         'TasksGraphs': 'tasks_graphs',
         'TasksGraphsId': 'tasks_graphs/<string:tasks_graph_id>',
-        'ExecutionsCheck': 'executions/<execution_id>/should-start'
+        'ExecutionsCheck': 'executions/<execution_id>/should-start',
+        'EventsStream': 'events/stream/<string:execution_id>',
+        'EventsExport': 'events/export',
+        'SummarizeEvents': 'summary/events'
     }
 
     # Set version endpoint as a non versioned endpoint
@@ -14,12 +14,19 @@
 #  * limitations under the License.
 #
 
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from dateutil.parser import parse as parse_datetime
 from sqlalchemy import (
+    and_ as sql_and,
     asc,
     bindparam,
     desc,
     literal_column,
-    or_ as sql_or
+    or_ as sql_or,
+    type_coerce
 )
 from toolz import dicttoolz
 
@@ -33,6 +40,7 @@ from manager_rest.rest.rest_decorators import (
 from manager_rest.security import SecuredResource
 from manager_rest.security.authorization import authorize
 from manager_rest.storage.models_base import db
+from manager_rest.storage.storage_manager import TOTAL_EXACT, count_results
 from manager_rest.storage.resource_models import (
     Blueprint,
     Deployment,
@@ -41,6 +49,7 @@ from manager_rest.storage.resource_models import (
     Log,
     Node,
     NodeInstance,
+    message_search_condition,
 )
 
 
@@ -55,6 +64,10 @@ class Events(SecuredResource):
 
     DEFAULT_SEARCH_SIZE = 10000
 
+    # Columns that are only selected to build the cursor of the next page
+    # (when paginating with a cursor), and aren't part of the response
+    CURSOR_COLUMNS = ['_cursor_timestamp', '_storage_id']
+
     # <filter name (passed as rest param)>: (<column name>, <comparison>)
     ALLOWED_FILTERS = {
         'node_id': (Node.id, 'in'),
@@ -66,6 +79,7 @@ class Events(SecuredResource):
         'event_type': (Event.event_type, 'in'),
         'level': (Log.level, 'in'),
         'message': ('message', 'ilike'),
+        'message_search': ('message', 'search'),
     }
 
     # Map from old Elasticsearch field name to PostgreSQL one
@@ -86,7 +100,9 @@ class Events(SecuredResource):
         :param filters:
             Dictionary of filters where the key is the column to filter and the
             value is a list of elements that can be matched using the `IN`
-            operator.
+            operator. `message` is matched as a substring (`ILIKE`), which
+            scans all the events and logs; `message_search` only matches
+            whole words, using the message search indexes.
         :type filters: dict(str, list(str))
 
         """
@@ -114,10 +130,14 @@ class Events(SecuredResource):
             elif filter_type == 'ilike':
                 for filter_element in filter_:
                     query = query.filter(model_field.ilike(filter_element))
+            elif filter_type == 'search':
+                for filter_element in filter_:
+                    query = query.filter(
+                        message_search_condition(model_field, filter_element))
             else:
                 raise ValueError(
                     'Unknown filter type: {0}. '
-                    'Allowed values: ilike, in'
+                    'Allowed values: ilike, in, search'
                     .format(filter_type)
                 )
 
@@ -208,7 +228,9 @@ class Events(SecuredResource):
         return query
 
     @staticmethod
-    def _build_select_query(filters, sort, range_filters, tenant_id):
+    def _build_select_query(filters, sort, range_filters, tenant_id,
+                            cursor=None, total_mode=TOTAL_EXACT,
+                            include=None):
         """Build query used to list events for a given execution.
 
         :param filters:
@@ -232,6 +254,11 @@ class Events(SecuredResource):
             The only field that is supported for now is @timestamp (note the
             `@` inherited from the old Elasticsearch implementation):
                 {'timestamp': 'asc'}
+
+            When sorting, each branch of the events/logs union is sorted
+            and limited on its own, so it can stop early (see
+            `_union_top`). If the filters only select events or only logs,
+            there is no union at all.
         :type sort: dict(str, str)
         :param range_filters:
             Filter out events that don't fall in a given range.
@@ -239,41 +266,61 @@ class Events(SecuredResource):
             The only field that is supported for now is @timestamp (note the
             `@` inherited from the old Elasticsearch implementation):
                 {'timestamp': {'from': <iso8601-date>, 'to': <iso8601-date>}}
+
+            Events and logs are partitioned by day of `reported_timestamp`,
+            so range filters on it only scan the partitions of the days in
+            the range.
         :type range_filters: dict(str, str)
+        :param cursor:
+            If not None, paginate with a cursor instead of an offset: the
+            query returns the events that come after the cursor (an empty
+            cursor means the first page), ordered by timestamp, type and
+            storage id. Each branch of the union seeks past the cursor on
+            its own, so deep pages cost the same as the first one.
+        :type cursor: str
+        :param total_mode:
+            How the total is computed (see
+            :func:`manager_rest.storage.storage_manager.count_results`)
+        :type total_mode: str
+        :param include:
+            The names of the columns to select (see `_get_select_columns`),
+            or None to select all of them
+        :type include: set(str)
         :returns:
             A SQL query that returns the events found that match the conditions
-            passed as arguments.
+            passed as arguments, and their total (None if it wasn't counted).
         :rtype: :class:`sqlalchemy.orm.query.Query`
 
         """
         assert isinstance(filters, dict), \
             'Filters is expected to be a dictionary'
 
-        subqueries = []
-        if (('type' not in filters or 'cloudify_event' in filters['type']) and
-                ('level' not in filters)):
-            events_query = Events._build_select_subquery(
-                Event, filters, range_filters, tenant_id)
-            subqueries.append(events_query)
-
-        if (('type' not in filters or 'cloudify_log' in filters['type']) and
-                ('event_type' not in filters)):
-            logs_query = Events._build_select_subquery(
-                Log, filters, range_filters, tenant_id)
-            subqueries.append(logs_query)
-
-        if subqueries:
+        models = Events._get_models(filters)
+        if models:
+            subqueries = [
+                Events._build_select_subquery(
+                    model, filters, range_filters, tenant_id, include)
+                for model in models
+            ]
             query = reduce(
                 lambda left, right: left.union_all(right),
                 subqueries,
             )
-            total = query.count()
-            query = Events._apply_sort(query, sort)
-            query = (
-                query
-                .limit(bindparam('limit'))
-                .offset(bindparam('offset'))
-            )
+            total = count_results(query, total_mode)
+            if cursor is None:
+                # without a sort order, the first rows of each subquery
+                # aren't necessarily the ones of the page
+                if sort and len(subqueries) > 1:
+                    query = Events._union_top(subqueries, sort)
+                query = Events._apply_sort(query, sort)
+                query = (
+                    query
+                    .limit(bindparam('limit'))
+                    .offset(bindparam('offset'))
+                )
+            else:
+                query = Events._apply_cursor(
+                    models, subqueries, sort, cursor)
         else:
             # Simple query that returns no results
             # Used when filtering by a field that doesn't exist for a type
@@ -281,12 +328,199 @@ class Events(SecuredResource):
                 db.session.query(Event.timestamp)
                 .filter(Event.timestamp is None)
             )
-            total = query.count()
+            total = count_results(query, total_mode)
 
         return query, total
 
     @staticmethod
-    def _build_select_subquery(model, filters, range_filters, tenant_id):
+    def _get_models(filters):
+        """The models (Event and/or Log) that can match the filters.
+
+        :param filters: Filters passed as request argument
+        :type filters: dict(str, list(str))
+        :returns: The models to query, possibly none
+        :rtype: list
+
+        """
+        models = []
+        if (('type' not in filters or 'cloudify_event' in filters['type']) and
+                ('level' not in filters)):
+            models.append(Event)
+
+        if (('type' not in filters or 'cloudify_log' in filters['type']) and
+                ('event_type' not in filters)):
+            models.append(Log)
+        return models
+
+    @staticmethod
+    def _union_top(subqueries, sort):
+        """The union of the first rows of each of the subqueries.
+
+        A page of the union can only contain the first `offset + limit`
+        rows of each subquery, so each of them is sorted and limited on
+        its own, which lets postgres use the indexes of its table (eg. the
+        timestamp index) and stop early, instead of reading both tables
+        in full and sorting them together.
+
+        :param subqueries: The select subqueries of the events and logs
+        :param sort: Sorting criteria passed as a request argument
+        :returns: The union of the limited subqueries, which still has to
+                  be sorted and paginated
+        :rtype: :class:`sqlalchemy.orm.query.Query`
+
+        """
+        top = bindparam('limit') + bindparam('offset')
+        return reduce(
+            lambda left, right: left.union_all(right),
+            [Events._apply_sort(subquery, sort).limit(top)
+             for subquery in subqueries],
+        )
+
+    @staticmethod
+    def _apply_cursor(models, subqueries, sort, cursor):
+        """Seek past the cursor, and order the results the way it expects.
+
+        :param models: The model of each of the subqueries
+        :param subqueries: The select subqueries of the events and logs
+        :param sort: Sorting criteria passed as a request argument; only
+                     the timestamp can be used
+        :param cursor: The cursor returned with the previous page, or an
+                       empty string for the first page
+        :returns: The union of the subqueries, ordered and limited
+        :rtype: :class:`sqlalchemy.orm.query.Query`
+
+        """
+        order = Events._get_cursor_order(sort)
+        position = Events._decode_cursor(cursor)
+        subqueries = [
+            subquery.add_columns(
+                # the timestamp column of the response is truncated to
+                # milliseconds, but the cursor needs the exact value
+                type_coerce(model.timestamp, db.DateTime)
+                .label('_cursor_timestamp'),
+                model._storage_id.label('_storage_id'),
+            )
+            for model, subquery in zip(models, subqueries)
+        ]
+        if position is not None:
+            subqueries = [
+                subquery.filter(
+                    Events._seek_condition(model, order, position))
+                for model, subquery in zip(models, subqueries)
+            ]
+        order_func = asc if order == 'asc' else desc
+        if len(subqueries) > 1:
+            # a page only contains the first `limit` rows of each subquery
+            # (all of its rows have the same type)
+            subqueries = [
+                subquery
+                .order_by(order_func(model.timestamp),
+                          order_func(model._storage_id))
+                .limit(bindparam('limit'))
+                for model, subquery in zip(models, subqueries)
+            ]
+        query = reduce(
+            lambda left, right: left.union_all(right),
+            subqueries,
+        )
+        return (
+            query
+            .order_by(
+                order_func('_cursor_timestamp'),
+                order_func('type'),
+                order_func('_storage_id'),
+            )
+            .limit(bindparam('limit'))
+        )
+
+    @staticmethod
+    def _get_cursor_order(sort):
+        """The direction of a cursor-paginated query.
+
+        The cursor encodes the position in the (timestamp, type, id) order,
+        so sorting by any other field isn't supported.
+        """
+        order = 'asc'
+        for field, field_order in sort.items():
+            if field.lstrip('@') != 'timestamp':
+                raise manager_exceptions.BadParametersError(
+                    'Only sorting by timestamp is supported when paginating '
+                    'with a cursor, got: {0}'.format(field))
+            order = field_order
+        return order
+
+    @staticmethod
+    def _seek_condition(model, order, position):
+        """Condition on a subquery to return only the rows after position.
+
+        All the rows of a subquery have the same type, so comparing the
+        (timestamp, type, id) tuples only needs the timestamp, unless the
+        type is the same as the cursor's.
+        """
+        timestamp, event_type, storage_id = position
+        model_type = 'cloudify_{0}'.format(model.__name__.lower())
+        if order == 'asc':
+            after = (lambda left, right: left > right)
+            after_or_equal = (lambda left, right: left >= right)
+        else:
+            after = (lambda left, right: left < right)
+            after_or_equal = (lambda left, right: left <= right)
+
+        if model_type == event_type:
+            return sql_or(
+                after(model.timestamp, timestamp),
+                sql_and(model.timestamp == timestamp,
+                        after(model._storage_id, storage_id))
+            )
+        elif after(model_type, event_type):
+            return after_or_equal(model.timestamp, timestamp)
+        return after(model.timestamp, timestamp)
+
+    @staticmethod
+    def _encode_cursor(sql_event):
+        """The cursor of the page that comes after the given event"""
+        return urlsafe_b64encode(json.dumps([
+            sql_event._cursor_timestamp.isoformat(),
+            sql_event.type,
+            sql_event._storage_id,
+        ]))
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        """The (timestamp, type, id) position encoded in the cursor.
+
+        :returns: The position, or None for an empty cursor
+        """
+        if not cursor:
+            return None
+        try:
+            timestamp, event_type, storage_id = json.loads(
+                urlsafe_b64decode(str(cursor)))
+            return parse_datetime(timestamp), event_type, int(storage_id)
+        except (TypeError, ValueError):
+            raise manager_exceptions.BadParametersError(
+                'Invalid cursor: {0}'.format(cursor))
+
+    @staticmethod
+    def _get_select_columns(_include, sort):
+        """The names of the columns to select for the requested fields.
+
+        The response fields are built from all the columns, so all of
+        them are selected.
+
+        :param _include: Projection passed as a request argument
+        :type _include: list(str)
+        :param sort: Sorting criteria passed as a request argument
+        :type sort: dict(str, str)
+        :returns: The column names, or None to select all of them
+        :rtype: set(str)
+
+        """
+        return None
+
+    @staticmethod
+    def _build_select_subquery(model, filters, range_filters, tenant_id,
+                               include=None):
         """Build select subquery.
 
         :param model: Model used to build the query (either Event or Log)
@@ -297,6 +531,10 @@ class Events(SecuredResource):
         :type filters: dict(str, list(str))
         :param range_filters: Range filtres passed as request argument
         :type range_filters: dict(str, dict(str))
+        :param include: The names of the columns to select, or None to
+                        select all of them. Only the tables of the selected
+                        and filtered columns are joined.
+        :type include: set(str)
         :returns: Select events query
         :rtype: :class:`sqlalchemy.orm.query.Query`
 
@@ -317,49 +555,94 @@ class Events(SecuredResource):
                 return getattr(model, column_name).label(column_name)
             return literal_column('NULL').label(column_name)
 
+        columns = [
+            select_column('id'),
+            select_column('timestamp'),
+            select_column('reported_timestamp'),
+            Blueprint.id.label('blueprint_id'),
+            Deployment.id.label('deployment_id'),
+            Execution.id.label('execution_id'),
+            Execution.workflow_id.label('workflow_id'),
+            select_column('message'),
+            select_column('message_code'),
+            select_column('error_causes'),
+            select_column('event_type'),
+            select_column('operation'),
+            select_column('node_id'),
+            select_column('source_id'),
+            select_column('target_id'),
+            NodeInstance.id.label('node_instance_id'),
+            Node.id.label('node_name'),
+            select_column('logger'),
+            select_column('level'),
+            literal_column("'cloudify_{}'".format(model.__name__.lower()))
+            .label('type'),
+        ]
+        if include is not None:
+            columns = [column for column in columns if column.name in include]
+
         query = (
-            db.session.query(
-                select_column('id'),
-                select_column('timestamp'),
-                select_column('reported_timestamp'),
-                Blueprint.id.label('blueprint_id'),
-                Deployment.id.label('deployment_id'),
-                Execution.id.label('execution_id'),
-                Execution.workflow_id.label('workflow_id'),
-                select_column('message'),
-                select_column('message_code'),
-                select_column('error_causes'),
-                select_column('event_type'),
-                select_column('operation'),
-                select_column('node_id'),
-                select_column('source_id'),
-                select_column('target_id'),
-                NodeInstance.id.label('node_instance_id'),
-                Node.id.label('node_name'),
-                select_column('logger'),
-                select_column('level'),
-                literal_column("'cloudify_{}'".format(model.__name__.lower()))
-                .label('type'),
-            )
+            db.session.query(*columns)
+            .select_from(model)
             .filter(
                 sql_or(
                     model._tenant_id == tenant_id,
                     model.visibility == VisibilityState.GLOBAL
                 )
             )
-            .outerjoin(NodeInstance, NodeInstance.id == model.node_id)
-            .outerjoin(Node, Node._storage_id == NodeInstance._node_fk)
-            .outerjoin(Execution, Execution._storage_id == model._execution_fk)
-            .outerjoin(Deployment,
-                       Deployment._storage_id == Execution._deployment_fk)
-            .outerjoin(
-                Blueprint, Blueprint._storage_id == Deployment._blueprint_fk)
         )
+        for joined_model, condition in Events._get_joins(
+                model, columns, filters):
+            query = query.outerjoin(joined_model, condition)
 
         query = Events._apply_filters(query, model, filters)
         query = Events._apply_range_filters(query, model, range_filters)
         return query
 
+    @staticmethod
+    def _get_joins(model, columns, filters):
+        """The models to join to the events or logs, and how.
+
+        :param model: Model used to build the query (either Event or Log)
+        :param columns: The selected columns
+        :param filters: Filters passed as request argument
+        :returns: A list of (model, join condition) tuples, in join order
+        :rtype: list(tuple)
+
+        """
+        join_conditions = OrderedDict([
+            (NodeInstance, NodeInstance.id == model.node_id),
+            (Node, Node._storage_id == NodeInstance._node_fk),
+            (Execution, Execution._storage_id == model._execution_fk),
+            (Deployment, Deployment._storage_id == Execution._deployment_fk),
+            (Blueprint, Blueprint._storage_id == Deployment._blueprint_fk),
+        ])
+        # the models that are joined through another model
+        dependencies = {
+            Node: NodeInstance,
+            Deployment: Execution,
+            Blueprint: Deployment,
+        }
+
+        tables = set(getattr(column.element, 'table', None)
+                     for column in columns)
+        for filter_field in filters:
+            filter_field = Events.ES_TO_PG_FILTER_FIELD.get(
+                filter_field, filter_field)
+            model_field, _ = Events.ALLOWED_FILTERS.get(
+                filter_field, (None, None))
+            if model_field is not None and not isinstance(model_field, str):
+                tables.add(model_field.class_.__table__)
+
+        joined = set(joined_model for joined_model in join_conditions
+                     if joined_model.__table__ in tables)
+        for joined_model in reversed(join_conditions):
+            if joined_model in joined and joined_model in dependencies:
+                joined.add(dependencies[joined_model])
+        return [(joined_model, condition)
+                for joined_model, condition in join_conditions.items()
+                if joined_model in joined]
+
     @staticmethod
     def _map_event_to_dict(_include, sql_event):
         """Map event to a dictionary to be sent as an API response.
@@ -62,7 +62,8 @@ class Blueprints(resources_v1.Blueprints):
             pagination=pagination,
             sort=sort,
             all_tenants=all_tenants,
-            get_all_results=get_all_results
+            get_all_results=get_all_results,
+            stream=get_all_results
         )
 
 
@@ -23,6 +23,7 @@ from manager_rest.rest import (
     rest_decorators,
 )
 from manager_rest.storage import (
+    StreamedResults,
     get_storage_manager,
     models,
 )
@@ -67,19 +68,25 @@ class Deployments(resources_v1.Deployments):
             pagination=pagination,
             sort=sort,
             all_tenants=all_tenants,
-            get_all_results=get_all_results
+            get_all_results=get_all_results,
+            stream=get_all_results
         )
 
         if _include and 'workflows' in _include:
             # Because we coerce this into a list in the model, but our ORM
             # won't return a model instance when filtering results, we have
             # to coerce this here as well. This is unpleasant.
-            for index, item in enumerate(result.items):
+            def list_workflows(item):
                 r = item._asdict()
                 r['workflows'] = models.Deployment._list_workflows(
                     r['workflows'],
                 )
-                result.items[index] = r
+                return r
+
+            if isinstance(result.items, StreamedResults):
+                result.items = result.items.map(list_workflows)
+            else:
+                result.items = [list_workflows(item) for item in result.items]
 
         return result
 
@@ -30,6 +30,10 @@ from manager_rest.storage.resource_models import (
     Log,
 )
 from manager_rest.storage import ListResult
+from manager_rest.storage.storage_manager import (
+    TOTAL_EXACT,
+    get_total_metadata,
+)
 from manager_rest.security.authorization import authorize
 
 
@@ -60,7 +64,8 @@ class Events(resources_v1.Events):
         """List events using a SQL backend.
 
         :param _include:
-            Projection used to get records from database (not currently used)
+            Projection used to get records from database (see
+            `_get_select_columns`)
         :type _include: list(str)
         :param filters:
             Filter selection.
@@ -76,7 +81,11 @@ class Events(resources_v1.Events):
         :param pagination:
             Parameters used to limit results returned in a single query.
             Expected values `size` and `offset` are mapped into SQL as `LIMIT`
-            and `OFFSET`.
+            and `OFFSET`. If `cursor` is passed instead of `offset`, the
+            results are the ones after the cursor, and the metadata contains
+            the cursor of the next page (None if this is the last page).
+            `total_mode` decides whether the total is counted exactly (the
+            default), estimated, or not counted at all.
         :type pagination: dict(str, int)
         :param sort:
             Result sorting order. The only allowed and expected value is to
@@ -95,27 +104,45 @@ class Events(resources_v1.Events):
         """
         size = pagination.get('size', self.DEFAULT_SEARCH_SIZE)
         offset = pagination.get('offset', 0)
+        cursor = pagination.get('cursor')
+        total_mode = pagination.get('total_mode', TOTAL_EXACT)
+        if cursor is not None and offset:
+            raise manager_exceptions.BadParametersError(
+                '`_offset` and `_cursor` can\'t be used together')
         params = {
             'limit': size,
             'offset': offset,
         }
 
         select_query, total = self._build_select_query(
-            filters, sort, range_filters, self.current_tenant.id
+            filters, sort, range_filters, self.current_tenant.id, cursor,
+            total_mode, self._get_select_columns(_include, sort)
         )
 
+        events = select_query.params(**params).all()
         results = [
             self._map_event_to_dict(_include, event)
-            for event in select_query.params(**params).all()
+            for event in events
         ]
 
         metadata = {
             'pagination': {
                 'size': size,
                 'offset': offset,
-                'total': total,
             }
         }
+        # the position of a page after a cursor isn't known
+        page_length = None if cursor else len(events)
+        metadata['pagination'].update(get_total_metadata(
+            total, total_mode, size, offset, page_length))
+        if cursor is not None:
+            for event in results:
+                for column in self.CURSOR_COLUMNS:
+                    event.pop(column, None)
+            next_cursor = None
+            if events and len(events) == size:
+                next_cursor = self._encode_cursor(events[-1])
+            metadata['pagination']['cursor'] = next_cursor
         return ListResult(results, metadata)
 
     @rest_decorators.exceptions_handled
@@ -66,7 +66,8 @@ class Nodes(resources_v1.Nodes):
             substr_filters=search,
             sort=sort,
             all_tenants=all_tenants,
-            get_all_results=get_all_results
+            get_all_results=get_all_results,
+            stream=get_all_results
         )
 
 
@@ -107,5 +108,6 @@ class NodeInstances(resources_v1.NodeInstances):
             pagination=pagination,
             sort=sort,
             all_tenants=all_tenants,
-            get_all_results=get_all_results
+            get_all_results=get_all_results,
+            stream=get_all_results
         )
@@ -28,6 +28,28 @@ class Events(v2_Events):
 
     UNUSED_FIELDS = ['id', 'node_id', 'message_code']
 
+    @staticmethod
+    def _get_select_columns(_include, sort):
+        """The names of the columns to select for the requested fields.
+
+        Every response field is a column, so only the included ones are
+        selected, together with the ones needed to sort and map the results.
+
+        :param _include: Projection passed as a request argument
+        :type _include: list(str)
+        :param sort: Sorting criteria passed as a request argument
+        :type sort: dict(str, str)
+        :returns: The column names, or None to select all of them
+        :rtype: set(str)
+
+        """
+        if _include is None:
+            return None
+        # the type is needed to map the results
+        columns = set(_include) | {'type'}
+        columns.update(field.lstrip('@') for field in sort)
+        return columns
+
     @staticmethod
     def _map_event_to_dict(_include, sql_event):
         """Map event to a dictionary to be sent as an API response.
@@ -55,13 +77,13 @@ class Events(v2_Events):
                 del event[unused_field]
 
         if event['type'] == 'cloudify_event':
-            del event['logger']
-            del event['level']
+            event.pop('logger', None)
+            event.pop('level', None)
         elif event['type'] == 'cloudify_log':
-            del event['event_type']
+            event.pop('event_type', None)
 
-        # Keep only keys passed in the _include request argument
-        # TBD: Do the projection at the database level
+        # Keep only keys passed in the _include request argument (the
+        # columns needed to sort and map the results are selected too)
         if _include is not None:
             event = dicttoolz.keyfilter(lambda key: key in _include, event)
 
@@ -203,5 +203,6 @@ class Secrets(SecuredResource):
             pagination=pagination,
             sort=sort,
             all_tenants=all_tenants,
-            get_all_results=get_all_results
+            get_all_results=get_all_results,
+            stream=get_all_results
         )
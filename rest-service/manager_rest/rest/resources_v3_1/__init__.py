@@ -62,3 +62,9 @@ from .operations import (                        # NOQA
 from .tokens import UserTokens                    # NOQA
 
 from .executions import ExecutionsCheck           # NOQA
+
+from .events import (                            # NOQA
+    EventsExport,
+    EventsStream,
+    SummarizeEvents
+)
@@ -0,0 +1,449 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import json
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+from flask import Response, stream_with_context
+from flask_restful.reqparse import Argument
+from flask_restful_swagger import swagger
+from sqlalchemy import func, text, type_coerce
+
+from cloudify.models_states import ExecutionState
+
+from manager_rest import manager_exceptions
+from manager_rest.rest import rest_decorators
+from manager_rest.rest.rest_utils import get_args_and_verify_arguments
+from manager_rest.security.authorization import authorize
+from manager_rest.storage import ListResult, db, get_storage_manager
+from manager_rest.storage.notifications import listen_for_events
+from manager_rest.storage.resource_models import Event, Execution, Log
+
+from ..resources_v3 import Events as v3_Events
+from .summary import marshal_summary
+
+DEFAULT_STREAM_TIMEOUT = 20
+# kept below the usual proxy and load balancer idle timeouts (30s)
+MAX_STREAM_TIMEOUT = 25
+DEFAULT_STREAM_SIZE = 1000
+# storage IDs are drawn when the rows are inserted, but the rows are only
+# visible when their transaction commits, so while rows are inserted, a
+# gap among the last STREAM_SETTLE_WINDOW IDs may still be filled (a batch
+# of amqp-postgres is at most 5000 rows)
+STREAM_SETTLE_WINDOW = 10000
+# whether another transaction is inserting rows into the table
+INSERTING_QUERY = text('''
+    SELECT EXISTS (
+        SELECT 1 FROM pg_locks
+        WHERE relation = CAST(:table AS regclass)
+        AND mode = 'RowExclusiveLock'
+        AND pid != pg_backend_pid()
+    )
+''')
+
+# how many rows are fetched from the database at a time when exporting
+EXPORT_FETCH_SIZE = 1000
+EXPORT_MIMETYPE = 'application/x-ndjson'
+
+SUMMARY_INTERVALS = ['second', 'minute', 'hour', 'day']
+SUMMARY_CACHE_SIZE = 1000
+# cached summaries eventually reflect events that were deleted
+SUMMARY_CACHE_TTL = 3600
+
+
+class EventsStream(v3_Events):
+    """New events and logs of an execution, as they are stored.
+
+    This is a long-poll: the request returns the events and logs that were
+    stored after the given cursor, and if there are none yet, it waits (up
+    to `timeout` seconds, at most MAX_STREAM_TIMEOUT) until amqp-postgres
+    notifies that new ones were stored. The response's metadata contains
+    the cursor to pass in the next request. When too many requests are
+    waiting already, the request fails with a 503, and should be retried.
+
+    The cursor is a storage ID, and rows can be committed out of the order
+    of their storage IDs, so while rows are being inserted, the cursor
+    doesn't move past an ID that may still be committed (see
+    `_get_settled_id`).
+    """
+
+    @swagger.operation(
+        responseclass='List[Event]',
+        nickname="stream events",
+        notes='Returns the new events and logs of an execution, waiting '
+              'for them if there are none yet'
+    )
+    @rest_decorators.exceptions_handled
+    @authorize('event_list')
+    @rest_decorators.marshal_events
+    def get(self, execution_id):
+        args = get_args_and_verify_arguments([
+            Argument('events_after', type=int, default=0),
+            Argument('logs_after', type=int, default=0),
+            Argument('timeout', type=float, default=DEFAULT_STREAM_TIMEOUT),
+            Argument('_size', type=int, default=DEFAULT_STREAM_SIZE)
+        ])
+        execution = get_storage_manager().get(Execution, execution_id)
+        execution_storage_id = execution._storage_id
+        cursor = {
+            'events': args.events_after,
+            'logs': args.logs_after
+        }
+        timeout = max(0, min(args.timeout, MAX_STREAM_TIMEOUT))
+
+        with listen_for_events() as listener:
+            items = self._get_new_events(
+                execution_storage_id, cursor, args._size)
+            if not items:
+                # don't keep the tables locked while waiting
+                db.session.commit()
+                if listener.wait(execution_storage_id, timeout):
+                    items = self._get_new_events(
+                        execution_storage_id, cursor, args._size)
+
+        return ListResult(items, {
+            'cursor': cursor,
+            'pagination': {
+                'size': args._size,
+                'offset': 0,
+                'total': len(items)
+            }
+        })
+
+    def _get_new_events(self, execution_storage_id, cursor, size):
+        """The events and logs of the execution that are after the cursor.
+
+        At most `size` of each are returned, and the cursor is updated to
+        the last ones returned.
+        """
+        items = []
+        for model, cursor_key in [(Event, 'events'), (Log, 'logs')]:
+            query = (
+                self._build_select_subquery(
+                    model, {}, {}, self.current_tenant.id)
+                .add_columns(model._storage_id.label('_storage_id'))
+                .filter(model._execution_fk == execution_storage_id)
+                .filter(model._storage_id > cursor[cursor_key])
+                .order_by(model._storage_id)
+                .limit(size)
+            )
+            settled_id = self._get_settled_id(model, cursor[cursor_key])
+            if settled_id is not None:
+                query = query.filter(model._storage_id <= settled_id)
+            for row in query:
+                cursor[cursor_key] = row._storage_id
+                event = self._map_event_to_dict(None, row)
+                del event['_storage_id']
+                items.append(event)
+        return sorted(items, key=lambda event: event['timestamp'])
+
+    @staticmethod
+    def _get_settled_id(model, after):
+        """The highest storage ID of `model` that the cursor can move to.
+
+        While other transactions are inserting rows, a gap among the last
+        STREAM_SETTLE_WINDOW IDs may be an uncommitted row, so the cursor
+        stops before the first such gap. Older gaps (eg. deleted rows, or
+        duplicates that weren't stored) are passed.
+
+        :return: The ID, or None if no rows are being inserted
+        """
+        inserting = db.session.execute(
+            INSERTING_QUERY, {'table': model.__tablename__}).scalar()
+        if not inserting:
+            return None
+        ids = [storage_id for storage_id, in
+               db.session.query(model._storage_id)
+               .filter(model._storage_id > after)
+               .order_by(model._storage_id.desc())
+               .limit(STREAM_SETTLE_WINDOW)]
+        ids.reverse()
+        settled_id = ids[0] if len(ids) == STREAM_SETTLE_WINDOW else after
+        for storage_id in ids:
+            if storage_id > settled_id + 1:
+                break
+            settled_id = storage_id
+        return settled_id
+
+
+class EventsExport(v3_Events):
+    """All the events and logs that match the filters, as newline-delimited
+    JSON (one event or log per line).
+
+    Unlike listing the events page by page, the query runs only once, and
+    its rows are fetched from a server-side cursor, EXPORT_FETCH_SIZE at a
+    time, and written to the response as they come. The memory used
+    doesn't depend on how many events and logs are exported.
+    """
+
+    @swagger.operation(
+        responseclass='List[Event]',
+        nickname="export events",
+        notes='Streams the events and logs that match the filters (the '
+              'same ones as when listing them), as newline-delimited JSON'
+    )
+    @rest_decorators.exceptions_handled
+    @authorize('event_list')
+    @rest_decorators.create_filters()
+    @rest_decorators.rangeable
+    @rest_decorators.projection
+    @rest_decorators.sortable()
+    def get(self, _include=None, filters=None, sort=None, range_filters=None,
+            **kwargs):
+        sort = sort or {'timestamp': 'asc'}
+        query = self._build_export_query(
+            filters, sort, range_filters, self.current_tenant.id,
+            self._get_select_columns(_include, sort))
+        response = Response(
+            stream_with_context(self._export_lines(query, _include)),
+            mimetype=EXPORT_MIMETYPE)
+        # don't let nginx buffer the whole export before sending it
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    def _build_export_query(self, filters, sort, range_filters, tenant_id,
+                            include=None):
+        """The union of the events and logs that match the filters, sorted.
+
+        The filters are validated here, before the response starts.
+
+        :returns: The query, or None if no events or logs can match the
+                  filters
+        """
+        models = self._get_models(filters)
+        if not models:
+            return None
+        subqueries = [
+            self._build_select_subquery(
+                model, filters, range_filters, tenant_id, include)
+            for model in models
+        ]
+        query = reduce(
+            lambda left, right: left.union_all(right),
+            subqueries,
+        )
+        return self._apply_sort(query, sort)
+
+    def _export_lines(self, query, _include):
+        """The results of the query, one JSON document per line"""
+        if query is None:
+            return
+        for sql_event in query.yield_per(EXPORT_FETCH_SIZE):
+            event = self._map_event_to_dict(_include, sql_event)
+            yield json.dumps(event) + '\n'
+
+
+class SummaryCache(object):
+    """The most recently used summaries, for up to `ttl` seconds"""
+
+    def __init__(self, size=SUMMARY_CACHE_SIZE, ttl=SUMMARY_CACHE_TTL):
+        self._size = size
+        self._ttl = ttl
+        self._lock = Lock()
+        self._items = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            expires, value = self._items.pop(key, (None, None))
+            if expires is None or expires < time():
+                return None
+            self._items[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time() + self._ttl, value)
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class SummarizeEvents(v3_Events):
+    """The number of events and logs, grouped by one or two fields.
+
+    This accepts the same filters as listing the events, and requires
+    filtering by execution_id or deployment_id. When grouping by
+    timestamp, the events are counted in buckets of `_interval` (a second,
+    minute, hour or day).
+
+    Summaries that only filter by executions that ended are cached, until
+    another event or log of those executions is stored.
+    """
+
+    summary_fields = [
+        'type',
+        'event_type',
+        'level',
+        'node_id',
+        'node_name',
+        'execution_id',
+        'deployment_id',
+        'timestamp',
+    ]
+    cache = SummaryCache()
+
+    @swagger.operation(
+        responseclass='List[Event]',
+        nickname="summarize events",
+        notes='Returns the number of events and logs of executions or '
+              'deployments, grouped by a field (and optionally a sub-field)'
+    )
+    @rest_decorators.exceptions_handled
+    @authorize('event_list')
+    @marshal_summary('events')
+    @rest_decorators.create_filters()
+    @rest_decorators.rangeable
+    def get(self, filters=None, range_filters=None, **kwargs):
+        args = get_args_and_verify_arguments([
+            Argument('_target_field', required=True),
+            Argument('_sub_field'),
+            Argument('_interval', default='minute'),
+        ])
+        fields = [args._target_field]
+        if args._sub_field:
+            fields.append(args._sub_field)
+        for field in fields:
+            if field not in self.summary_fields:
+                raise manager_exceptions.BadParametersError(
+                    'Field {0} is not available for summary. Valid fields '
+                    'are: {1}'.format(field, ', '.join(self.summary_fields)))
+        if args._interval not in SUMMARY_INTERVALS:
+            raise manager_exceptions.BadParametersError(
+                'Invalid interval: {0}. Valid intervals are: {1}'.format(
+                    args._interval, ', '.join(SUMMARY_INTERVALS)))
+        if 'execution_id' not in filters and 'deployment_id' not in filters:
+            raise manager_exceptions.BadParametersError(
+                'Summarizing events requires filtering by execution_id or '
+                'deployment_id')
+
+        items = self._get_summary(filters, range_filters,
+                                  self.current_tenant.id, fields,
+                                  args._interval)
+        return ListResult(items, {
+            'pagination': {
+                'size': len(items),
+                'offset': 0,
+                'total': len(items)
+            }
+        })
+
+    def _get_summary(self, filters, range_filters, tenant_id, fields,
+                     interval):
+        """The summary, from the cache if possible.
+
+        Only the summaries of executions that ended are cached. Their
+        events and logs can still be stored after they ended (eg. when
+        amqp-postgres replays its spool), so the key includes the last
+        event and log stored for the executions, and such a write makes
+        the cached summary miss.
+
+        :returns: A list of (field value, [sub-field value,] count) tuples
+        """
+        execution_fks = self._ended_executions(filters)
+        if execution_fks is None:
+            return self._summarize(
+                filters, range_filters, tenant_id, fields, interval)
+        key = (
+            tenant_id,
+            tuple(sorted((field, tuple(sorted(values)))
+                         for field, values in filters.items())),
+            tuple(sorted((field, tuple(sorted(range_filter.items())))
+                         for field, range_filter in range_filters.items())),
+            tuple(fields),
+            interval,
+            self._last_stored(execution_fks),
+        )
+        items = self.cache.get(key)
+        if items is None:
+            items = self._summarize(
+                filters, range_filters, tenant_id, fields, interval)
+            self.cache.set(key, items)
+        return items
+
+    @staticmethod
+    def _ended_executions(filters):
+        """The storage IDs of the executions that the filters select, if
+        they only select events of executions that ended (or else None).
+
+        Filtering only by a deployment doesn't qualify, because new
+        executions of the deployment can be started. The executions are
+        looked up with the tenant and permission filters of the storage
+        manager, same as the events are.
+        """
+        execution_ids = set(filters.get('execution_id', []))
+        if not execution_ids:
+            return None
+        executions = get_storage_manager().list(
+            Execution,
+            include=['_storage_id', 'id', 'status'],
+            filters={'id': list(execution_ids)},
+            get_all_results=True
+        )
+        if (len(executions) != len(execution_ids) or
+                any(execution.status not in ExecutionState.END_STATES
+                    for execution in executions)):
+            return None
+        return sorted(execution._storage_id for execution in executions)
+
+    @staticmethod
+    def _last_stored(execution_fks):
+        """The storage IDs of the last event and log of the executions"""
+        return tuple(
+            db.session.query(func.max(model._storage_id))
+            .filter(model._execution_fk.in_(execution_fks))
+            .scalar()
+            for model in [Event, Log]
+        )
+
+    def _summarize(self, filters, range_filters, tenant_id, fields,
+                   interval):
+        """Count the events and logs in SQL, grouped by the fields"""
+        models = self._get_models(filters)
+        if not models:
+            return []
+        subqueries = [
+            self._build_select_subquery(
+                model, filters, range_filters, tenant_id, set(fields))
+            for model in models
+        ]
+        union = reduce(
+            lambda left, right: left.union_all(right),
+            subqueries,
+        ).subquery()
+
+        columns = []
+        for field in fields:
+            column = union.c[field]
+            if field == 'timestamp':
+                column = func.date_trunc(
+                    interval, type_coerce(column, db.DateTime),
+                    type_=db.DateTime).label(field)
+            columns.append(column)
+        query = (
+            db.session.query(*(columns + [func.count()]))
+            .group_by(*columns)
+            .order_by(*columns)
+        )
+        return [
+            tuple(value.isoformat() if field == 'timestamp' else value
+                  for field, value in zip(fields, row[:-1])) + (row[-1], )
+            for row in query
+        ]
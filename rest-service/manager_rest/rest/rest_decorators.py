@@ -13,6 +13,7 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
+import json
 import pytz
 
 from functools import wraps
@@ -22,7 +23,7 @@ from werkzeug.exceptions import HTTPException
 from dateutil.parser import parse as parse_datetime
 from flask_restful import marshal
 from flask_restful.utils import unpack
-from flask import request, current_app
+from flask import Response, request, current_app, stream_with_context
 from sqlalchemy.util._collections import _LW as sql_alchemy_collection
 from toolz import (
     dicttoolz,
@@ -43,6 +44,8 @@ from voluptuous import (
 from ..security.authentication import authenticator
 from manager_rest import utils, config, manager_exceptions
 from manager_rest.storage.models_base import SQLModelBase
+from manager_rest.storage.storage_manager import (TOTAL_MODES,
+                                                  StreamedResults)
 from manager_rest.rest.rest_utils import (verify_and_convert_bool,
                                           request_use_all_tenants)
 
@@ -151,6 +154,8 @@ class marshal_with(object):
                 return response
 
             if isinstance(response, ListResponse):
+                if isinstance(response.items, StreamedResults):
+                    return self.stream_list(response, fields_to_include)
                 return marshal(wrap_list_items(response),
                                ListResponse.resource_fields)
             # SQLAlchemy returns a class that subtypes tuple, but acts
@@ -172,6 +177,38 @@ class marshal_with(object):
 
         return wrapper
 
+    def stream_list(self, response, fields_to_include):
+        """A response with the same JSON as the marshalled list, written
+        one item at a time, as the items are fetched from the database.
+
+        The status (200) is sent before the first item is fetched, so an
+        error while fetching the items can't change it: the items are then
+        cut short, and followed by an "error" object (with the message and
+        error_code of an error response), which the client has to check for.
+        """
+        def generate():
+            yield '{{"metadata": {0}, "items": ['.format(
+                json.dumps(response.metadata))
+            try:
+                for index, item in enumerate(response.items):
+                    item = marshal(self.wrap_with_response_object(item),
+                                   fields_to_include)
+                    yield '{0}{1}'.format(', ' if index else '',
+                                          json.dumps(item))
+            except Exception as e:
+                current_app.logger.exception('Streaming the list failed')
+                yield '], "error": {0}}}'.format(json.dumps({
+                    'message': 'Streaming the list failed - {0}: {1}'
+                               .format(type(e).__name__, str(e)),
+                    'error_code': getattr(
+                        e, 'error_code',
+                        manager_exceptions.INTERNAL_SERVER_ERROR_CODE)
+                }))
+                return
+            yield ']}'
+        return Response(stream_with_context(generate()),
+                        mimetype='application/json')
+
     def wrap_with_response_object(self, data):
         if isinstance(data, dict):
             return data
@@ -432,13 +469,27 @@ def marshal_events(func):
 def paginate(func):
     """Decorator for adding pagination.
 
-    This decorator looks into the request for the `_size` and `_offset`
-    parameters and passes them as the `paginate` parameter to the decorated
-    function.
+    This decorator looks into the request for the `_size`, `_offset`,
+    `_cursor` and `_total_mode` parameters and passes them as the `paginate`
+    parameter to the decorated function.
+
+    The `paginate` parameter is a dictionary whose keys are `size`, `offset`,
+    `cursor` and `total_mode` (note that the leading underscore is dropped)
+    if a values was passed in a request header. Otherwise, the dictionary
+    will be empty.
 
-    The `paginate` parameter is a dictionary whose keys are `size` and `offset`
-    (note that the leading underscore is dropped) if a values was passed in a
-    request header. Otherwise, the dictionary will be empty.
+    `_cursor` is an opaque value, returned in the metadata of the previous
+    page, for endpoints that support paginating with a cursor (an empty
+    value requests the first page). The resources listed through the
+    storage manager and the events support it: the next page is looked up
+    by the values of the sort fields (and the primary key) of the last
+    result, instead of skipping `_offset` results, so it works with any
+    `_sort` and filters.
+
+    `_total_mode` is how the total number of results is computed: `exact`
+    (the default), `estimate` (by the query planner, which is much faster on
+    large tables), or `none`. With the latter two, the pagination metadata
+    also has a `total_estimated` flag.
 
     A `voluptuous.error.Invalid` exception will be raised if any of the request
     parameters has an invalid value.
@@ -459,6 +510,15 @@ def paginate(func):
                 Range(min=0),
                 msg='`_offset` is expected to be a positive integer',
             ),
+            '_cursor': All(
+                basestring,
+                msg='`_cursor` is expected to be a string',
+            ),
+            '_total_mode': Any(
+                *TOTAL_MODES,
+                msg='`_total_mode` is expected to be one of: {0}'
+                    .format(', '.join(TOTAL_MODES))
+            ),
         },
         extra=REMOVE_EXTRA,
     )
@@ -0,0 +1,240 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""Removal of old events and logs.
+
+Old rows are removed in two ways:
+  - the daily partitions that are older than the retention period of all
+    the tenants are dropped as a whole (see storage/partitions.py)
+  - the remaining expired rows are deleted in chunks of `chunk_size` rows,
+    ordered by primary key, each chunk in its own transaction (and
+    starting after the last row of the previous chunk, so that it doesn't
+    scan the dead rows the previous chunks left behind), with a
+    pause of `chunk_delay` seconds between the chunks, so that the deletion
+    never holds locks for longer than a single chunk, and autovacuum and
+    the inserts of new events and logs can keep up
+
+Rows that are still in the parent tables (those stored before the tables
+were partitioned, or while the partition of their day was missing) are
+moved to their partitions the same way, in chunks, by every run.
+"""
+
+import logging
+from time import time, sleep
+from datetime import datetime, timedelta
+
+from manager_rest.storage.partitions import (
+    FUTURE_PARTITIONS_DAYS,
+    PARTITIONED_TABLES
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_CHUNK_DELAY = 0.1
+
+TENANTS_QUERY = 'SELECT id, name FROM tenants'
+DROP_PARTITIONS_QUERY = 'SELECT drop_partitions(%s, %s)'
+CREATE_PARTITIONS_QUERY = 'SELECT create_partitions(%s, %s)'
+# {0} is the table, and {1} a condition on its _tenant_id
+DELETE_CHUNK_QUERY = """
+    WITH deleted AS (
+        DELETE FROM {0} WHERE _storage_id IN (
+            SELECT _storage_id FROM {0}
+            WHERE reported_timestamp < %(cutoff)s
+            AND _storage_id > %(after)s
+            AND {1}
+            ORDER BY _storage_id
+            LIMIT %(chunk_size)s)
+        RETURNING _storage_id)
+    SELECT count(*), max(_storage_id) FROM deleted
+"""
+# {0} is the table. The rows are inserted back into the parent table, and
+# its trigger routes them to their partitions; rows whose day has no
+# partition are skipped
+MOVE_CHUNK_QUERY = """
+    WITH moved AS (
+        DELETE FROM ONLY {0} WHERE _storage_id IN (
+            SELECT _storage_id FROM ONLY {0}
+            WHERE _storage_id > %(after)s
+            AND to_regclass(CAST(partition_name(
+                '{0}', CAST(reported_timestamp AS date)) AS cstring))
+                IS NOT NULL
+            ORDER BY _storage_id
+            LIMIT %(chunk_size)s)
+        RETURNING *),
+    inserted AS (
+        INSERT INTO {0} SELECT * FROM moved)
+    SELECT count(*), max(_storage_id) FROM moved
+"""
+
+
+class RetentionPolicy(object):
+    """How many days the events and logs are kept, per tenant.
+
+    :param default: {table: days} for all the tenants that have no policy
+                    of their own; None days means the rows are kept forever
+    :param tenants: {tenant name: {table: days}}
+    """
+
+    def __init__(self, default, tenants=None):
+        self.default = default
+        self.tenants = tenants or {}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            default={
+                'events': config.events_retention_days,
+                'logs': config.logs_retention_days
+            },
+            tenants=config.retention_tenant_policies
+        )
+
+    def get_days(self, table, tenant_name=None):
+        policy = self.tenants.get(tenant_name, self.default)
+        return policy.get(table, self.default.get(table))
+
+    def get_max_days(self, table):
+        """The longest retention period of the table, among all tenants"""
+        days = [self.get_days(table)] + [
+            self.get_days(table, tenant) for tenant in self.tenants]
+        if None in days:
+            return None
+        return max(days)
+
+
+class RetentionEngine(object):
+    """Remove the events and logs that are older than the policy allows.
+
+    :param connect: a function that returns a new psycopg2 connection
+    :param policy: a RetentionPolicy
+    """
+
+    def __init__(self, connect, policy, chunk_size=DEFAULT_CHUNK_SIZE,
+                 chunk_delay=DEFAULT_CHUNK_DELAY):
+        self._connect = connect
+        self.policy = policy
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+
+    def run(self, now=None):
+        """Remove the expired rows of all the tables.
+
+        :return: a dict of {table: {'deleted_rows': number of rows,
+                 'dropped_partitions': number of partitions,
+                 'moved_rows': number of rows moved to partitions,
+                 'duration': seconds}}
+        """
+        now = now or datetime.utcnow()
+        conn = self._connect()
+        try:
+            tenant_ids = self._get_tenant_ids(conn)
+            report = {}
+            for table in PARTITIONED_TABLES:
+                report[table] = self._clean_table(conn, table, tenant_ids,
+                                                  now)
+                logger.info(
+                    'Removed %d rows and %d partitions of %s, and moved %d '
+                    'rows to partitions, in %.2f seconds',
+                    report[table]['deleted_rows'],
+                    report[table]['dropped_partitions'], table,
+                    report[table]['moved_rows'], report[table]['duration'])
+            return report
+        finally:
+            conn.close()
+
+    def _get_tenant_ids(self, conn):
+        """The ids of the tenants that have a policy of their own"""
+        with conn.cursor() as cur:
+            cur.execute(TENANTS_QUERY)
+            tenants = cur.fetchall()
+        conn.commit()
+        return dict((name, tenant_id) for tenant_id, name in tenants
+                    if name in self.policy.tenants)
+
+    def _clean_table(self, conn, table, tenant_ids, now):
+        start = time()
+        dropped_partitions = 0
+        max_days = self.policy.get_max_days(table)
+        if max_days is not None:
+            dropped_partitions = self._run_query(
+                conn, DROP_PARTITIONS_QUERY,
+                (table, now - timedelta(days=max_days)))
+        self._run_query(conn, CREATE_PARTITIONS_QUERY,
+                        (table, FUTURE_PARTITIONS_DAYS))
+
+        deleted_rows = 0
+        for tenant_name, tenant_id in tenant_ids.items():
+            deleted_rows += self._delete_expired(
+                conn, table, self.policy.get_days(table, tenant_name), now,
+                '_tenant_id = %(tenant_id)s', {'tenant_id': tenant_id})
+        # all the tenants without a policy of their own
+        deleted_rows += self._delete_expired(
+            conn, table, self.policy.get_days(table), now,
+            '_tenant_id <> ALL(%(tenant_ids)s)',
+            {'tenant_ids': list(tenant_ids.values())})
+        moved_rows = self._move_to_partitions(conn, table)
+        return {
+            'deleted_rows': deleted_rows,
+            'dropped_partitions': dropped_partitions,
+            'moved_rows': moved_rows,
+            'duration': time() - start
+        }
+
+    def _move_to_partitions(self, conn, table):
+        """Move the rows of the parent table to their partitions"""
+        query = MOVE_CHUNK_QUERY.format(table)
+        moved_rows = 0
+        after = 0
+        while True:
+            with conn.cursor() as cur:
+                cur.execute(query, {'after': after,
+                                    'chunk_size': self.chunk_size})
+                moved, last_id = cur.fetchone()
+            conn.commit()
+            moved_rows += moved
+            if moved < self.chunk_size:
+                return moved_rows
+            after = last_id
+            sleep(self.chunk_delay)
+
+    def _delete_expired(self, conn, table, days, now, condition, params):
+        if days is None:
+            return 0
+        query = DELETE_CHUNK_QUERY.format(table, condition)
+        params = dict(params,
+                      cutoff=now - timedelta(days=days),
+                      chunk_size=self.chunk_size)
+        deleted_rows = 0
+        after = 0
+        while True:
+            with conn.cursor() as cur:
+                cur.execute(query, dict(params, after=after))
+                deleted, last_id = cur.fetchone()
+            conn.commit()
+            deleted_rows += deleted
+            if deleted < self.chunk_size:
+                return deleted_rows
+            after = last_id
+            sleep(self.chunk_delay)
+
+    @staticmethod
+    def _run_query(conn, query, params):
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            result = cur.fetchone()[0]
+        conn.commit()
+        return result
@@ -17,5 +17,6 @@ from .file_server import FileServer                                     # NOQA
 from .models_base import db                                             # NOQA
 from .models import user_datastore                                      # NOQA
 from .storage_manager import ListResult                                 # NOQA
+from .storage_manager import StreamedResults                            # NOQA
 from .storage_manager import get_storage_manager                        # NOQA
 from .storage_utils import get_node                                     # NOQA
@@ -0,0 +1,118 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""Notifications about new events and logs.
+
+After storing every batch, amqp-postgres sends a NOTIFY on EVENTS_CHANNEL,
+with the comma-separated `_storage_id`s of the executions that have new
+events or logs. The notification is only delivered once the batch is
+committed, so once it's received, the new rows can be queried.
+
+Every listener holds a database connection, and a request, while it waits
+(with gunicorn's sync workers, a whole worker), so the number of
+concurrent listeners is limited to MAX_LISTENERS, and requests over that
+limit fail right away instead of exhausting the workers and the pool. The
+limit is for all the processes that use the database (all the gunicorn
+workers), not for each of them: every listener holds one of MAX_LISTENERS
+advisory locks while it waits.
+"""
+
+import select
+from time import time
+from contextlib import contextmanager
+
+from manager_rest import manager_exceptions
+from manager_rest.storage.models_base import db
+
+EVENTS_CHANNEL = 'cloudify_events_logs'
+
+MAX_LISTENERS = 5
+
+
+class EventsListener(object):
+    """A connection that listens on EVENTS_CHANNEL"""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def wait(self, execution_storage_id, timeout):
+        """Wait for new events or logs of the execution.
+
+        :return: True if there are new events or logs, or False if the
+                 timeout expired before that
+        """
+        execution_storage_id = str(execution_storage_id)
+        deadline = time() + timeout
+        while True:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select(
+                [self._connection], [], [], remaining)
+            if not readable:
+                return False
+            self._connection.poll()
+            notifies = self._connection.notifies[:]
+            del self._connection.notifies[:]
+            for notify in notifies:
+                if execution_storage_id in notify.payload.split(','):
+                    return True
+
+
+@contextmanager
+def listen_for_events():
+    """Listen on EVENTS_CHANNEL, using a connection from the pool.
+
+    Start listening before querying for the current events, so that no
+    notification is missed between the query and the wait.
+
+    :raises TooManyListenersError: if MAX_LISTENERS are listening already
+    """
+    pooled_connection = db.engine.raw_connection()
+    connection = pooled_connection.connection
+    try:
+        connection.autocommit = True
+        slot = _acquire_listener_slot(connection)
+        if slot is None:
+            raise manager_exceptions.TooManyListenersError(
+                'Too many clients are waiting for events (the limit is '
+                '{0}), try again later'.format(MAX_LISTENERS))
+        try:
+            with connection.cursor() as cur:
+                cur.execute('LISTEN {0}'.format(EVENTS_CHANNEL))
+            yield EventsListener(connection)
+        finally:
+            with connection.cursor() as cur:
+                cur.execute('UNLISTEN *')
+                cur.execute('SELECT pg_advisory_unlock(hashtext(%s), %s)',
+                            (EVENTS_CHANNEL, slot))
+            del connection.notifies[:]
+    finally:
+        connection.autocommit = False
+        pooled_connection.close()
+
+
+def _acquire_listener_slot(connection):
+    """Lock one of the MAX_LISTENERS listener slots, for the session.
+
+    :return: The number of the slot, or None if they're all locked
+    """
+    with connection.cursor() as cur:
+        for slot in range(MAX_LISTENERS):
+            cur.execute('SELECT pg_try_advisory_lock(hashtext(%s), %s)',
+                        (EVENTS_CHANNEL, slot))
+            if cur.fetchone()[0]:
+                return slot
+    return None
@@ -0,0 +1,170 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""Time partitioning of the events and logs tables.
+
+The manager runs on PostgreSQL 9.5, which has no declarative partitioning,
+so the tables are partitioned using inheritance: every day of
+`reported_timestamp` has its own child table (eg. `events_p20181104`),
+with a CHECK constraint on its range, so that queries filtering on
+`reported_timestamp` only scan the relevant days (constraint exclusion).
+
+Rows are inserted into the parent table, and a trigger moves them to the
+child table of their day. The child tables are created ahead of time (up
+to `FUTURE_PARTITIONS_DAYS` days from today, by the migration, and then
+periodically by amqp-postgres and by the retention job), so the trigger
+only routes the row, after checking in the catalog cache that the child
+table exists. Rows of days that have no child table yet are kept in the
+parent table, so nothing is lost if the partitions weren't created in
+time. Child tables have the same indexes (including the unique message_id
+index) and foreign keys as the parent table.
+
+All of this is implemented by the SQL functions below, which are created
+by the migration (or by `create_all`, for new databases):
+  - create_partitions(table, days): create the child tables from yesterday
+    up to `days` days from today (UTC)
+  - drop_partitions(table, cutoff): detach and drop the child tables whose
+    whole day is before `cutoff`; returns the number of dropped tables
+"""
+
+from sqlalchemy import text
+
+PARTITIONED_TABLES = ['events', 'logs']
+
+# how many days of future partitions are created in advance
+FUTURE_PARTITIONS_DAYS = 7
+
+PARTITION_FUNCTIONS = """
+CREATE OR REPLACE FUNCTION partition_name(parent text, day date)
+RETURNS text AS $$
+    SELECT parent || '_p' || to_char(day, 'YYYYMMDD');
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION partition_exists(child text)
+RETURNS boolean AS $$
+    SELECT EXISTS (
+        SELECT 1 FROM pg_class
+        WHERE relname = child
+        AND relkind = 'r'
+        AND pg_table_is_visible(oid));
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION create_partition(parent text, day date)
+RETURNS text AS $$
+DECLARE
+    child text := partition_name(parent, day);
+    fkey text;
+BEGIN
+    -- several sessions might try to create the same partition
+    PERFORM pg_advisory_xact_lock(hashtext(child));
+    IF partition_exists(child) THEN
+        RETURN child;
+    END IF;
+    EXECUTE format(
+        'CREATE TABLE %I (LIKE %I INCLUDING ALL, '
+        || 'CHECK (reported_timestamp >= %L '
+        || 'AND reported_timestamp < %L)) INHERITS (%I)',
+        child, parent, day, day + 1, parent);
+    FOR fkey IN
+        SELECT pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = parent::regclass AND contype = 'f'
+    LOOP
+        EXECUTE format('ALTER TABLE %I ADD %s', child, fkey);
+    END LOOP;
+    RETURN child;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION create_partitions(parent text, days integer)
+RETURNS void AS $$
+DECLARE
+    today date := CAST(timezone('UTC', now()) AS date);
+BEGIN
+    FOR i IN -1..days LOOP
+        PERFORM create_partition(parent, today + i);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION drop_partitions(parent text, cutoff timestamp)
+RETURNS integer AS $$
+DECLARE
+    child text;
+    dropped integer := 0;
+BEGIN
+    FOR child IN
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = parent::regclass
+        AND c.relname ~ ('^' || parent || '_p[0-9]{8}$')
+        AND to_date(right(c.relname, 8), 'YYYYMMDD') + 1 <= cutoff
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format('ALTER TABLE %I NO INHERIT %I', child, parent);
+        EXECUTE format('DROP TABLE %I', child);
+        dropped := dropped + 1;
+    END LOOP;
+    RETURN dropped;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION route_to_partition()
+RETURNS trigger AS $$
+DECLARE
+    child text := partition_name(
+        TG_TABLE_NAME, CAST(NEW.reported_timestamp AS date));
+BEGIN
+    -- to_regclass is a catalog cache lookup; an EXCEPTION block instead
+    -- would open a subtransaction for every row
+    IF to_regclass(CAST(child AS cstring)) IS NULL THEN
+        RETURN NEW;
+    END IF;
+    EXECUTE format('INSERT INTO %I SELECT ($1).* ON CONFLICT DO NOTHING',
+                   child) USING NEW;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+DROP_PARTITION_FUNCTIONS = """
+DROP FUNCTION IF EXISTS route_to_partition();
+DROP FUNCTION IF EXISTS drop_partitions(text, timestamp);
+DROP FUNCTION IF EXISTS create_partitions(text, integer);
+DROP FUNCTION IF EXISTS create_partition(text, date);
+DROP FUNCTION IF EXISTS partition_exists(text);
+DROP FUNCTION IF EXISTS partition_name(text, date);
+"""
+
+CREATE_TRIGGER = """
+CREATE TRIGGER {0}_partition_insert
+BEFORE INSERT ON {0}
+FOR EACH ROW EXECUTE PROCEDURE route_to_partition()
+"""
+
+DROP_TRIGGER = 'DROP TRIGGER IF EXISTS {0}_partition_insert ON {0}'
+
+
+def setup_partitioning(connection, table_name):
+    """Create the partitioning functions, and the insert trigger"""
+    connection.execute(text(PARTITION_FUNCTIONS))
+    connection.execute(text(CREATE_TRIGGER.format(table_name)))
+    connection.execute(
+        text('SELECT create_partitions(:table_name, :days)'),
+        table_name=table_name, days=FUTURE_PARTITIONS_DAYS)
+
+
+def on_partitioned_table_created(target, connection, **kwargs):
+    """Set up the partitioning of tables created by `create_all`"""
+    setup_partitioning(connection, target.name)
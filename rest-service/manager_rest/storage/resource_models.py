@@ -16,7 +16,8 @@
 from os import path
 from datetime import datetime
 
-from sqlalchemy import case
+from sqlalchemy import case, func, literal_column
+from sqlalchemy.event import listen
 from flask_restful import fields as flask_fields
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.declarative import declared_attr
@@ -41,6 +42,7 @@ from .models_base import (
 )
 from .resource_models_base import SQLResourceBase
 from .relationships import foreign_key, one_to_many_relationship
+from .partitions import on_partitioned_table_created
 
 
 class CreatedAtMixin(object):
@@ -269,11 +271,45 @@ class Execution(CreatedAtMixin, SQLResourceBase):
         self.deployment = deployment
 
 
+# Events and logs are searched using this text search configuration, which
+# splits the message into lowercase words, without stemming them
+TEXT_SEARCH_CONFIG = 'simple'
+
+
+def message_search_vector(column):
+    """The text search document of a message column.
+
+    This is the expression of the message search indexes, so queries
+    have to use it as-is for the indexes to be used.
+    """
+    return func.to_tsvector(
+        literal_column("'{0}'::regconfig".format(TEXT_SEARCH_CONFIG)),
+        column)
+
+
+def message_search_condition(column, text):
+    """Whether the message contains all the words of the text.
+
+    This uses the message search indexes; unlike ILIKE, it only matches
+    whole words (in any order), and not any substring.
+    """
+    return message_search_vector(column).op('@@')(
+        func.plainto_tsquery(TEXT_SEARCH_CONFIG, text))
+
+
 class Event(SQLResourceBase):
 
     """Execution events."""
 
     __tablename__ = 'events'
+    __table_args__ = (
+        db.Index('events_message_search_idx',
+                 message_search_vector(literal_column('message')),
+                 postgresql_using='gin'),
+        # rows are moved to the partitions by a trigger, so they can't be
+        # returned by the insert itself (see partitions.py)
+        {'implicit_returning': False}
+    )
 
     timestamp = db.Column(
         UTCDateTime,
@@ -290,6 +326,7 @@ class Event(SQLResourceBase):
     source_id = db.Column(db.Text)
     target_id = db.Column(db.Text)
     error_causes = db.Column(JSONString)
+    message_id = db.Column(db.Text, index=True, unique=True)
 
     _execution_fk = foreign_key(Execution._storage_id, index=True)
 
@@ -313,6 +350,14 @@ class Log(SQLResourceBase):
     """Execution logs."""
 
     __tablename__ = 'logs'
+    __table_args__ = (
+        db.Index('logs_message_search_idx',
+                 message_search_vector(literal_column('message')),
+                 postgresql_using='gin'),
+        # rows are moved to the partitions by a trigger, so they can't be
+        # returned by the insert itself (see partitions.py)
+        {'implicit_returning': False}
+    )
 
     timestamp = db.Column(
         UTCDateTime,
@@ -329,6 +374,7 @@ class Log(SQLResourceBase):
     node_id = db.Column(db.Text)
     source_id = db.Column(db.Text)
     target_id = db.Column(db.Text)
+    message_id = db.Column(db.Text, index=True, unique=True)
 
     _execution_fk = foreign_key(Execution._storage_id, index=True)
 
@@ -347,6 +393,10 @@ class Log(SQLResourceBase):
         self.execution = execution
 
 
+listen(Event.__table__, 'after_create', on_partitioned_table_created)
+listen(Log.__table__, 'after_create', on_partitioned_table_created)
+
+
 class DeploymentUpdate(CreatedAtMixin, SQLResourceBase):
     __tablename__ = 'deployment_updates'
 
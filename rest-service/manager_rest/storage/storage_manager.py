@@ -13,19 +13,33 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
-import psutil
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from dateutil.parser import parse as parse_datetime
 from flask_security import current_user
-from sqlalchemy import or_ as sql_or, func
+from sqlalchemy import (and_ as sql_and,
+                        or_ as sql_or,
+                        bindparam,
+                        false,
+                        func,
+                        type_coerce)
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext import baked
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.elements import BindParameter, Label
+from sqlalchemy.sql.expression import ClauseElement, Executable
 from flask import current_app, has_request_context
 from sqlite3 import DatabaseError as SQLiteDBError
 from sqlalchemy.orm.attributes import flag_modified
 
 from cloudify.models_states import VisibilityState
 
-from manager_rest.storage.models_base import db
+from manager_rest.storage.models_base import db, UTCDateTime
 from manager_rest import manager_exceptions, config, utils
+from manager_rest import memory_monitor
 from manager_rest.utils import all_tenants_authorization, is_administrator
 
 try:
@@ -35,8 +49,73 @@ except ImportError:
     sql_errors = (SQLAlchemyError, SQLiteDBError)
     Psycopg2DBError = None
 
+# How the total number of results of a list is computed: exactly, with a
+# count of the whole query (the default), estimated by the query planner
+# from the table statistics, or not at all
+TOTAL_EXACT = 'exact'
+TOTAL_ESTIMATE = 'estimate'
+TOTAL_NONE = 'none'
+TOTAL_MODES = (TOTAL_EXACT, TOTAL_ESTIMATE, TOTAL_NONE)
+
+# How many rows are fetched from the database at a time when the results
+# of a list are streamed
+STREAM_FETCH_SIZE = 1000
+
+# The memory that results take is only estimated (which costs a query) for
+# more than this many rows; fewer always fit
+MEMORY_ESTIMATE_MIN_ROWS = 1000
+# How many times the size of the rows in the database the results take in
+# memory, once they're loaded into (ORM) objects
+RESULTS_MEMORY_FACTOR = 5
+
+# How many query shapes (see `QueryShape`) are kept, and how many baked
+# statements: a shape has up to five (its first result, a page, a count...),
+# and each is kept along with its compiled SQL
+QUERY_SHAPES_CACHE_SIZE = 1000
+query_bakery = baked.bakery(size=QUERY_SHAPES_CACHE_SIZE * 10)
+
+# The filter values that can be bind parameters of a query shape, and how
+# a filter is part of the shape (see `get_filter_kind`)
+BINDABLE_TYPES = (basestring, bool, int, long, float, datetime)
+FILTER_VALUE = 'value'
+FILTER_LIST = 'list'
+FILTER_EMPTY_LIST = 'empty'
+FILTER_NULL = 'null'
+
+
+class QueryShapeCache(object):
+    """The most recently used query shapes"""
+
+    def __init__(self, size=QUERY_SHAPES_CACHE_SIZE):
+        self._size = size
+        self._lock = Lock()
+        self._items = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
 
 class SQLStorageManager(object):
+    query_shapes = QueryShapeCache()
+
     @staticmethod
     def _safe_commit():
         """Try to commit changes in the session. Roll back if exception raised
@@ -50,6 +129,19 @@ class SQLStorageManager(object):
                 'SQL Storage error: {0}'.format(str(e))
             )
 
+    @staticmethod
+    def _safe_flush():
+        """Try to flush changes in the session. Roll back if exception
+        raised, like `_safe_commit`
+        """
+        try:
+            db.session.flush()
+        except sql_errors as e:
+            db.session.rollback()
+            raise manager_exceptions.SQLStorageException(
+                'SQL Storage error: {0}'.format(str(e))
+            )
+
     def _get_base_query(self, model_class, include, joins):
         """Create the initial query from the model class and included columns
 
@@ -95,17 +187,20 @@ class SQLStorageManager(object):
                       model_class,
                       filters,
                       substr_filters,
-                      all_tenants):
+                      tenant_ids,
+                      creator_id):
         """Add filter clauses to the query
 
         :param query: Base SQL query
         :param filters: An optional dictionary where keys are column names to
         filter by, and values are values applicable for those columns (or lists
-        of such values)
+        of such values, or bind parameters)
+        :param tenant_ids: See `_get_tenant_ids`
+        :param creator_id: See `_get_creator_id`
         :return: An SQLAlchemy AppenderQuery object
         """
-        query = self._add_tenant_filter(query, model_class, all_tenants)
-        query = self._add_permissions_filter(query, model_class)
+        query = self._add_tenant_filter(query, model_class, tenant_ids)
+        query = self._add_permissions_filter(query, model_class, creator_id)
         query = self._add_value_filter(query, filters)
         query = self._add_substr_filter(query, substr_filters)
         return query
@@ -113,7 +208,8 @@ class SQLStorageManager(object):
     def _add_value_filter(self, query, filters):
         for column, value in filters.iteritems():
             column, value = self._update_case_insensitive(column, value)
-            if isinstance(value, (list, tuple)):
+            if isinstance(value, (list, tuple)) or \
+                    getattr(value, 'expanding', False):
                 query = query.filter(column.in_(value))
             else:
                 query = query.filter(column == value)
@@ -122,7 +218,7 @@ class SQLStorageManager(object):
     def _add_substr_filter(self, query, filters):
         for column, value in filters.iteritems():
             column, value = self._update_case_insensitive(column, value, True)
-            if isinstance(value, basestring):
+            if isinstance(value, (basestring, BindParameter)):
                 query = query.filter(column.contains(value))
             else:
                 raise manager_exceptions.BadParametersError(
@@ -144,6 +240,9 @@ class SQLStorageManager(object):
 
         # Adding a label to preserve the column name
         column = func.lower(column).label(column.key)
+        if isinstance(value, BindParameter):
+            # the value is converted when it's bound (see `_get_query_params`)
+            return column, value
         try:
             if isinstance(value, (list, tuple)):
                 value = [v.lower() for v in value]
@@ -159,18 +258,21 @@ class SQLStorageManager(object):
 
         return column, value
 
-    def _add_tenant_filter(self, query, model_class, all_tenants):
-        """Filter by the tenant ID associated with `model_class` (either
-        directly via a relationship with the tenants table, or via an
-        ancestor who has such a relationship)
+    def _get_tenant_ids(self, model_class, all_tenants):
+        """The IDs of the tenants whose resources of `model_class` can be
+        queried (either directly via a relationship with the tenants table,
+        or via an ancestor who has such a relationship)
+
+        :return: The list of tenant IDs, or None if the resources aren't
+                 filtered by tenant
         """
         # Users/Groups etc. don't have tenants
         if not model_class.is_resource:
-            return query
+            return None
 
         # not used from a request handler - no relevant user
         if not has_request_context():
-            return query
+            return None
 
         current_tenant = self.current_tenant
 
@@ -179,16 +281,22 @@ class SQLStorageManager(object):
             # If a user that is allowed to get all the tenants in the system
             # no need to filter
             if all_tenants_authorization():
-                return query
+                return None
             # Filter by all the tenants the user is allowed to list in
-            tenant_ids = [
+            return [
                 tenant.id for tenant in current_user.all_tenants
                 if utils.tenant_specific_authorization(tenant,
                                                        model_class.__name__)
                 ]
-        else:
-            # Specific tenant only
-            tenant_ids = [current_tenant.id] if current_tenant else []
+        # Specific tenant only
+        return [current_tenant.id] if current_tenant else []
+
+    def _add_tenant_filter(self, query, model_class, tenant_ids):
+        """Filter by the tenant IDs returned by `_get_tenant_ids`"""
+        if tenant_ids is None:
+            return query
+        if tenant_ids:
+            tenant_ids = bindparam('_tenant_ids', expanding=True)
 
         # Match any of the applicable tenant ids or if it's a global resource
         tenant_filter = sql_or(
@@ -197,29 +305,39 @@ class SQLStorageManager(object):
         )
         return query.filter(tenant_filter)
 
-    def _add_permissions_filter(self, query, model_class):
-        """Filter by the users present in either the `viewers` or `owners`
-        lists
+    def _get_creator_id(self, model_class):
+        """The ID of the user whose private resources of `model_class` can
+        be queried
+
+        :return: The user ID, or None if the resources aren't filtered by
+                 permissions
         """
         # not used from a request handler - no relevant user
         if not has_request_context():
-            return query
+            return None
 
         # Queries of elements that aren't resources (tenants, users, etc.),
         # shouldn't be filtered
         if not model_class.is_resource:
-            return query
+            return None
 
         # For users that are allowed to see all resources, regardless of tenant
         is_admin = is_administrator(self.current_tenant)
         if is_admin:
+            return None
+
+        return current_user.id
+
+    def _add_permissions_filter(self, query, model_class, creator_id):
+        """Filter by the user ID returned by `_get_creator_id`"""
+        if creator_id is None:
             return query
 
         # Only get resources that are public - not private (note that ~ stands
         # for NOT, in SQLA), *or* those where the current user is the creator
         user_filter = sql_or(
             model_class.visibility != VisibilityState.PRIVATE,
-            model_class.creator == current_user
+            model_class._creator_id == bindparam('_creator_id')
         )
         return query.filter(user_filter)
 
@@ -245,29 +363,6 @@ class SQLStorageManager(object):
                 column = column.remote_attr
         return joins.values()
 
-    def _get_joins_and_converted_columns(self,
-                                         model_class,
-                                         include,
-                                         filters,
-                                         substr_filters,
-                                         sort):
-        """Get a list of tables on which we need to join and the converted
-        `include`, `filters` and `sort` arguments (converted to actual SQLA
-        column/label objects instead of column names)
-        """
-        include = include or []
-        filters = filters or dict()
-        substr_filters = substr_filters or dict()
-        sort = sort or OrderedDict()
-
-        all_columns = set(include) | set(filters.keys()) | set(sort.keys())
-        joins = self._get_joins(model_class, all_columns)
-
-        include, filters, substr_filters, sort = \
-            self._get_columns_from_field_names(
-                model_class, include, filters, substr_filters, sort)
-        return include, filters, substr_filters, sort, joins
-
     def _get_query(self,
                    model_class,
                    include=None,
@@ -287,34 +382,108 @@ class SQLStorageManager(object):
         :return: A sorted and filtered query with only the relevant
         columns
         """
-        include, filters, substr_filters, sort, joins = \
-            self._get_joins_and_converted_columns(
-                model_class, include, filters, substr_filters, sort)
+        shape, params = self._get_query_shape(
+            model_class, include, filters, substr_filters, sort, all_tenants)
+        return shape.bind(db.session(), params)
+
+    def _get_query_shape(self,
+                         model_class,
+                         include=None,
+                         filters=None,
+                         substr_filters=None,
+                         sort=None,
+                         all_tenants=None):
+        """Get the shape of the query that `_get_query` returns, from
+        `query_shapes` if possible, and the values to bind to it
+
+        :return: A tuple of the `QueryShape` and a dict of its parameters
+        """
+        include = include or []
+        filters = filters or dict()
+        substr_filters = substr_filters or dict()
+        sort = sort or OrderedDict()
+        tenant_ids = self._get_tenant_ids(model_class, all_tenants)
+        creator_id = self._get_creator_id(model_class)
+
+        key = get_query_shape_key(model_class, include, filters,
+                                  substr_filters, sort, tenant_ids,
+                                  creator_id)
+        shape = self.query_shapes.get(key) if key is not None else None
+        if shape is None:
+            shape = self._build_query_shape(
+                key, model_class, include, filters, substr_filters, sort,
+                tenant_ids, creator_id)
+            if key is not None:
+                self.query_shapes.set(key, shape)
+        params = self._get_query_params(
+            shape, filters, substr_filters, tenant_ids, creator_id)
+        return shape, params
+
+    def _build_query_shape(self,
+                           key,
+                           model_class,
+                           include,
+                           filters,
+                           substr_filters,
+                           sort,
+                           tenant_ids,
+                           creator_id):
+        """Build the query, with bind parameters instead of the values of
+        the filters that can be bound (see `get_filter_kind`)
+        """
+        all_columns = set(include) | set(filters.keys()) | set(sort.keys())
+        joins = self._get_joins(model_class, all_columns)
+        columns = {
+            column_name: self._get_column(model_class, column_name)
+            for column_name in all_columns | set(substr_filters.keys())
+        }
+
+        bound_filters = {}
+        for column_name, value in filters.iteritems():
+            kind = get_filter_kind(value)
+            if kind in (FILTER_VALUE, FILTER_LIST):
+                value = bindparam(filter_param_name(column_name),
+                                  expanding=kind == FILTER_LIST)
+            bound_filters[columns[column_name]] = value
+        bound_substr_filters = {}
+        for column_name, value in substr_filters.iteritems():
+            if isinstance(value, basestring):
+                value = bindparam(substr_param_name(column_name))
+            bound_substr_filters[columns[column_name]] = value
 
-        query = self._get_base_query(model_class, include, joins)
+        query = self._get_base_query(
+            model_class, [columns[c] for c in include], joins)
         query = self._filter_query(
-            query, model_class, filters, substr_filters, all_tenants)
-        query = self._sort_query(query, model_class, sort)
-        return query
-
-    def _get_columns_from_field_names(self,
-                                      model_class,
-                                      include,
-                                      filters,
-                                      substr_filters,
-                                      sort):
-        """Go over the optional parameters (include, filters, sort), and
-        replace column names with actual SQLA column objects
-        """
-        include = [self._get_column(model_class, c) for c in include]
-        filters = {self._get_column(model_class, c): filters[c]
-                   for c in filters}
-        substr_filters = {self._get_column(model_class, c): substr_filters[c]
-                          for c in substr_filters}
-        sort = OrderedDict((self._get_column(model_class, c), sort[c])
-                           for c in sort)
-
-        return include, filters, substr_filters, sort
+            query, model_class, bound_filters, bound_substr_filters,
+            tenant_ids, creator_id)
+        query = self._sort_query(
+            query, model_class,
+            OrderedDict((columns[c], sort[c]) for c in sort))
+        return QueryShape(key, query.with_session(None), columns)
+
+    def _get_query_params(self,
+                          shape,
+                          filters,
+                          substr_filters,
+                          tenant_ids,
+                          creator_id):
+        """The values of the bind parameters of the query shape"""
+        params = {}
+        for column_name, value in filters.iteritems():
+            if get_filter_kind(value) in (FILTER_VALUE, FILTER_LIST):
+                _, value = self._update_case_insensitive(
+                    shape.columns[column_name], value)
+                params[filter_param_name(column_name)] = value
+        for column_name, value in substr_filters.iteritems():
+            if isinstance(value, basestring):
+                _, value = self._update_case_insensitive(
+                    shape.columns[column_name], value, True)
+                params[substr_param_name(column_name)] = value
+        if tenant_ids:
+            params['_tenant_ids'] = tenant_ids
+        if creator_id is not None:
+            params['_creator_id'] = creator_id
+        return params
 
     @staticmethod
     def _get_column(model_class, column_name):
@@ -334,29 +503,137 @@ class SQLStorageManager(object):
             return column.remote_attr.label(column_name)
 
     @staticmethod
-    def _paginate(query, pagination, get_all_results=False):
+    def _paginate(query, pagination, get_all_results=False, stream=False,
+                  shape=None, params=None):
         """Paginate the query by size and offset
 
         :param query: Current SQLAlchemy query object
-        :param pagination: An optional dict with size and offset keys
-        :return: A tuple with four elements:
+        :param pagination: An optional dict with size, offset and total_mode
+                           keys
+        :param get_all_results: Ignore the pagination, and return all the
+                                results
+        :param stream: With `get_all_results`, return the results as a
+                       `StreamedResults`, instead of fetching them all
+        :param shape: The `QueryShape` that the query was bound from, with
+                      `params`: the count and the results are then fetched
+                      with its compiled statements
+        :return: A tuple with two elements:
         - results: `size` items starting from `offset`
-        - the total count of items
-        - `size` [default: 0]
-        - `offset` [default: 0]
+        - the pagination metadata: the total count of items (see
+          `get_total_metadata`), `size` [default: 0] and `offset`
+          [default: 0]
         """
-
+        if get_all_results:
+            if shape is not None:
+                total = shape.count(query.session, params)
+            else:
+                total = count_results(query)
+            if stream:
+                results = StreamedResults(query, count=total)
+            else:
+                SQLStorageManager._validate_available_memory(query, total)
+                if shape is not None:
+                    results = shape.all(query.session, params)
+                else:
+                    results = query.all()
+            return results, {'size': total, 'offset': 0, 'total': total}
+
+        if pagination and pagination.get('cursor') is not None:
+            raise manager_exceptions.BadParametersError(
+                'Paginating with a cursor is not supported here')
         if pagination:
             size = pagination.get('size', config.instance.default_page_size)
             SQLStorageManager._validate_pagination(size)
             offset = pagination.get('offset', 0)
+            total_mode = pagination.get('total_mode', TOTAL_EXACT)
         else:
             size = config.instance.default_page_size
             offset = 0
+            total_mode = TOTAL_EXACT
+
+        if shape is not None and total_mode == TOTAL_EXACT:
+            total = shape.count(query.session, params)
+        else:
+            total = count_results(query, total_mode)
+        rows = size if total is None else max(0, min(size, total - offset))
+        SQLStorageManager._validate_available_memory(query, rows)
+        if shape is not None:
+            results = shape.page(query.session, params, size, offset)
+        else:
+            results = query.limit(size).offset(offset).all()
+        metadata = {'size': size, 'offset': offset}
+        metadata.update(get_total_metadata(
+            total, total_mode, size, offset, len(results)))
+        return results, metadata
+
+    @staticmethod
+    def _get_cursor_sort(model_class, sort):
+        """The sort of a query that is paginated with a cursor.
+
+        The cursor is the position of the last result of the page in this
+        order, so it has to be unique: the primary key is the last field.
+        """
+        sort = OrderedDict(sort or ())
+        mapper = model_class.__mapper__
+        for column in mapper.primary_key:
+            sort.setdefault(mapper.get_property_by_column(column).key, 'asc')
+        return sort
+
+    def _paginate_with_cursor(self, query, model_class, sort, pagination,
+                              include):
+        """Paginate the query by size and cursor (keyset pagination).
+
+        The page is the `size` results that come after the cursor, which
+        is looked up using the columns the query is sorted by, instead of
+        skipping `offset` results, so deep pages cost the same as the
+        first one.
+
+        :param query: Current SQLAlchemy query object, sorted by `sort`
+        :param sort: The sort returned by `_get_cursor_sort`
+        :param pagination: A dict with cursor, size and total_mode keys
+        :param include: Whether the query only selects some columns
+        :return: A tuple with two elements:
+        - results: `size` items after the cursor
+        - the pagination metadata: as in `_paginate`, and the cursor of the
+          next page (None if this is the last one)
+        """
+        if pagination.get('offset'):
+            raise manager_exceptions.BadParametersError(
+                '`_offset` and `_cursor` can\'t be used together')
+        size = pagination.get('size', config.instance.default_page_size)
+        self._validate_pagination(size)
+        total_mode = pagination.get('total_mode', TOTAL_EXACT)
+        total = count_results(query, total_mode)
+        self._validate_available_memory(query, size)
+
+        columns = [_unlabel(self._get_column(model_class, column_name))
+                   for column_name in sort]
+        position = decode_cursor(pagination['cursor'], columns)
+        if position is not None:
+            query = query.filter(
+                seek_condition(columns, sort.values(), position))
+        # the exact values of the last result, to build the next cursor
+        query = query.add_columns(*[
+            _cursor_column(column).label('_cursor_{0}'.format(index))
+            for index, column in enumerate(columns)
+        ])
+        rows = query.limit(size).all()
+
+        next_cursor = None
+        if rows and len(rows) == size:
+            next_cursor = encode_cursor(rows[-1][-len(columns):])
+        if include:
+            # the extra columns aren't part of the marshalled fields
+            results = rows
+        else:
+            results = [row[0] for row in rows]
 
-        total = query.order_by(None).count()  # Fastest way to count
-        results = query.limit(size).offset(offset).all()
-        return results, total, size, offset
+        # the position of a page after a cursor isn't known
+        page_length = None if pagination['cursor'] else len(results)
+        metadata = {'size': size, 'offset': 0, 'cursor': next_cursor}
+        metadata.update(get_total_metadata(
+            total, total_mode, size, 0, page_length))
+        return results, metadata
 
     @staticmethod
     def _validate_pagination(pagination_size):
@@ -394,13 +671,51 @@ class SQLStorageManager(object):
                 )
             )
 
+    def _validate_unique_resource_ids_per_tenant(self, instances):
+        """Assert that only a single resource exists with the id of each of
+        the instances, in the current tenant (as in
+        `_validate_unique_resource_id_per_tenant`).
+
+        The instances have to be flushed, but not committed: the resources
+        are counted with a single query per model, and if one of them isn't
+        unique, the transaction is rolled back.
+        """
+        instances_by_model = OrderedDict()
+        for instance in instances:
+            if instance.is_resource and instance.is_id_unique:
+                instances_by_model.setdefault(
+                    instance.__class__, []).append(instance)
+
+        for model_class, model_instances in instances_by_model.items():
+            query = (
+                self._get_unique_resource_id_query(
+                    model_class, [instance.id for instance in model_instances])
+                .with_entities(model_class.id)
+                .group_by(model_class.id)
+                .having(func.count() > 1)
+            )
+            duplicate_ids = set(resource_id for resource_id, in query)
+            if duplicate_ids:
+                instance = next(instance for instance in model_instances
+                                if instance.id in duplicate_ids)
+                db.session.rollback()
+                raise manager_exceptions.ConflictError(
+                    '{0} already exists on {1} or with global visibility'
+                    .format(instance, self.current_tenant)
+                )
+
     def _get_unique_resource_id_query(self, model_class, resource_id):
         """
         Query for all the resources with the same id of the given instance,
         if it's in the current tenant, or if it's a global resource
+
+        :param resource_id: The id, or a list of ids
         """
         query = model_class.query
-        query = query.filter(model_class.id == resource_id)
+        if isinstance(resource_id, list):
+            query = query.filter(model_class.id.in_(resource_id))
+        else:
+            query = query.filter(model_class.id == resource_id)
         tenant_id = self.current_tenant.id if self.current_tenant else ''
         unique_resource_filter = sql_or(
             model_class._tenant_id == tenant_id,
@@ -449,11 +764,9 @@ class SQLStorageManager(object):
             'Get `{0}` with ID `{1}`'.format(model_class.__name__, element_id)
         )
         filters = filters or {'id': element_id}
-        query = self._get_query(model_class, include, filters,
-                                all_tenants=all_tenants)
-        if locking:
-            query = query.with_for_update()
-        result = query.first()
+        shape, params = self._get_query_shape(model_class, include, filters,
+                                              all_tenants=all_tenants)
+        result = shape.first(db.session(), params, locking)
 
         if not result:
             raise manager_exceptions.NotFoundError(
@@ -464,19 +777,29 @@ class SQLStorageManager(object):
         return result
 
     @staticmethod
-    def _validate_available_memory():
-        """Validate minimal available memory in manager
+    def _validate_available_memory(query=None, rows=0):
+        """Validate minimal available memory in manager, before fetching
+        the results of a query.
+
+        The available memory is the latest sample of the memory monitor.
+        Besides the configured minimum, the memory that the results are
+        estimated to take also has to be available.
+
+        :param query: The query that is about to be fetched
+        :param rows: How many results it's going to fetch (at most)
         """
         min_available_memory_mb = config.instance.min_available_memory_mb
-        if min_available_memory_mb == 0:
+        if not min_available_memory_mb:
             return
-        memory_status = psutil.virtual_memory()
-        available_mb = memory_status.available / 1024 / 1024
-        if available_mb < min_available_memory_mb:
+        needed_mb = min_available_memory_mb
+        if query is not None and rows > MEMORY_ESTIMATE_MIN_ROWS:
+            needed_mb += estimate_results_mb(query, rows)
+        available_mb = memory_monitor.instance.available_mb()
+        if available_mb < needed_mb:
             raise manager_exceptions.InsufficientMemoryError(
                 'Insufficient memory in manager, '
                 'needed: {0}mb, available: {1}mb'
-                ''.format(min_available_memory_mb, available_mb))
+                ''.format(int(needed_mb), available_mb))
 
     def list(self,
              model_class,
@@ -486,7 +809,8 @@ class SQLStorageManager(object):
              sort=None,
              all_tenants=None,
              substr_filters=None,
-             get_all_results=False):
+             get_all_results=False,
+             stream=False):
         """Return a list of `model_class` results
 
         :param model_class: SQL DB table class
@@ -494,7 +818,9 @@ class SQLStorageManager(object):
         :param filters: An optional dictionary where keys are column names to
                         filter by, and values are values applicable for those
                         columns (or lists of such values)
-        :param pagination: An optional dict with size and offset keys
+        :param pagination: An optional dict with size and offset keys, or
+                           size and cursor keys (see
+                           `_paginate_with_cursor`)
         :param sort: An optional dictionary where keys are column names to
                      sort by, and values are the order (asc/desc)
         :param all_tenants: Include resources from all tenants associated
@@ -504,10 +830,13 @@ class SQLStorageManager(object):
         :param get_all_results: Get all the results without the limitation of
                                 size or pagination. Use it carefully to
                                 prevent consumption of too much memory
+        :param stream: When getting all the results, don't fetch them
+                       before returning, but as they are iterated over (see
+                       `StreamedResults`). Streamed results use a bounded
+                       amount of memory, so they aren't refused when the
+                       available memory is low.
         :return: A (possibly empty) list of `model_class` results
         """
-        self._validate_available_memory()
-
         if filters:
             msg = 'List `{0}` with filter {1}'.format(model_class.__name__,
                                                       filters)
@@ -515,17 +844,27 @@ class SQLStorageManager(object):
             msg = 'List `{0}`'.format(model_class.__name__)
 
         current_app.logger.debug(msg)
-        query = self._get_query(model_class,
-                                include,
-                                filters,
-                                substr_filters,
-                                sort,
-                                all_tenants)
-
-        results, total, size, offset = self._paginate(query,
-                                                      pagination,
-                                                      get_all_results)
-        pagination = {'total': total, 'size': size, 'offset': offset}
+        cursor = pagination.get('cursor') if pagination else None
+        if cursor is not None:
+            sort = self._get_cursor_sort(model_class, sort)
+        shape, params = self._get_query_shape(model_class,
+                                              include,
+                                              filters,
+                                              substr_filters,
+                                              sort,
+                                              all_tenants)
+        query = shape.bind(db.session(), params)
+
+        if cursor is not None:
+            results, pagination = self._paginate_with_cursor(
+                query, model_class, sort, pagination, include)
+        else:
+            results, pagination = self._paginate(query,
+                                                 pagination,
+                                                 get_all_results,
+                                                 stream,
+                                                 shape,
+                                                 params)
 
         current_app.logger.debug('Returning: {0}'.format(results))
         return ListResult(items=results, metadata={'pagination': pagination})
@@ -547,10 +886,9 @@ class SQLStorageManager(object):
             include=string_fields,
         ).with_entities(*entities).group_by(*fields)
 
-        results, total, size, offset = self._paginate(query,
-                                                      pagination,
-                                                      get_all_results)
-        pagination = {'total': total, 'size': size, 'offset': offset}
+        results, pagination = self._paginate(query,
+                                             pagination,
+                                             get_all_results)
 
         return ListResult(items=results, metadata={'pagination': pagination})
 
@@ -575,6 +913,29 @@ class SQLStorageManager(object):
         self._validate_unique_resource_id_per_tenant(instance)
         return instance
 
+    def put_many(self, instances):
+        """Create many instances, in a single transaction
+
+        As with `put`, the instances are associated with the current
+        tenant and user if necessary, and a ConflictError is raised if the
+        id of one of them isn't unique. In that case, none of them are
+        created.
+
+        :param instances: Instances of SQLModelBase classes
+        :return: The instances
+        """
+        instances = list(instances)
+        if not instances:
+            return instances
+        current_app.logger.debug('Put {0} instances'.format(len(instances)))
+        for instance in instances:
+            self._associate_users_and_tenants(instance)
+        db.session.add_all(instances)
+        self._safe_flush()
+        self._validate_unique_resource_ids_per_tenant(instances)
+        self._safe_commit()
+        return instances
+
     def delete(self, instance):
         """Delete the passed instance
         """
@@ -584,6 +945,22 @@ class SQLStorageManager(object):
         self._safe_commit()
         return instance
 
+    def delete_many(self, instances):
+        """Delete many instances, in a single transaction
+
+        :return: The deleted instances
+        """
+        instances = list(instances)
+        if not instances:
+            return instances
+        current_app.logger.debug(
+            'Delete {0} instances'.format(len(instances)))
+        for instance in instances:
+            self._load_relationships(instance)
+            db.session.delete(instance)
+        self._safe_commit()
+        return instances
+
     def update(self, instance, log=True, modified_attrs=()):
         """Add `instance` to the DB session, and attempt to commit
 
@@ -605,6 +982,25 @@ class SQLStorageManager(object):
         self._safe_commit()
         return instance
 
+    def update_many(self, instances, modified_attrs=()):
+        """Add many instances to the DB session, and commit them in a
+        single transaction
+
+        :param modified_attrs: As in `update`, for each of the instances
+        :return: The updated instances
+        """
+        instances = list(instances)
+        if not instances:
+            return instances
+        current_app.logger.debug(
+            'Update {0} instances'.format(len(instances)))
+        for instance in instances:
+            db.session.add(instance)
+            for attr in modified_attrs:
+                flag_modified(instance, attr)
+        self._safe_commit()
+        return instances
+
     def refresh(self, instance):
         """Reload the instance with fresh information from the DB
 
@@ -617,6 +1013,234 @@ class SQLStorageManager(object):
         return instance
 
 
+def get_filter_kind(value):
+    """How filtering by the value is part of a query shape.
+
+    Values, and non-empty lists of values, are bind parameters (of the
+    FILTER_VALUE and FILTER_LIST kinds); None (FILTER_NULL) and empty lists
+    (FILTER_EMPTY_LIST) are part of the SQL itself.
+
+    :return: The kind, or None if the value can't be bound (eg. a model
+             instance, when filtering by a relationship)
+    """
+    if value is None:
+        return FILTER_NULL
+    if isinstance(value, (list, tuple)):
+        if not value:
+            return FILTER_EMPTY_LIST
+        if all(isinstance(item, BINDABLE_TYPES) for item in value):
+            return FILTER_LIST
+        return None
+    if isinstance(value, BINDABLE_TYPES):
+        return FILTER_VALUE
+    return None
+
+
+def filter_param_name(column_name):
+    return 'filter_{0}'.format(column_name)
+
+
+def substr_param_name(column_name):
+    return 'substr_{0}'.format(column_name)
+
+
+def get_query_shape_key(model_class, include, filters, substr_filters, sort,
+                        tenant_ids, creator_id):
+    """The key of a query shape in the cache.
+
+    Queries of the same model, included fields, filtered and sorted fields,
+    and kinds of filters (see `get_filter_kind`) have the same shape.
+
+    :return: The key, or None if the query shape can't be cached
+    """
+    filter_kinds = tuple(sorted(
+        (column_name, get_filter_kind(value))
+        for column_name, value in filters.iteritems()))
+    if any(kind is None for _, kind in filter_kinds) or \
+            not all(isinstance(value, basestring)
+                    for value in substr_filters.itervalues()) or \
+            not all(isinstance(order, basestring)
+                    for order in sort.itervalues()):
+        return None
+    return (
+        model_class,
+        tuple(include),
+        filter_kinds,
+        tuple(sorted(substr_filters)),
+        tuple(sort.iteritems()),
+        None if tenant_ids is None else bool(tenant_ids),
+        creator_id is not None,
+    )
+
+
+def count_results(query, total_mode=TOTAL_EXACT):
+    """Count the results of the query, as requested by `total_mode`.
+
+    :param query: The (unpaginated) query
+    :param total_mode: One of TOTAL_MODES
+    :return: The total, or None if it isn't counted
+    """
+    if total_mode not in TOTAL_MODES:
+        raise manager_exceptions.BadParametersError(
+            'Unknown total mode: {0} (expected one of: {1})'
+            .format(total_mode, ', '.join(TOTAL_MODES)))
+    if total_mode == TOTAL_NONE:
+        return None
+    query = query.order_by(None)
+    if total_mode == TOTAL_ESTIMATE:
+        return estimate_count(query)
+    return query.count()  # Fastest way to count
+
+
+def get_total_metadata(total, total_mode, size, offset, page_length):
+    """The pagination metadata of the total.
+
+    If the page that was fetched isn't full, it's the last one, so even
+    if the total wasn't counted exactly, it's known.
+
+    :param total: The total, as returned by `count_results`
+    :param total_mode: The mode it was counted with
+    :param size: The requested page size
+    :param offset: The offset of the page that was fetched
+    :param page_length: The number of results in the page that was
+                        fetched, or None if its offset isn't known
+    :return: A dict with a `total` key, and for the non-exact modes, a
+             `total_estimated` key
+    """
+    if total_mode == TOTAL_EXACT:
+        return {'total': total}
+    if page_length is not None and page_length < size and \
+            (page_length > 0 or offset == 0):
+        return {'total': offset + page_length, 'total_estimated': False}
+    if total is not None and page_length is not None:
+        total = max(total, offset + page_length)
+    return {'total': total, 'total_estimated': total_mode == TOTAL_ESTIMATE}
+
+
+def _unlabel(column):
+    """The expression of a column that `_get_column` might have labeled"""
+    return column.element if isinstance(column, Label) else column
+
+
+def _cursor_column(column):
+    """The column as selected for the cursor.
+
+    UTCDateTime values are returned truncated to milliseconds, so the
+    exact value is selected instead.
+    """
+    if isinstance(column.type, UTCDateTime):
+        return type_coerce(column, db.DateTime)
+    return column
+
+
+def encode_cursor(values):
+    """An opaque cursor of the position of a result.
+
+    :param values: The values of the sort columns of the result
+    """
+    return urlsafe_b64encode(json.dumps([
+        value.isoformat() if isinstance(value, datetime) else value
+        for value in values
+    ]))
+
+
+def decode_cursor(cursor, columns):
+    """The position encoded by `encode_cursor`.
+
+    :param columns: The sort columns, to convert the values to their types
+    :return: The values of the columns, or None for an empty cursor (the
+             first page)
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(urlsafe_b64decode(str(cursor)))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError('Expected {0} values'.format(len(columns)))
+        return [
+            parse_datetime(value)
+            if value is not None and
+            isinstance(column.type, (db.DateTime, UTCDateTime))
+            else value
+            for column, value in zip(columns, values)
+        ]
+    except (TypeError, ValueError):
+        raise manager_exceptions.BadParametersError(
+            'Invalid cursor: {0}'.format(cursor))
+
+
+def seek_condition(columns, orders, position):
+    """A condition of the rows that come after `position`.
+
+    This is the comparison of the (columns) tuple to the position, in a
+    (possibly) different direction for each column, as postgres orders
+    them: NULLs come last in ascending order, and first in descending
+    order.
+
+    :param columns: The columns the query is sorted by
+    :param orders: The order (asc/desc) of each column
+    :param position: The value of each column, as returned by
+                     `decode_cursor`
+    """
+    conditions = []
+    equal = []
+    for column, order, value in zip(columns, orders, position):
+        if order == 'desc':
+            after = column.isnot(None) if value is None else column < value
+        elif value is not None:
+            after = sql_or(column > value, column.is_(None))
+        else:
+            after = None
+        if after is not None:
+            conditions.append(sql_and(*(equal + [after])))
+        equal.append(column.is_(None) if value is None else column == value)
+    if not conditions:
+        return false()
+    return sql_or(*conditions)
+
+
+class _Explain(Executable, ClauseElement):
+    """EXPLAIN of a statement, returning the plan as JSON"""
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(_Explain, 'postgresql')
+def _compile_explain(element, compiler, **kwargs):
+    return 'EXPLAIN (FORMAT JSON) {0}'.format(
+        compiler.process(element.statement, **kwargs))
+
+
+def estimate_count(query):
+    """The query planner's estimate of the number of results of the query.
+
+    This only uses the table statistics (as updated by autovacuum), so it
+    doesn't depend on the size of the tables, but it can be far off,
+    especially for queries with several filters.
+    """
+    return int(_explain(query)['Plan Rows'])
+
+
+def estimate_results_mb(query, rows):
+    """How much memory (in MB) `rows` results of the query would take.
+
+    The width of the rows is the query planner's estimate (see
+    `estimate_count`), and loading them takes RESULTS_MEMORY_FACTOR times
+    that.
+    """
+    width = int(_explain(query.order_by(None))['Plan Width'])
+    return rows * width * RESULTS_MEMORY_FACTOR / 1024.0 / 1024
+
+
+def _explain(query):
+    """The query planner's plan of the query's top node"""
+    plan = db.session.execute(_Explain(query.statement)).scalar()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
 def get_storage_manager():
     """Get the current Flask app's storage manager, create if necessary
     """
@@ -624,6 +1248,111 @@ def get_storage_manager():
                                          SQLStorageManager())
 
 
+class StreamedResults(object):
+    """All the results of a query, fetched as they are iterated over.
+
+    The rows are fetched from a server-side cursor, STREAM_FETCH_SIZE at a
+    time, so iterating over them uses the same amount of memory regardless
+    of their number. They can only be iterated over while the request's
+    session is open (eg. by a streamed response, see
+    `rest_decorators.marshal_with`).
+
+    :param count: The number of results, as counted for the pagination
+                  metadata (rows committed after it was counted aren't
+                  included in it, but may be iterated over)
+    """
+
+    def __init__(self, query, function=None, count=0):
+        self._query = query
+        self._function = function
+        self._count = count
+
+    def map(self, function):
+        """The results, converted by `function` as they are fetched"""
+        return StreamedResults(self._query, function, self._count)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        results = self._query.yield_per(STREAM_FETCH_SIZE)
+        if self._function is None:
+            return iter(results)
+        return (self._function(result) for result in results)
+
+    def __repr__(self):
+        return '<StreamedResults of {0}>'.format(
+            ', '.join(str(column['name'])
+                      for column in self._query.column_descriptions))
+
+
+class QueryShape(object):
+    """A query, without the values it's filtered by.
+
+    The values (of the filters, and the IDs of the tenants and of the
+    creator that the resources are filtered by) are bind parameters, so
+    the shape serves all the queries of the same model, included fields
+    and filtered and sorted fields. The shapes are built once, and kept in
+    `SQLStorageManager.query_shapes`; the statements that are run with a
+    shape (its first result, a page, a count...) are compiled once, and
+    kept in `query_bakery`.
+
+    :param key: The key of the shape in the cache (see
+                `get_query_shape_key`), or None if the query can't be
+                cached: it then contains the values that can't be bound,
+                and isn't baked
+    :param query: The query, without a session
+    :param columns: {field name: SQLA column/label} of the fields that the
+                    query includes, and filters and sorts by
+    """
+
+    def __init__(self, key, query, columns):
+        self.key = key
+        self.query = query
+        self.columns = columns
+
+    def bind(self, session, params):
+        """The query, with the values of its parameters"""
+        return self.query.with_session(session).params(params)
+
+    def first(self, session, params, locking=False):
+        if self.key is None:
+            query = self.bind(session, params)
+            if locking:
+                query = query.with_for_update()
+            return query.first()
+        baked_query = self._bake()
+        if locking:
+            baked_query += lambda q: q.with_for_update()
+        return baked_query(session).params(params).first()
+
+    def all(self, session, params):
+        if self.key is None:
+            return self.bind(session, params).all()
+        return self._bake()(session).params(params).all()
+
+    def count(self, session, params):
+        if self.key is None:
+            return self.bind(session, params).order_by(None).count()
+        baked_query = self._bake()
+        baked_query += lambda q: q.order_by(None)
+        return baked_query(session).params(params).count()
+
+    def page(self, session, params, size, offset):
+        if self.key is None:
+            return self.bind(session, params).limit(size).offset(offset).all()
+        baked_query = self._bake()
+        baked_query += lambda q: q.limit(bindparam('_size')) \
+            .offset(bindparam('_offset'))
+        return baked_query(session).params(
+            params, _size=size, _offset=offset).all()
+
+    def _bake(self):
+        query = self.query
+        return query_bakery(lambda session: query.with_session(session),
+                            self.key)
+
+
 class ListResult(object):
     """
     a ListResult contains results about the requested items.
@@ -12,8 +12,10 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
+import re
 from collections import namedtuple
 from copy import deepcopy
+from datetime import datetime, timedelta
 from random import choice
 from unittest import TestCase
 
@@ -499,6 +501,54 @@ class SelectEventsFilterTest(SelectEventsBaseTest):
         """Filter events by message.text."""
         self.filter_by_message_helper('message.text')
 
+    def test_filter_by_message_search(self):
+        """Search events by the words of their message."""
+        word = self.fake.word()
+        filters = {
+            'message_search': [word.upper()],
+            'type': ['cloudify_event', 'cloudify_log']
+        }
+
+        query, event_count = EventsV1._build_select_query(
+            filters,
+            self.DEFAULT_SORT,
+            self.DEFAULT_RANGE_FILTERS,
+            self.tenant.id
+        )
+        events = query.params(**self.DEFAULT_PAGINATION).all()
+        event_ids = [event.id for event in events]
+
+        # only whole words match, regardless of their case
+        expected_events = [
+            event
+            for event in self.events
+            if word.lower() in re.findall(r'\w+', event.message.lower())
+        ]
+        expected_event_ids = [event.id for event in expected_events]
+        self.assertListEqual(event_ids, expected_event_ids)
+        self.assertEqual(event_count, len(expected_events))
+
+    def test_message_search_uses_index(self):
+        """Searching by message doesn't need to scan the whole tables."""
+        filters = {'message_search': ['<word>']}
+        query, _ = EventsV1._build_select_query(
+            filters,
+            self.DEFAULT_SORT,
+            self.DEFAULT_RANGE_FILTERS,
+            self.tenant.id
+        )
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+        params = dict(compiled.params, **self.DEFAULT_PAGINATION)
+        connection = db.session.connection()
+        connection.execute('SET LOCAL enable_seqscan = off')
+        plan = connection.execute('EXPLAIN ' + str(compiled), params)
+        plan = '\n'.join(line for line, in plan.fetchall())
+        db.session.rollback()
+        # the events and logs are in the partitions, which have copies of
+        # the indexes of the parent tables
+        self.assertIn('to_tsvector', plan)
+        self.assertNotRegexpMatches(plan, r'Seq Scan on (events|logs)')
+
     def test_filter_by_unknown(self):
         """Filter events by an unknown field."""
         filters = {
@@ -668,6 +718,144 @@ class SelectEventsSortTest(SelectEventsBaseTest):
         """
         self._sort_by_timestamp('@timestamp', 'desc')
 
+    def test_paginate_sorted(self):
+        """Every page is limited in each of the events and logs subqueries.
+
+        Going through all the pages returns all the events and logs, in
+        order.
+
+        """
+        sort = {'timestamp': 'desc'}
+        query, _ = EventsV1._build_select_query(
+            self.DEFAULT_FILTERS,
+            sort,
+            self.DEFAULT_RANGE_FILTERS,
+            self.tenant.id
+        )
+        self.assertEqual(str(query).count('LIMIT'), 3)
+
+        size = 7
+        event_timestamps = []
+        for offset in range(0, len(self.events), size):
+            events = query.params(limit=size, offset=offset).all()
+            self.assertLessEqual(len(events), size)
+            event_timestamps.extend(event.timestamp for event in events)
+
+        expected_event_timestamps = sorted(
+            (event.timestamp for event in self.events),
+            reverse=True,
+        )
+        self.assertListEqual(event_timestamps, expected_event_timestamps)
+
+    def test_single_type_without_union(self):
+        """When only events are selected, they aren't unioned with logs."""
+        query, _ = EventsV1._build_select_query(
+            {'type': ['cloudify_event']},
+            {'timestamp': 'asc'},
+            self.DEFAULT_RANGE_FILTERS,
+            self.tenant.id
+        )
+        self.assertNotIn('UNION', str(query))
+        self.assertNotIn('logs', str(query))
+
+
+@attr(client_min_version=1, client_max_version=1)
+class SelectEventsTotalTest(SelectEventsBaseTest):
+
+    """Count the events exactly, approximately, or not at all."""
+
+    DEFAULT_FILTERS = {
+        'type': ['cloudify_event', 'cloudify_log']
+    }
+
+    def _get_total(self, total_mode):
+        _, total = EventsV1._build_select_query(
+            self.DEFAULT_FILTERS, {}, {}, self.tenant.id,
+            total_mode=total_mode)
+        return total
+
+    def test_exact(self):
+        self.assertEqual(self._get_total('exact'), len(self.events))
+
+    def test_estimate(self):
+        db.session.execute('ANALYZE events')
+        db.session.execute('ANALYZE logs')
+        total = self._get_total('estimate')
+        self.assertIsInstance(total, int)
+        self.assertGreater(total, 0)
+
+    def test_none(self):
+        self.assertIsNone(self._get_total('none'))
+
+    def test_unknown(self):
+        with self.assertRaises(BadParametersError):
+            self._get_total('approximately')
+
+
+@attr(client_min_version=1, client_max_version=1)
+class SelectEventsCursorTest(SelectEventsBaseTest):
+
+    """Paginate events with a cursor."""
+
+    DEFAULT_FILTERS = {
+        'type': ['cloudify_event', 'cloudify_log']
+    }
+    PAGE_SIZE = 7
+
+    def setUp(self):
+        super(SelectEventsCursorTest, self).setUp()
+        # events and logs with the same timestamp are ordered by type and id
+        timestamp = self.events[0].timestamp
+        for event in self.events[:10]:
+            event.timestamp = timestamp
+        db.session.commit()
+
+    def _get_pages(self, sort):
+        pages = []
+        cursor = ''
+        while cursor is not None:
+            query, total = EventsV1._build_select_query(
+                self.DEFAULT_FILTERS, sort, {}, self.tenant.id, cursor)
+            events = query.params(limit=self.PAGE_SIZE).all()
+            self.assertEqual(total, len(self.events))
+            pages.append(events)
+            cursor = None
+            if len(events) == self.PAGE_SIZE:
+                cursor = EventsV1._encode_cursor(events[-1])
+        return pages
+
+    def _paginate(self, direction):
+        pages = self._get_pages({'@timestamp': direction})
+        self.assertTrue(all(len(page) <= self.PAGE_SIZE for page in pages))
+
+        def key(event):
+            return event.timestamp, type(event).__name__, event._storage_id
+
+        expected = sorted(self.events, key=key, reverse=direction == 'desc')
+        self.assertEqual(
+            [(event.type, event._storage_id)
+             for page in pages for event in page],
+            [('cloudify_{0}'.format(type(event).__name__.lower()),
+              event._storage_id)
+             for event in expected])
+
+    def test_paginate_ascending(self):
+        self._paginate('asc')
+
+    def test_paginate_descending(self):
+        self._paginate('desc')
+
+    def test_sort_by_other_field(self):
+        with self.assertRaises(BadParametersError):
+            EventsV1._build_select_query(
+                self.DEFAULT_FILTERS, {'event_type': 'asc'}, {},
+                self.tenant.id, '')
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(BadParametersError):
+            EventsV1._build_select_query(
+                self.DEFAULT_FILTERS, {}, {}, self.tenant.id, 'abc')
+
 
 @attr(client_min_version=1, client_max_version=1)
 class SelectEventsRangeFilterTest(SelectEventsBaseTest):
@@ -793,6 +981,86 @@ class SelectEventTenantTest(SelectEventsBaseTest):
         self.assertEqual(event_count, 0)
 
 
+@attr(client_min_version=1, client_max_version=1)
+class SelectEventsPartitionsTest(SelectEventsBaseTest):
+
+    """Events and logs are stored in daily partitions."""
+
+    def setUp(self):
+        super(SelectEventsPartitionsTest, self).setUp()
+        for table in ['events', 'logs']:
+            db.session.execute('SELECT create_partitions(:table, 7)',
+                               {'table': table})
+        db.session.commit()
+        self.today = datetime.utcnow().replace(
+            hour=0, minute=0, second=0, microsecond=0)
+
+    def _add_event(self, reported_timestamp):
+        execution = choice(self.executions)
+        event = Event(
+            id='event_{}'.format(self.fake.uuid4()),
+            timestamp=datetime.utcnow(),
+            reported_timestamp=reported_timestamp,
+            _execution_fk=execution._storage_id,
+            _tenant_id=execution._tenant_id,
+            _creator_id=execution._creator_id,
+            event_type=choice(self.EVENT_TYPES),
+            message=self.fake.sentence(),
+        )
+        db.session.add(event)
+        db.session.commit()
+        return event
+
+    def _get_table(self, event):
+        return db.session.execute(
+            'SELECT CAST(tableoid AS regclass) FROM events WHERE id = :id',
+            {'id': event.id}).scalar()
+
+    def test_rows_are_moved_to_partitions(self):
+        event = self._add_event(self.today + timedelta(hours=1))
+        self.assertEqual(self._get_table(event),
+                         self.today.strftime('events_p%Y%m%d'))
+        self.assertEqual(db.session.query(Event).get(event._storage_id).id,
+                         event.id)
+
+    def test_rows_without_partition(self):
+        """Rows of days that have no partition stay in the parent table"""
+        event = self._add_event(self.today - timedelta(days=30))
+        self.assertEqual(self._get_table(event), 'events')
+
+    def test_partition_pruning(self):
+        range_filters = {'reported_timestamp': {
+            'from': self.today + timedelta(hours=1),
+            'to': self.today + timedelta(hours=2)
+        }}
+        query, _ = EventsV1._build_select_query(
+            {'type': ['cloudify_event']}, {'timestamp': 'asc'},
+            range_filters, self.tenant.id)
+        statement = query.statement.compile(dialect=db.engine.dialect)
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute('EXPLAIN {0}'.format(statement),
+                       dict(statement.params, limit=100, offset=0))
+        plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertIn(self.today.strftime('events_p%Y%m%d'), plan)
+        self.assertNotIn((self.today + timedelta(days=1)).strftime(
+            'events_p%Y%m%d'), plan)
+
+    def test_drop_partitions(self):
+        kept = self._add_event(self.today + timedelta(days=1, hours=1))
+        dropped = self._add_event(self.today + timedelta(hours=1))
+        dropped_count = db.session.execute(
+            'SELECT drop_partitions(:table, :cutoff)',
+            {'table': 'events', 'cutoff': self.today + timedelta(days=1)}
+        ).scalar()
+        db.session.commit()
+
+        # at least yesterday's and today's partitions
+        self.assertGreaterEqual(dropped_count, 2)
+        event_ids = [event.id for event in db.session.query(Event)]
+        self.assertIn(kept.id, event_ids)
+        self.assertNotIn(dropped.id, event_ids)
+
+
 @attr(client_min_version=1, client_max_version=1)
 class BuildSelectQueryTest(TestCase):
 
@@ -0,0 +1,86 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import json
+
+from mock import patch
+
+from manager_rest.manager_exceptions import BadParametersError
+from manager_rest.rest.resources_v3_1 import EventsExport
+from manager_rest.storage.resource_models import Log
+from manager_rest.test.attribute import attr
+from manager_rest.test.endpoints.test_events import SelectEventsBaseTest
+
+
+@attr(client_min_version=3.1, client_max_version=3.1)
+class EventsExportTest(SelectEventsBaseTest):
+
+    """All the matching events are streamed, one per line."""
+
+    SORT = {'timestamp': 'asc'}
+
+    def _export(self, filters, _include=None, range_filters=None):
+        export = EventsExport()
+        query = export._build_export_query(
+            filters, self.SORT, range_filters or {}, self.tenant.id,
+            export._get_select_columns(_include, self.SORT))
+        lines = list(export._export_lines(query, _include))
+        for line in lines:
+            self.assertTrue(line.endswith('\n'))
+        return [json.loads(line) for line in lines]
+
+    def test_export_all(self):
+        # fetch a few rows at a time, to go through several fetches
+        with patch('manager_rest.rest.resources_v3_1.events.'
+                   'EXPORT_FETCH_SIZE', 3):
+            events = self._export({})
+        self.assertEqual(len(events), len(self.events))
+        self.assertEqual(
+            [event['timestamp'] for event in events],
+            sorted(event.timestamp for event in self.events))
+
+    def test_filters(self):
+        execution = self.executions[0]
+        events = self._export({
+            'type': ['cloudify_log'],
+            'execution_id': [execution.id]
+        })
+        expected = [
+            event for event in self.events
+            if isinstance(event, Log) and
+            event._execution_fk == execution._storage_id
+        ]
+        self.assertEqual(len(events), len(expected))
+        for event in events:
+            self.assertEqual(event['type'], 'cloudify_log')
+            self.assertEqual(event['execution_id'], execution.id)
+
+    def test_include(self):
+        events = self._export({}, _include=['timestamp', 'message'])
+        self.assertEqual(len(events), len(self.events))
+        for event in events:
+            self.assertEqual(set(event), {'timestamp', 'message'})
+
+    def test_no_matching_type(self):
+        events = self._export({
+            'type': ['cloudify_event'],
+            'level': ['INFO']
+        })
+        self.assertEqual(events, [])
+
+    def test_invalid_filter(self):
+        with self.assertRaises(BadParametersError):
+            EventsExport()._build_export_query(
+                {'unknown': ['<value>']}, self.SORT, {}, self.tenant.id)
@@ -0,0 +1,157 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+from datetime import datetime
+from threading import Timer
+
+from mock import patch
+
+from manager_rest import manager_exceptions
+from manager_rest.rest.resources_v3_1 import EventsStream
+from manager_rest.storage import db, notifications
+from manager_rest.storage.notifications import (
+    EVENTS_CHANNEL,
+    listen_for_events
+)
+from manager_rest.storage.resource_models import Event, Log
+from manager_rest.test.attribute import attr
+from manager_rest.test.endpoints.test_events import SelectEventsBaseTest
+
+
+@attr(client_min_version=3.1, client_max_version=3.1)
+class EventsStreamTest(SelectEventsBaseTest):
+
+    """New events of an execution are returned after a cursor."""
+
+    def setUp(self):
+        super(EventsStreamTest, self).setUp()
+        patcher = patch.object(EventsStream, 'current_tenant',
+                               new=self.tenant)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.execution = self.executions[0]
+
+    def _notify(self, payload):
+        conn = db.engine.raw_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_notify(%s, %s)',
+                            (EVENTS_CHANNEL, payload))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def test_cursor(self):
+        cursor = {'events': 0, 'logs': 0}
+        stream = EventsStream()
+        items = stream._get_new_events(
+            self.execution._storage_id, cursor, 1000)
+        expected = [event for event in self.events
+                    if event._execution_fk == self.execution._storage_id]
+        self.assertEqual(len(items), len(expected))
+        self.assertTrue(all(item['execution_id'] == self.execution.id
+                            for item in items))
+        self.assertEqual(stream._get_new_events(
+            self.execution._storage_id, cursor, 1000), [])
+
+        log = Log(
+            id='new_log',
+            timestamp=datetime.utcnow(),
+            reported_timestamp=datetime.utcnow(),
+            _execution_fk=self.execution._storage_id,
+            _tenant_id=self.execution._tenant_id,
+            _creator_id=self.execution._creator_id,
+            logger='<logger>',
+            level='INFO',
+            message='new log',
+        )
+        db.session.add(log)
+        db.session.commit()
+        items = stream._get_new_events(
+            self.execution._storage_id, cursor, 1000)
+        self.assertEqual([item['message'] for item in items], ['new log'])
+        self.assertEqual(cursor['logs'], log._storage_id)
+
+    def test_uncommitted_rows_are_not_skipped(self):
+        cursor = {'events': 0, 'logs': 0}
+        stream = EventsStream()
+        stream._get_new_events(self.execution._storage_id, cursor, 1000)
+
+        # another writer draws a storage ID, but commits after a later row
+        conn = db.engine.raw_connection()
+        self.addCleanup(conn.close)
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO logs (id, timestamp, reported_timestamp,
+                                  _execution_fk, _tenant_id, _creator_id,
+                                  visibility, logger, level, message)
+                VALUES ('slow_log', now(), now(), %s, %s, %s, 'tenant',
+                        '<logger>', 'INFO', 'slow log')
+            """, (self.execution._storage_id, self.execution._tenant_id,
+                  self.execution._creator_id))
+        db.session.add(Log(
+            id='fast_log',
+            timestamp=datetime.utcnow(),
+            reported_timestamp=datetime.utcnow(),
+            _execution_fk=self.execution._storage_id,
+            _tenant_id=self.execution._tenant_id,
+            _creator_id=self.execution._creator_id,
+            logger='<logger>',
+            level='INFO',
+            message='fast log',
+        ))
+        db.session.commit()
+        self.assertEqual(stream._get_new_events(
+            self.execution._storage_id, cursor, 1000), [])
+
+        conn.commit()
+        items = stream._get_new_events(
+            self.execution._storage_id, cursor, 1000)
+        self.assertEqual(sorted(item['message'] for item in items),
+                         ['fast log', 'slow log'])
+
+    def test_size(self):
+        cursor = {'events': 0, 'logs': 0}
+        items = EventsStream()._get_new_events(
+            self.execution._storage_id, cursor, 1)
+        self.assertLessEqual(len(items), 2)
+        for model, key in [(Event, 'events'), (Log, 'logs')]:
+            first = db.session.query(model).filter(
+                model._execution_fk == self.execution._storage_id
+            ).order_by(model._storage_id).first()
+            self.assertEqual(cursor[key], first._storage_id if first else 0)
+
+    def test_wait_for_notification(self):
+        with listen_for_events() as listener:
+            Timer(0.2, self._notify, ['12345,{0}'.format(
+                self.execution._storage_id)]).start()
+            self.assertTrue(listener.wait(self.execution._storage_id, 5))
+
+    def test_wait_timeout(self):
+        with listen_for_events() as listener:
+            Timer(0.1, self._notify, ['12345']).start()
+            self.assertFalse(listener.wait(self.execution._storage_id, 0.5))
+
+    def test_too_many_listeners(self):
+        # the slots are shared by all the processes that use the database
+        with patch.object(notifications, 'MAX_LISTENERS', 1):
+            with listen_for_events():
+                with self.assertRaises(
+                        manager_exceptions.TooManyListenersError):
+                    with listen_for_events():
+                        pass
+            # the slot is released when the listener is done
+            with listen_for_events():
+                pass
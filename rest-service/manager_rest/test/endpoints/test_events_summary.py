@@ -0,0 +1,170 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+from collections import Counter
+from unittest import TestCase
+
+from mock import patch
+
+from cloudify.models_states import ExecutionState
+
+from manager_rest.rest.resources_v3_1 import SummarizeEvents
+from manager_rest.rest.resources_v3_1.events import SummaryCache
+from manager_rest.storage import db
+from manager_rest.storage.management_models import Tenant
+from manager_rest.storage.resource_models import Event, Log
+from manager_rest.storage.storage_manager import SQLStorageManager
+from manager_rest.test.attribute import attr
+from manager_rest.test.endpoints.test_events import SelectEventsBaseTest
+
+
+@attr(client_min_version=3.1, client_max_version=3.1)
+class SummarizeEventsTest(SelectEventsBaseTest):
+
+    """Events are counted in SQL, and summaries of ended executions are
+    cached."""
+
+    def setUp(self):
+        super(SummarizeEventsTest, self).setUp()
+        patcher = patch.object(SummarizeEvents, 'cache', SummaryCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.execution = self.executions[0]
+        self.filters = {'execution_id': [self.execution.id]}
+
+    def _execution_events(self):
+        return [event for event in self.events
+                if event._execution_fk == self.execution._storage_id]
+
+    def _set_status(self, status):
+        self.execution.status = status
+        db.session.commit()
+
+    def test_by_type(self):
+        items = SummarizeEvents()._summarize(
+            self.filters, {}, self.tenant.id, ['type'], 'minute')
+        expected = Counter(
+            'cloudify_event' if isinstance(event, Event) else 'cloudify_log'
+            for event in self._execution_events())
+        self.assertEqual(dict(items), dict(expected))
+
+    def test_by_level(self):
+        items = SummarizeEvents()._summarize(
+            dict(self.filters, type=['cloudify_log']), {}, self.tenant.id,
+            ['level'], 'minute')
+        expected = Counter(event.level for event in self._execution_events()
+                           if isinstance(event, Log))
+        self.assertEqual(dict(items), dict(expected))
+
+    def test_by_timestamp_and_type(self):
+        items = SummarizeEvents()._summarize(
+            self.filters, {}, self.tenant.id, ['timestamp', 'type'], 'day')
+        self.assertEqual(sum(count for _, _, count in items),
+                         len(self._execution_events()))
+        days = [day for day, _, _ in items]
+        self.assertEqual(days, sorted(days))
+        for day in days:
+            self.assertTrue(day.endswith('T00:00:00'))
+
+    def test_cached_when_ended(self):
+        self._set_status(ExecutionState.TERMINATED)
+        summarize = SummarizeEvents()
+        items = summarize._get_summary(
+            self.filters, {}, self.tenant.id, ['type'], 'minute')
+        with patch.object(summarize, '_summarize') as mock_summarize:
+            self.assertEqual(summarize._get_summary(
+                self.filters, {}, self.tenant.id, ['type'], 'minute'), items)
+            self.assertFalse(mock_summarize.called)
+
+    def test_cache_missed_after_late_write(self):
+        self._set_status(ExecutionState.TERMINATED)
+        summarize = SummarizeEvents()
+        items = dict(summarize._get_summary(
+            self.filters, {}, self.tenant.id, ['type'], 'minute'))
+        # eg. replayed from the spool of amqp-postgres
+        db.session.add(Log(
+            id='log_late',
+            timestamp=self.fake.date_time(),
+            reported_timestamp=self.fake.date_time(),
+            _execution_fk=self.execution._storage_id,
+            _tenant_id=self.execution._tenant_id,
+            _creator_id=self.execution._creator_id,
+            logger='<logger>',
+            level='info',
+            message='Late log',
+        ))
+        db.session.commit()
+        late_items = dict(summarize._get_summary(
+            self.filters, {}, self.tenant.id, ['type'], 'minute'))
+        self.assertEqual(late_items['cloudify_log'],
+                         items.get('cloudify_log', 0) + 1)
+
+    def test_not_cached_when_running(self):
+        self._set_status(ExecutionState.STARTED)
+        summarize = SummarizeEvents()
+        summarize._get_summary(
+            self.filters, {}, self.tenant.id, ['type'], 'minute')
+        with patch.object(summarize, '_summarize',
+                          return_value=[]) as mock_summarize:
+            summarize._get_summary(
+                self.filters, {}, self.tenant.id, ['type'], 'minute')
+            self.assertEqual(mock_summarize.call_count, 1)
+
+    def test_not_cached_by_deployment(self):
+        self._set_status(ExecutionState.TERMINATED)
+        self.assertIsNone(SummarizeEvents._ended_executions(
+            {'deployment_id': ['<deployment>']}))
+        self.assertIsNone(SummarizeEvents._ended_executions(
+            {'execution_id': [self.execution.id, '<unknown>']}))
+        self.assertEqual(SummarizeEvents._ended_executions(self.filters),
+                         [self.execution._storage_id])
+
+    def test_not_cached_for_other_tenants(self):
+        self._set_status(ExecutionState.TERMINATED)
+        other_tenant = Tenant(name='other_tenant')
+        db.session.add(other_tenant)
+        db.session.commit()
+        for tenant, ended in [(self.tenant, True), (other_tenant, False)]:
+            with patch('manager_rest.storage.storage_manager.'
+                       'has_request_context', return_value=True), \
+                    patch('manager_rest.storage.storage_manager.'
+                          'is_administrator', return_value=True), \
+                    patch.object(SQLStorageManager, 'current_tenant',
+                                 new=tenant):
+                ended_executions = \
+                    SummarizeEvents._ended_executions(self.filters)
+                self.assertEqual(ended_executions is not None, ended)
+
+
+class SummaryCacheTest(TestCase):
+
+    def test_least_recently_used_is_evicted(self):
+        cache = SummaryCache(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expired(self):
+        cache = SummaryCache(ttl=10)
+        with patch('manager_rest.rest.resources_v3_1.events.time',
+                   return_value=100):
+            cache.set('a', 1)
+        with patch('manager_rest.rest.resources_v3_1.events.time',
+                   return_value=111):
+            self.assertIsNone(cache.get('a'))
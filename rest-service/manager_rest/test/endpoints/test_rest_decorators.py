@@ -70,6 +70,19 @@ class PaginateTest(TestCase):
                 with self.assertRaises(Invalid):
                     paginate(verify)()
 
+    def test_total_mode(self):
+        """Only the known total modes are accepted."""
+        def verify(pagination):
+            self.assertEqual(pagination['total_mode'], 'estimate')
+            return Mock()
+
+        with patch('manager_rest.rest.rest_decorators.request') as request:
+            request.args = {'_total_mode': 'estimate'}
+            paginate(verify)()
+            request.args = {'_total_mode': 'approximately'}
+            with self.assertRaises(Invalid):
+                paginate(verify)()
+
 
 @attr(client_min_version=2, client_max_version=base_test.LATEST_API_VERSION)
 class RangeableTest(TestCase):
@@ -13,11 +13,14 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 
+from mock import patch
+from sqlalchemy.orm import Query
+
 from cloudify.models_states import VisibilityState
 
-from manager_rest import utils
+from manager_rest import manager_exceptions, utils
 from manager_rest.test import base_test
-from manager_rest.storage import models
+from manager_rest.storage import models, storage_manager
 from manager_rest.test.attribute import attr
 
 
@@ -211,4 +214,110 @@ class StorageManagerTests(base_test.BaseServerTestCase):
             include=['id', 'created_at'],
             get_all_results=True
         )
-        self.assertEquals(1000, len(secret_list))
+        # not limited to the default page size
+        self.assertEquals(1001, len(secret_list))
+
+    def _put_blueprints(self, count):
+        now = utils.get_formatted_timestamp()
+        for i in range(count):
+            self.sm.put(models.Blueprint(id='blueprint-{0}'.format(i),
+                                         created_at=now,
+                                         plan={'name': 'my-bp'},
+                                         main_file_name='aaa'))
+
+    def test_query_shapes(self):
+        self._put_blueprints(3)
+        self.sm.query_shapes.clear()
+        for blueprint_ids in [['blueprint-0'], ['blueprint-1', 'blueprint-2']]:
+            blueprints = self.sm.list(models.Blueprint,
+                                      filters={'id': blueprint_ids})
+            self.assertEqual(sorted(b.id for b in blueprints),
+                             blueprint_ids)
+        # both lists have the same shape
+        self.assertEqual(len(self.sm.query_shapes), 1)
+
+        blueprints = self.sm.list(models.Blueprint,
+                                  filters={'id': 'blueprint-1'})
+        self.assertEqual([b.id for b in blueprints], ['blueprint-1'])
+        blueprints = self.sm.list(models.Blueprint, filters={'id': []})
+        self.assertEqual(len(blueprints), 0)
+        self.assertEqual(len(self.sm.query_shapes), 3)
+
+    def test_query_shapes_compiled_once(self):
+        """Queries of a cached shape are only compiled the first time,
+        while queries without a shape key are compiled on every call
+        """
+        self._put_blueprints(10)
+
+        def list_and_get(index):
+            self.sm.list(models.Blueprint,
+                         filters={'id': ['blueprint-{0}'.format(index),
+                                         'blueprint-{0}'.format(index + 1)]},
+                         sort={'id': 'asc'},
+                         pagination={'size': 5})
+            self.sm.get(models.Blueprint, 'blueprint-{0}'.format(index))
+
+        def count_compiles(calls):
+            with patch.object(Query, '_compile_context', autospec=True,
+                              side_effect=Query._compile_context) as compiles:
+                for index in range(calls):
+                    list_and_get(index)
+            return compiles.call_count
+
+        list_and_get(0)
+        self.assertEqual(count_compiles(5), 0)
+        # a shape without a key isn't cached
+        with patch.object(storage_manager, 'get_query_shape_key',
+                          return_value=None):
+            self.assertGreaterEqual(count_compiles(5), 5)
+
+    def _blueprint(self, blueprint_id, **kwargs):
+        now = utils.get_formatted_timestamp()
+        return models.Blueprint(id=blueprint_id,
+                                created_at=now,
+                                plan={'name': 'my-bp'},
+                                main_file_name='aaa',
+                                **kwargs)
+
+    def test_put_many(self):
+        blueprints = self.sm.put_many([
+            self._blueprint('blueprint-1'),
+            self._blueprint('blueprint-2',
+                            visibility=VisibilityState.GLOBAL)
+        ])
+        self.assertEqual(len(blueprints), 2)
+        for blueprint in self.sm.list(models.Blueprint):
+            self.assertEqual(blueprint.tenant, self.sm.current_tenant)
+            self.assertEqual(blueprint.creator.username,
+                             blueprints[0].creator.username)
+        self.assertEqual(
+            self.sm.get(models.Blueprint, 'blueprint-2').visibility,
+            VisibilityState.GLOBAL)
+
+    def test_put_many_conflict(self):
+        self.sm.put(self._blueprint('blueprint-1'))
+        for blueprint_ids in [['blueprint-2', 'blueprint-1'],
+                              ['blueprint-3', 'blueprint-3']]:
+            self.assertRaises(
+                manager_exceptions.ConflictError,
+                self.sm.put_many,
+                [self._blueprint(blueprint_id)
+                 for blueprint_id in blueprint_ids])
+        # none of the conflicting blueprints were stored
+        self.assertEqual([b.id for b in self.sm.list(models.Blueprint)],
+                         ['blueprint-1'])
+
+    def test_update_and_delete_many(self):
+        self._put_blueprints(3)
+        blueprints = self.sm.list(models.Blueprint).items
+        for blueprint in blueprints:
+            blueprint.description = 'updated'
+        self.sm.update_many(blueprints)
+        self.assertEqual(
+            set(b.description for b in self.sm.list(models.Blueprint)),
+            {'updated'})
+
+        deleted = self.sm.delete_many(blueprints[:2])
+        self.assertEqual(len(deleted), 2)
+        self.assertEqual([b.id for b in self.sm.list(models.Blueprint)],
+                         [blueprints[2].id])
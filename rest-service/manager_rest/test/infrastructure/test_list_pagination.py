@@ -13,6 +13,13 @@
 #  * See the License for the specific language governing permissions and
 #  * limitations under the License.
 #
+import json
+from unittest import TestCase
+
+from mock import Mock, patch
+
+from manager_rest import config, manager_exceptions, memory_monitor
+from manager_rest.storage import StreamedResults, models, storage_manager
 from manager_rest.test.attribute import attr
 
 from manager_rest.test import base_test
@@ -83,3 +90,191 @@ class ResourceListTestCase(BaseListTest):
     def test_snapshots_list_paginated(self):
         self._put_n_snapshots(3)
         self._test_pagination(self.client.snapshots.list, 3)
+
+    def test_total_modes(self):
+        self._put_n_deployments(id_prefix='test', number_of_deployments=3)
+
+        def get_pagination(**params):
+            return self.get('/deployments', query_params=params)\
+                .json['metadata']['pagination']
+
+        pagination = get_pagination(_size=1)
+        self.assertEqual(pagination['total'], 3)
+        self.assertNotIn('total_estimated', pagination)
+
+        pagination = get_pagination(_size=1, _total_mode='none')
+        self.assertIsNone(pagination['total'])
+        self.assertFalse(pagination['total_estimated'])
+
+        pagination = get_pagination(_size=1, _total_mode='estimate')
+        self.assertIsInstance(pagination['total'], int)
+        self.assertGreaterEqual(pagination['total'], 1)
+        self.assertTrue(pagination['total_estimated'])
+
+        # the last page tells the exact total
+        for total_mode in ['none', 'estimate']:
+            pagination = get_pagination(_size=2, _offset=2,
+                                        _total_mode=total_mode)
+            self.assertEqual(pagination['total'], 3)
+            self.assertFalse(pagination['total_estimated'])
+
+    def _test_cursor_pagination(self, url, sort_keys):
+        all_ids = [item['id'] for item in self.get(
+            url, query_params={'_sort': sort_keys}).json['items']]
+        for size in range(1, len(all_ids) + 2):
+            ids = []
+            cursor = ''
+            while cursor is not None:
+                response = self.get(url, query_params={
+                    '_sort': sort_keys,
+                    '_size': size,
+                    '_cursor': cursor,
+                    '_include': 'id'
+                }).json
+                items = response['items']
+                self.assertLessEqual(len(items), size)
+                self.assertTrue(all(item.keys() == ['id'] for item in items))
+                ids.extend(item['id'] for item in items)
+                pagination = response['metadata']['pagination']
+                self.assertEqual(pagination['total'], len(all_ids))
+                cursor = pagination['cursor']
+            self.assertEqual(ids, all_ids)
+
+    def test_cursor_pagination(self):
+        self._put_n_deployments(id_prefix='test', number_of_deployments=3)
+        self._test_cursor_pagination('/deployments', ['-created_at'])
+        self._test_cursor_pagination('/node-instances',
+                                     ['deployment_id', '-id'])
+        self._test_cursor_pagination('/executions', ['blueprint_id'])
+
+    def test_cursor_with_offset(self):
+        response = self.get('/deployments', query_params={
+            '_cursor': '', '_offset': 1})
+        self.assertEqual(response.status_code, 400)
+        response = self.get('/deployments', query_params={
+            '_cursor': 'invalid'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_all_results(self):
+        self._put_n_deployments(id_prefix='test', number_of_deployments=3)
+        with patch.object(config.instance, 'default_page_size', 1):
+            deployments = self.sm.list(models.Deployment,
+                                       get_all_results=True)
+            self.assertEqual(len(deployments), 3)
+            self.assertEqual(deployments.metadata['pagination']['total'], 3)
+
+            streamed = self.sm.list(models.Deployment,
+                                    get_all_results=True, stream=True)
+            self.assertIsInstance(streamed.items, StreamedResults)
+            self.assertEqual(len(streamed), 3)
+            self.assertEqual(
+                sorted(deployment.id for deployment in streamed),
+                sorted(deployment.id for deployment in deployments))
+
+    def test_get_all_results_streamed(self):
+        self._put_n_deployments(id_prefix='test', number_of_deployments=3)
+        with patch.object(config.instance, 'default_page_size', 1):
+            response = self.get('/deployments', query_params={
+                '_get_all_results': 'true',
+                '_include': 'id,workflows'
+            })
+        self.assertTrue(response.is_streamed)
+        response = json.loads(response.data)
+        self.assertEqual(response['metadata']['pagination']['total'], 3)
+        self.assertEqual(len(response['items']), 3)
+        for item in response['items']:
+            self.assertEqual(set(item), {'id', 'workflows'})
+            self.assertIsInstance(item['workflows'], list)
+
+    def test_get_all_results_stream_error(self):
+        self._put_n_deployments(id_prefix='test', number_of_deployments=3)
+        iterate = StreamedResults.__iter__
+
+        def fail_after_first(results):
+            for index, result in enumerate(iterate(results)):
+                if index:
+                    raise RuntimeError('connection lost')
+                yield result
+
+        with patch.object(StreamedResults, '__iter__', fail_after_first):
+            response = self.get('/deployments', query_params={
+                '_get_all_results': 'true',
+                '_include': 'id'
+            })
+            # the status was sent before the items were fetched
+            self.assertEqual(response.status_code, 200)
+            response = json.loads(response.data)
+        self.assertEqual(response['metadata']['pagination']['total'], 3)
+        self.assertEqual(len(response['items']), 1)
+        self.assertEqual(response['error']['error_code'],
+                         manager_exceptions.INTERNAL_SERVER_ERROR_CODE)
+        self.assertIn('connection lost', response['error']['message'])
+
+    def test_insufficient_memory(self):
+        self._put_n_deployments(id_prefix='test', number_of_deployments=3)
+        with patch.object(config.instance, 'min_available_memory_mb', 100), \
+                patch.object(memory_monitor.instance, 'available_mb',
+                             return_value=50):
+            self.assertRaises(manager_exceptions.InsufficientMemoryError,
+                              self.sm.list, models.Deployment)
+            # streamed results fit in any memory
+            streamed = self.sm.list(models.Deployment,
+                                    get_all_results=True, stream=True)
+            self.assertEqual(len(list(streamed)), 3)
+
+    def test_results_memory_estimate(self):
+        self._put_n_deployments(id_prefix='test', number_of_deployments=3)
+        with patch.object(config.instance, 'min_available_memory_mb', 100), \
+                patch.object(memory_monitor.instance, 'available_mb',
+                             return_value=200), \
+                patch.object(storage_manager, 'MEMORY_ESTIMATE_MIN_ROWS', 0):
+            deployments = self.sm.list(models.Deployment,
+                                       get_all_results=True)
+            self.assertEqual(len(deployments), 3)
+            # the 3 deployments won't fit if each takes more than 33mb
+            with patch.object(storage_manager, 'RESULTS_MEMORY_FACTOR',
+                              50 * 1024 * 1024):
+                self.assertRaises(
+                    manager_exceptions.InsufficientMemoryError,
+                    self.sm.list, models.Deployment, get_all_results=True)
+                self.assertRaises(
+                    manager_exceptions.InsufficientMemoryError,
+                    self.sm.list, models.Deployment,
+                    pagination={'size': 2})
+                # a single one fits
+                deployments = self.sm.list(models.Deployment,
+                                           pagination={'size': 1})
+                self.assertEqual(len(deployments), 1)
+
+
+class MemoryMonitorTest(TestCase):
+
+    def _monitor(self, available_mb=100):
+        sample = Mock(return_value=available_mb)
+        monitor = memory_monitor.MemoryMonitor(interval=1000, sample=sample)
+        # stop the sampler thread (after its sleep)
+        self.addCleanup(setattr, monitor, '_pid', None)
+        return monitor, sample
+
+    def test_shared_sample(self):
+        monitor, sample = self._monitor()
+        for _ in range(10):
+            self.assertEqual(monitor.available_mb(), 100)
+        self.assertEqual(sample.call_count, 1)
+
+    def test_stale_sample(self):
+        monitor, sample = self._monitor()
+        monitor.available_mb()
+        sample.return_value = 50
+        monitor._sampled_at -= 1000 * memory_monitor.MAX_MISSED_SAMPLES + 1
+        self.assertEqual(monitor.available_mb(), 50)
+        self.assertEqual(sample.call_count, 2)
+
+    def test_restarted_after_fork(self):
+        monitor, sample = self._monitor()
+        with patch('manager_rest.memory_monitor.Thread') as thread:
+            monitor.available_mb()
+            with patch('os.getpid', return_value=-1):
+                monitor.available_mb()
+        self.assertEqual(thread.call_count, 2)
+        self.assertEqual(sample.call_count, 2)
@@ -0,0 +1,157 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+from datetime import datetime, timedelta
+
+from mock import MagicMock, patch
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from manager_rest.retention import RetentionEngine, RetentionPolicy
+from manager_rest.storage import db
+from manager_rest.storage.resource_models import Event, Log
+from manager_rest.test.attribute import attr
+from manager_rest.test.endpoints.test_events import SelectEventsBaseTest
+
+
+@attr(client_min_version=1, client_max_version=1)
+class RetentionTest(SelectEventsBaseTest):
+
+    """Old events and logs are removed in short transactions."""
+
+    CHUNK_SIZE = 7
+
+    def setUp(self):
+        super(RetentionTest, self).setUp()
+        self.now = datetime.utcnow()
+        self.cutoff = self.now - timedelta(days=5)
+        self.connections = []
+
+    def _connect(self):
+        conn = db.engine.raw_connection()
+        self.connections.append(conn)
+        return conn
+
+    def _count(self, model, expired=False):
+        query = db.session.query(model)
+        if expired:
+            query = query.filter(model.reported_timestamp < self.cutoff)
+        count = query.count()
+        # don't keep the tables locked while the retention runs
+        db.session.commit()
+        return count
+
+    def _run(self, policy, on_sleep=None):
+        engine = RetentionEngine(self._connect, policy,
+                                 chunk_size=self.CHUNK_SIZE)
+        with patch('manager_rest.retention.sleep',
+                   side_effect=on_sleep) as sleep:
+            report = engine.run(now=self.now)
+        return report, sleep
+
+    def test_never_locks_longer_than_a_chunk(self):
+        """Between the chunks, the tables aren't locked at all"""
+        expired = self._count(Event, True) + self._count(Log, True)
+        total = self._count(Event) + self._count(Log)
+        checker = db.engine.raw_connection()
+        self.addCleanup(checker.close)
+
+        def check_no_locks(_):
+            # the chunk was committed, so its row locks were released...
+            for conn in self.connections:
+                self.assertEqual(conn.get_transaction_status(),
+                                 TRANSACTION_STATUS_IDLE)
+            # ...and nothing else holds a lock on the tables
+            with checker.cursor() as cur:
+                cur.execute('LOCK TABLE events, logs '
+                            'IN ACCESS EXCLUSIVE MODE NOWAIT')
+            checker.rollback()
+
+        report, sleep = self._run(
+            RetentionPolicy({'events': 5, 'logs': 5}), check_no_locks)
+
+        deleted = sum(r['deleted_rows'] for r in report.values())
+        self.assertEqual(deleted, expired)
+        self.assertEqual(self._count(Event, True) + self._count(Log, True),
+                         0)
+        self.assertEqual(self._count(Event) + self._count(Log),
+                         total - expired)
+        # every chunk but the last one of each delete is followed by a sleep
+        self.assertGreaterEqual(sleep.call_count,
+                                expired // self.CHUNK_SIZE - 2)
+        for table_report in report.values():
+            self.assertGreaterEqual(table_report['duration'], 0)
+
+    def test_tenant_policy(self):
+        events = self._count(Event)
+        expired_logs = self._count(Log, True)
+        self.assertGreater(expired_logs, 0)
+
+        report, _ = self._run(RetentionPolicy(
+            default={'events': 5, 'logs': 5},
+            tenants={self.tenant.name: {'events': None}}))
+
+        self.assertEqual(self._count(Event), events)
+        self.assertEqual(self._count(Log, True), 0)
+        self.assertEqual(report['events']['deleted_rows'], 0)
+        self.assertEqual(report['logs']['deleted_rows'], expired_logs)
+
+    def test_chunks_start_after_the_previous_chunk(self):
+        conn = MagicMock()
+        cursor = conn.cursor.return_value.__enter__.return_value
+        cursor.fetchone.side_effect = [(7, 10), (7, 25), (3, 30)]
+        engine = RetentionEngine(None, None, chunk_size=self.CHUNK_SIZE)
+        with patch('manager_rest.retention.sleep'):
+            deleted = engine._delete_expired(
+                conn, 'events', 5, self.now, 'true', {})
+        self.assertEqual(deleted, 17)
+        self.assertEqual([c[0][1]['after'] for c in
+                          cursor.execute.call_args_list], [0, 10, 25])
+        self.assertEqual(conn.commit.call_count, 3)
+
+    def _count_parent(self, table):
+        count = db.session.execute(
+            'SELECT count(*) FROM ONLY {0}'.format(table)).scalar()
+        db.session.commit()
+        return count
+
+    def test_move_to_partitions(self):
+        """Rows left in the parent table are moved to their partitions"""
+        days = db.session.execute(
+            'SELECT DISTINCT CAST(reported_timestamp AS date) '
+            'FROM ONLY events').fetchall()
+        for day, in days:
+            db.session.execute('SELECT create_partition(:table, :day)',
+                               {'table': 'events', 'day': day})
+        db.session.commit()
+        events = self._count(Event)
+        in_parent = self._count_parent('events')
+        self.assertGreater(in_parent, self.CHUNK_SIZE)
+
+        report, _ = self._run(RetentionPolicy({'events': None,
+                                               'logs': None}))
+
+        self.assertEqual(report['events']['moved_rows'], in_parent)
+        self.assertEqual(self._count_parent('events'), 0)
+        self.assertEqual(self._count(Event), events)
+
+    def test_policy_days(self):
+        policy = RetentionPolicy(
+            default={'events': 5, 'logs': 5},
+            tenants={'short': {'logs': 1}, 'forever': {'events': None}})
+        self.assertEqual(policy.get_days('logs'), 5)
+        self.assertEqual(policy.get_days('logs', 'short'), 1)
+        self.assertEqual(policy.get_days('events', 'short'), 5)
+        self.assertEqual(policy.get_max_days('logs'), 5)
+        self.assertIsNone(policy.get_max_days('events'))
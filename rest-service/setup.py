@@ -20,6 +20,7 @@ install_requires = [
     'flask-restful==0.3.6',
     'flask-restful-swagger==0.20.1',
     'flask-sqlalchemy==2.3.2',
+    'sqlalchemy>=1.2,<1.4',
     'flask-security==3.0.0',
     'flask-migrate==2.2.1',
     'supervise==1.1.1',